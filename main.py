@@ -32,18 +32,18 @@ atexit.register(close_chrome)
 signal.signal(signal.SIGINT, handle_exit)
 signal.signal(signal.SIGTERM, handle_exit)
 
-def start_video_streaming(input_video, low_res_path, med_res_path, high_res_path):
+def start_video_streaming(input_video, low_res_path, med_res_path, high_res_path, **options):
     """
-    VideoStreaming の実行
+    VideoStreaming の実行（options は VideoStreaming の設定）
     """
-    video_streaming = VideoStreaming(input_video, low_res_path, med_res_path, high_res_path)
+    video_streaming = VideoStreaming(input_video, low_res_path, med_res_path, high_res_path, **options)
     video_streaming.run()
 
-def start_video_playback(layer_dir):
+def start_video_playback():
     """
     VideoPlayback の実行
     """
-    client_operator = VidepPlayback(layer_dir=layer_dir)
+    client_operator = VidepPlayback()
     client_operator.run()
 
 if __name__ == "__main__":
@@ -51,13 +51,38 @@ if __name__ == "__main__":
     monitor_queue = multiprocessing.Queue()
     input_video = "Assets/Snow.mp4"
 
-    try:
-        # フォビエイテッド圧縮を実行
-        low_res_path, med_res_path, high_res_path = h264_compression(input_video)
-        print(f"H.264 Compression completed successfully.")
-    except Exception as e:
-        print(f"Error during H.264 Compression: {e}")
-        exit(1)
+    # True の場合は入力を ffmpeg パイプで直接デコードし、中間レンディションファイルを作らない
+    use_piped_source = True
+
+    # ストリーミングの設定（VideoStreaming の引数）
+    streaming_options = {
+        # True の場合、レイヤーセグメントをチャンク (CMAF) で書き、書き始めた時点で MPD に載せて配信する（LL-DASH）
+        "low_latency": False,
+        # True の場合、配信スループットに合わせてセグメントごとにリングの半径と CRF を選ぶ（target_bitrate は上限 bps）
+        "adaptive_foveation": False,
+        "target_bitrate": 4000000,
+        # True の場合、視線の軌跡から予測した 1 つの領域でセグメント全体をマスクする（ヒット率は終了時に表示）
+        "gaze_prediction": False,
+        # 背景以外のリングを視線周辺のタイルとして書き出す場合の (width, height)。None ならフレーム全体
+        # （背景以外のどのリングの解像度も超えないこと。既定のリングでは 640x360 以下）
+        "tile_size": None,
+        # 疑似視線のモデル（"random_walk", "saccade", "replay"）と乱数のシード（None なら毎回異なる）。
+        # "replay" では gaze_replay_path の視線ログ（別のセッションの logs/gaze_log.bin）を再生する
+        "gaze_model": "random_walk",
+        "gaze_seed": None,
+        "gaze_replay_path": None,
+    }
+
+    if use_piped_source:
+        low_res_path = med_res_path = high_res_path = None
+    else:
+        try:
+            # フォビエイテッド圧縮を実行
+            low_res_path, med_res_path, high_res_path = h264_compression(input_video)
+            print(f"H.264 Compression completed successfully.")
+        except Exception as e:
+            print(f"Error during H.264 Compression: {e}")
+            exit(1)
 
     # Monitor と Plot ウィンドウのプロセスを開始
     '''
@@ -84,11 +109,11 @@ if __name__ == "__main__":
     try:
         video_streaming_process = multiprocessing.Process(
             target=start_video_streaming,
-            args=(input_video, low_res_path, med_res_path, high_res_path)
+            args=(input_video, low_res_path, med_res_path, high_res_path),
+            kwargs=streaming_options
         )
         video_playback_process = multiprocessing.Process(
-            target=start_video_playback,
-            args=("segments/segmented_video_layer",)
+            target=start_video_playback
         )
 
         # プロセス開始
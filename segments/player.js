@@ -33,17 +33,38 @@ window.addEventListener("DOMContentLoaded", async () => {
     }, 4000);
 });
 
+// "$Number%04d$" のような番号テンプレートを展開
+function formatNumber(media, number) {
+    return media.replace(/\$Number(?:%0(\d+)d)?\$/g, (_, width) =>
+        width ? String(number).padStart(parseInt(width, 10), "0") : String(number)
+    );
+}
+
+// SegmentTemplate + SegmentTimeline からセグメント URL の一覧を作る
+function expandSegmentTemplate(xmlDoc) {
+    const segments = [];
+    const template = xmlDoc.getElementsByTagName("SegmentTemplate")[0];
+    if (!template) {
+        return segments;
+    }
+    const media = template.getAttribute("media");
+    let number = parseInt(template.getAttribute("startNumber") || "1", 10);
+    for (let s of template.getElementsByTagName("S")) {
+        const repeat = parseInt(s.getAttribute("r") || "0", 10);
+        for (let i = 0; i <= repeat; i++) {
+            segments.push(formatNumber(media, number));
+            number++;
+        }
+    }
+    return segments;
+}
+
 async function fetchManifest() {
     const response = await fetch("http://localhost:8080/manifest.mpd");
     const text = await response.text();
     const parser = new DOMParser();
     const xmlDoc = parser.parseFromString(text, "application/xml");
-    const segmentUrls = xmlDoc.getElementsByTagName("SegmentURL");
-
-    const newSegments = [];
-    for (let segment of segmentUrls) {
-        newSegments.push(segment.getAttribute("media"));
-    }
+    const newSegments = expandSegmentTemplate(xmlDoc);
 
     // 新しいセグメントをリストに追加
     const currentLength = segments.length;
@@ -1,76 +1,100 @@
 import os
 import cv2
-import datetime
-import numpy as np
+import json
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
-from src.client.gaze_log_handler import load_gaze_log
+from src.client.compositor import DEFAULT_FEATHER, ROICompositor, composite_frames_where
+from src.server.foveated_compression import layer_metadata_path
+from src.server.segment_encoder import H264FileEncoder
+from src.server.manifest import SegmentIndex, create_mpd_root, write_mpd
 
 
-def combine_segments(low_path, med_path, high_path, output_path):
+def load_layer_metadata(segment_path):
+    """
+    マスク済みレイヤーセグメントに対応するサイドカー JSON（視線中心・半径・タイル位置）を読み込む。
+    存在しなければ None。
+    """
+    metadata_path = layer_metadata_path(segment_path)
+    if not os.path.exists(metadata_path):
+        return None
+    with open(metadata_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def combine_segments(layer_paths, output_path, feather=DEFAULT_FEATHER):
     """
     複数の解像度のセグメントを合成。
+    layer_paths はレイヤー名 -> セグメントのパスを外側のリングから順に並べた dict（先頭が背景）。
+    背景以外のレイヤーのサイドカーがある場合は、視線中心と半径から円形の ROI だけを事前確保した
+    バッファに貼り付け、円の縁の幅 feather ピクセル（出力の座標系）を下のレイヤーと混ぜる。
+    サイドカーがない古いセグメントは従来の合成（composite_frames_where）を使う。
+
+    合成フレームは H.264 エンコーダ（ffmpeg）の標準入力に直接流し込み、MPD の
+    codecs="avc1.42E01E" に合う mp4 を書き出す。mp4v の中間ファイルや再エンコードは行わない。
+    書きかけのファイルが見えないよう、一時ファイルに書いてから置き換える。
     """
-    cap_low = cv2.VideoCapture(low_path)
-    cap_med = cv2.VideoCapture(med_path)
-    cap_high = cv2.VideoCapture(high_path)
+    names = list(layer_paths)
+    layer_metadata = {name: load_layer_metadata(layer_paths[name]) for name in names[1:]}
+    use_roi = all(layer_metadata.values())
+
+    cap_low = cv2.VideoCapture(layer_paths[names[0]])
+    inner_caps = [cv2.VideoCapture(layer_paths[name]) for name in names[1:]]
     frame_width = int(cap_low.get(cv2.CAP_PROP_FRAME_WIDTH))
     frame_height = int(cap_low.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = int(cap_low.get(cv2.CAP_PROP_FPS))
+    fps = int(round(cap_low.get(cv2.CAP_PROP_FPS))) or 30
 
-    out = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (frame_width, frame_height))
-    
+    partial_path = output_path + ".part"
+    out = H264FileEncoder(partial_path, frame_width, frame_height, fps)
+
+    compositor = ROICompositor((frame_width, frame_height), layer_metadata, feather) if use_roi else None
+    frame_low = compositor.output if use_roi else None
+    inner_frames = [None] * len(inner_caps)
+
+    frame_number = 0
     while True:
-        # フレームを読み取る
-        ret_low, frame_low = cap_low.read()
-        ret_med, frame_med = cap_med.read()
-        ret_high, frame_high = cap_high.read()
+        # フレームを読み取る（ROI 合成では low を出力バッファに直接読み込み、他のレイヤーのバッファも使い回す）
+        ret_low, frame_low = cap_low.read(frame_low)
+        ret_inner = True
+        for i, cap in enumerate(inner_caps):
+            ret, inner_frames[i] = cap.read(inner_frames[i])
+            ret_inner = ret_inner and ret
 
         # 読み取りが終了した場合
-        if not (ret_low and ret_med and ret_high):
+        if not (ret_low and ret_inner):
             break
 
-        # 解像度を低解像度のサイズに揃える
-        frame_med = cv2.resize(frame_med, (frame_width, frame_height), interpolation=cv2.INTER_LINEAR)
-        frame_high = cv2.resize(frame_high, (frame_width, frame_height), interpolation=cv2.INTER_LINEAR)
-
-        # 高・中解像度フレームはすでに円形マスクが適応されていると仮定
-        combined_frame = np.where(
-            (frame_high[..., 0] != 0)[..., np.newaxis],  # 高解像度の非ゼロ部分をチェック
-            frame_high,
-            np.where(
-                (frame_med[..., 0] != 0)[..., np.newaxis],  # 中解像度の非ゼロ部分をチェック
-                frame_med,
-                frame_low  # 背景として低解像度フレーム
-            )
-        )
+        if use_roi:
+            combined_frame = compositor.composite(frame_low, dict(zip(names[1:], inner_frames)), frame_number)
+        else:
+            combined_frame = composite_frames_where(frame_low, *inner_frames)
+        frame_number += 1
 
         out.write(combined_frame)
 
     cap_low.release()
-    cap_med.release()
-    cap_high.release()
-    out.release()
+    for cap in inner_caps:
+        cap.release()
+    if not out.close() or frame_number == 0:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise RuntimeError(f"Failed to encode combined segment: {output_path}")
+    os.replace(partial_path, output_path)
     print(f'Segment saved: {output_path}')
 
 
-def generate_mpd(segment_dir="segments/segmented_video", mpd_path="segments/manifest.mpd", fps=30, resolution="960x540", bitrate="1500k"):
+def generate_mpd(segment_dir="segments/segmented_video", mpd_path="segments/manifest.mpd", fps=30, resolution="960x540", bitrate="1500k",
+                 segment_index=None, segment_duration=2):
     """
     MPDファイルを生成。
+    segment_index (SegmentIndex) を渡した場合はディレクトリを走査せず、SegmentTemplate を生成する。
     """
     segment_dir = os.path.abspath(segment_dir)
     mpd_path = os.path.abspath(mpd_path)
-    os.makedirs(os.path.dirname(mpd_path), exist_ok=True)
+
+    if segment_index is None:
+        segment_index = SegmentIndex.from_directory(segment_dir, r"segment_(\d+)\.mp4$", fps, segment_duration)
 
     # MPDの基本構造
-    mpd = ET.Element("MPD", attrib={
-        "xmlns": "urn:mpeg:dash:schema:mpd:2011",
-        "profiles": "urn:mpeg:dash:profile:isoff-on-demand:2011",
-        "type": "dynamic",
-        "minBufferTime": "PT1.5S",
-        "availabilityStartTime": datetime.datetime.utcnow().isoformat() + "Z",
-        "publishTime": datetime.datetime.utcnow().isoformat() + "Z"
-    })
+    mpd = create_mpd_root(segment_index.availability_start)
 
     period = ET.SubElement(mpd, "Period", attrib={"id": "1", "start": "PT0S"})
     adaptation_set = ET.SubElement(period, "AdaptationSet", attrib={
@@ -90,63 +114,9 @@ def generate_mpd(segment_dir="segments/segmented_video", mpd_path="segments/mani
         "frameRate": str(fps)
     })
 
-    segment_list = ET.SubElement(representation, "SegmentList", attrib={
-        "timescale": str(fps),
-        "duration": str(2 * fps)  # 2秒ごと
-    })
+    segment_index.add_template(representation, "segmented_video/segment_$Number%04d$.mp4")
 
-    # セグメントリストを追加
-    segment_files = sorted([f for f in os.listdir(segment_dir) if f.endswith(".mp4")])
-    for segment_file in segment_files:
-        ET.SubElement(segment_list, "SegmentURL", attrib={"media": f"segmented_video/{segment_file}"})
-
-    # 整形してファイルに書き込む
-    rough_string = ET.tostring(mpd, 'utf-8')
-    reparsed = minidom.parseString(rough_string)
-    pretty_xml_as_string = reparsed.toprettyxml(indent="  ")
-
-    with open(mpd_path, "w", encoding="utf-8") as f:
-        f.write(pretty_xml_as_string)
+    # 一時ファイル経由で書き込む
+    write_mpd(mpd, mpd_path)
 
     print(f"Combined Segments MPD ファイルを生成しました: {mpd_path}")
-
-def process_segments(layer_dir, output_dir, log_dir, fps, segment_duration, last_index):
-    segment_files = sorted([f for f in os.listdir(layer_dir) if f.endswith(".mp4")])
-    segment_count = len(segment_files) // 3  # high, med, low
-    print(f'Segment count detected in layer_dir: {segment_count}')
-
-    # output_dir に存在する既存のセグメントをチェック
-    existing_output_files = sorted([f for f in os.listdir(output_dir) if f.endswith(".mp4")])
-    existing_count = len(existing_output_files)
-    print(f'Existing segment count in output_dir: {existing_count}')
-
-    new_segments = range(last_index + 1, segment_count)  # 新しいセグメントの範囲を決定
-
-    # 新しいセグメントのみ処理
-    for i in range(existing_count, segment_count):
-        log_path = os.path.join(log_dir, f"segment_{i:04d}.txt")
-        '''
-        # 視線ログが存在するか確認
-        if not os.path.exists(log_path):
-            print(f"Warning: Gaze log not found for segment {i:04d}. Skipping...")
-            break
-        '''
-
-        # 視線ログを読み取る
-        #gaze_log = load_gaze_log(log_dir, i, fps, segment_duration)
-        #print(f'gaze log is {gaze_log}')
-
-        # 各解像度のセグメントパス
-        low_path = os.path.join(layer_dir, f"low_segment{i:04d}.mp4")
-        med_path = os.path.join(layer_dir, f"med_segment{i:04d}.mp4")
-        high_path = os.path.join(layer_dir, f"high_segment{i:04d}.mp4")
-        output_path = os.path.join(output_dir, f"segment_{i:04d}.mp4")
-
-        # 各解像度のセグメントが存在するか確認
-        if not (os.path.exists(low_path) and os.path.exists(med_path) and os.path.exists(high_path)):
-            print(f"Warning: Missing segment files for segment {i:04d} in segmented_video_layer directly. Skipping...")
-            break
-
-        # セグメントを合成
-        print(f"Combining segment {i:04d}...")
-        combine_segments(low_path, med_path, high_path, output_path)
\ No newline at end of file
@@ -1,56 +1,96 @@
 import os
 import time
-from src.client.client_functions import combine_segments, generate_mpd, process_segments
+from collections import deque
+from src.client.client_functions import generate_mpd
+from src.client.segment_combiner import SegmentCombiner
+from src.server.segment_watcher import SegmentWatcher
+from src.server.manifest import SegmentIndex
 #from src.client.gaze_log_handler import load_gaze_log
 
 class VidepPlayback:
-    def __init__(self, layer_dir = "segments/segmented_video_layer"):
+    def __init__(self, session_id=None, combine_workers=None):
+        # セッションを指定した場合は segments/<session_id>/ 以下を使う
+        session_dir = os.path.join("segments", session_id) if session_id else "segments"
+
         # セグメントディレクトリ
-        self.output_dir = os.path.abspath("segments/segmented_video")  # 絶対パスを設定
+        self.output_dir = os.path.abspath(os.path.join(session_dir, "segmented_video"))  # 絶対パスを設定
         os.makedirs(self.output_dir, exist_ok=True)
         print(f"合成セグメントディレクトリ: {self.output_dir}")
 
-        self.layer_dir = "segments/segmented_video_layer"
+        self.layer_dir = os.path.join(session_dir, "segmented_video_layer")
         #self.output_dir = "segments/segmented_video"
-        self.mpd_path = os.path.abspath("segments/manifest.mpd")  # 完全パスで保存
-        self.mpd_layer_path = "segments/manifest_layer.mpd"
-        self.log_dir = "segments/logs/gaze_logs"
+        self.mpd_path = os.path.abspath(os.path.join(session_dir, "manifest.mpd"))  # 完全パスで保存
+        self.mpd_layer_path = os.path.join(session_dir, "manifest_layer.mpd")
+        self.log_dir = os.path.join(session_dir, "logs")  # バイナリ視線ログ (gaze_log.bin) のディレクトリ
         self.segment_duration = 2
         self.fps = 30
         #self.frame_counter = 0
         self.last_segment_index = -1  # 最後に処理したセグメントのインデックス
+        # 合成済みセグメントの番号（起動時に一度だけ既存ファイルから復元する）
+        self.segment_index = SegmentIndex.from_directory(
+            self.output_dir, r"segment_(\d+)\.mp4$", self.fps, self.segment_duration
+        )
         #os.makedirs(self.output_dir, exist_ok=True)
 
+        # 合成を並列に行うワーカープロセス数（None なら CPU 数、0 ならこのプロセスで順に合成）
+        self.combine_workers = combine_workers
+        next_index = self.segment_index.last_number + 1 if len(self.segment_index) else 0
+        self.combiner = SegmentCombiner(
+            self.layer_dir, self.output_dir, segment_duration=self.segment_duration,
+            max_workers=combine_workers, next_index=next_index
+        )
+        # レイヤーセグメントが閉じられてから合成セグメントが公開されるまでの遅延 [ms]
+        self.latencies_ms = deque(maxlen=300)
+
+    def record_latency(self, watcher, indices):
+        """
+        レイヤーセグメントが閉じられてから、合成セグメントが MPD に載るまでの遅延 [ms] を記録する。
+        """
+        now = time.time()
+        for index in indices:
+            closed_at = watcher.closed_at(index)
+            discovery_ms = (watcher.detected_at.pop(index, now) - closed_at) * 1000
+            self.latencies_ms.append((now - closed_at) * 1000)
+            print(
+                f"Segment {index:04d}: discovered {discovery_ms:.1f} ms, "
+                f"composite available {self.latencies_ms[-1]:.1f} ms after close"
+            )
+        latencies = sorted(self.latencies_ms)
+        print(
+            f"Close-to-composite latency: p50 {latencies[len(latencies) // 2]:.1f} ms, "
+            f"max {latencies[-1]:.1f} ms (last {len(latencies)} segments)"
+        )
+
     def run(self):
         running = True
-        start_time = time.time()  # 処理開始時間の記録
+        # 全レイヤーのセグメントが確定するたびに通知を受け、すぐに合成を投入する
+        watcher = SegmentWatcher(self.layer_dir)
+        print(f"Segment discovery: {watcher.backend}")
 
         while running:
-            # 2秒ごとにMPDとログを保存
-            elapsed_time = time.time() - start_time  # 経過時間の計算
-            if elapsed_time >= self.segment_duration:  # 2秒経過時に処理を実行
-                try:
-                    process_segments(
-                        layer_dir=self.layer_dir,
-                        output_dir=self.output_dir,
-                        log_dir=self.log_dir,
-                        fps=self.fps,
-                        segment_duration=self.segment_duration,
-                        last_index=self.last_segment_index
-                    )
+            # 合成中のセグメントがある間は、完了を拾うために短い間隔で戻る
+            ready = watcher.wait(timeout=0.01 if self.combiner.pending else 0.5)
+            try:
+                if ready:
+                    self.combiner.submit(ready[-1] + 1)
+                combined = self.combiner.collect()
+                for index in combined:
+                    self.segment_index.append(index)
+                    self.last_segment_index = index
+                if combined:
                     generate_mpd(
                         segment_dir=self.output_dir,
                         mpd_path=self.mpd_path,
                         fps=self.fps,
                         resolution="960x540",
-                        bitrate="1500k"
+                        bitrate="1500k",
+                        segment_index=self.segment_index
                     )
-                    #print("Combined Segments MPD generation completed.")
-                    self.frame_counter = 0  # フレームカウンターをリセット
-                except Exception as e:
-                    print(f'Segments Combining or Combined Segments MPD Generating faled: {e}')
-                    break
-                start_time = time.time()  # 処理後に時間をリセット
-
-            time.sleep(0.01)  # 短いウェイトで負荷を軽減
-            #self.frame_counter += 1
\ No newline at end of file
+                    self.record_latency(watcher, combined)
+                    print(f"Combiner: {self.combiner.stats()}")
+            except Exception as e:
+                print(f'Segments Combining or Combined Segments MPD Generating faled: {e}')
+                break
+
+        watcher.close()
+        self.combiner.close()
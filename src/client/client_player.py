@@ -1,18 +1,82 @@
 import shutil
 import os
 
-def create_client_player(output_dir="segments", mpd_url="http://localhost:8080/manifest.mpd"):
+def create_low_latency_player(output_dir, mpd_url, target_latency=1.0):
+    """
+    dash.js の低遅延 (LL-DASH) 設定を有効にしたプレイヤー player_ll.html / player_ll.js を生成します。
+    目標遅延からのずれは再生速度の調整 (liveCatchup) で追いつき、現在の遅延をコンソールに出力します。
+    """
+    html_content = """<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Foveated Compression Low-Latency MPEG-DASH Player</title>
+    <script src="https://cdn.dashjs.org/latest/dash.all.min.js"></script>
+</head>
+<body>
+    <h1>Low-Latency MPEG-DASH Video Player</h1>
+    <video id="videoPlayer" controls width="960" height="540"></video>
+    <div id="latency">latency: -</div>
+    <script src="player_ll.js"></script>
+</body>
+</html>
+"""
+
+    js_content = f"""const url = "{mpd_url}";
+const video = document.getElementById('videoPlayer');
+const player = dashjs.MediaPlayer().create();
+
+player.updateSettings({{
+    streaming: {{
+        lowLatencyEnabled: true,
+        delay: {{ liveDelay: {target_latency} }},
+        liveCatchup: {{
+            enabled: true,
+            maxDrift: {max(0.5, target_latency)},
+            playbackRate: {{ min: -0.3, max: 0.3 }}
+        }},
+        buffer: {{ fastSwitchEnabled: true }}
+    }}
+}});
+player.initialize(video, url, true);
+video.muted = true;
+
+setInterval(() => {{
+    const latency = player.getCurrentLiveLatency();
+    document.getElementById('latency').innerText = `latency: ${{latency.toFixed(2)}} s`;
+    console.log(`live latency ${{latency.toFixed(3)}} s, buffer ${{player.getBufferLength('video').toFixed(3)}} s`);
+}}, 1000);
+"""
+
+    dest_html = os.path.join(output_dir, "player_ll.html")
+    dest_js = os.path.join(output_dir, "player_ll.js")
+    with open(dest_html, "w", encoding="utf-8") as html_file:
+        html_file.write(html_content)
+    with open(dest_js, "w", encoding="utf-8") as js_file:
+        js_file.write(js_content)
+    print(f"低遅延プレイヤーのファイルを生成しました: {dest_html}, {dest_js}")
+
+
+def create_client_player(output_dir="segments", mpd_url="http://localhost:8080/manifest.mpd", low_latency=False,
+                         target_latency=1.0):
     """
     MPEG-DASH クライアントプレイヤーの HTML と JavaScript ファイルを生成またはコピーします。
 
     Args:
         output_dir (str): ファイルを保存するディレクトリ。
         mpd_url (str): MPD ファイルの URL。
+        low_latency (bool): True の場合、dash.js の低遅延設定を有効にした player_ll.html / player_ll.js を生成する。
+        target_latency (float): 低遅延モードの目標遅延（秒）。
     """
     # ディレクトリの作成
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    if low_latency:
+        create_low_latency_player(output_dir, mpd_url, target_latency)
+        return
+
     # コピー元とコピー先のファイルパス
     source_html = os.path.join(output_dir, "player.html")
     source_js = os.path.join(output_dir, "player.js")
@@ -72,13 +136,13 @@ def create_client_player(output_dir="segments", mpd_url="http://localhost:8080/m
         video.autoplay = true;
         video.muted = true;
 
-        player.updateSettings({
-            'streaming': {
+        player.updateSettings({{
+            'streaming': {{
                 'liveDelay': 3,
                 'jumpGaps': true,
                 'lowLatencyEnabled': false  // 低遅延モードを無効化
-            }
-        });
+            }}
+        }});
 
         setInterval(() => {{
             console.log("MPD ファイルを再読み込みします");
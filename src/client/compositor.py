@@ -0,0 +1,273 @@
+"""
+ROI 合成。
+
+従来の合成（composite_frames_where）は背景以外のレイヤーのフレーム全体を low のサイズに縮小し、
+チャンネル 0 が 0 かどうかでマスク領域を推定して合成する。
+この方法はフレームごとにフレーム全体の一時配列を作り、元から黒い画素をマスク外と誤認する。
+
+ROICompositor はサーバが書き出すサイドカー JSON の視線中心と半径を使い、
+各レイヤーの円の外接矩形だけを縮小して、事前に確保した出力バッファに円形ステンシルで貼り付ける。
+feather を指定すると、円の縁の幅 feather ピクセルの円環を固定小数点の重み（src.server.foveation_rings の
+radial_weight_lut）で下のレイヤーと混ぜ、リングの境界の継ぎ目を目立たなくする。
+境界を混ぜる分だけ ROI の整数演算が増えるため、ステンシルで貼り付けるだけの合成より遅くなる。
+"""
+import time
+import cv2
+import numpy as np
+from src.server.foveated_compression import circle_roi, get_circle_stencil
+from src.server.foveation_rings import WEIGHT_ONE, patch_distance_sq, radial_weight_lut
+
+# 合成セグメントでリングの境界を混ぜる幅（出力 = low のピクセル）
+DEFAULT_FEATHER = 4
+
+
+def composite_frames_where(frame_low, *inner_frames):
+    """
+    従来の合成方法。背景以外のレイヤー（外側から順）を low のサイズに揃え、内側のレイヤーの非ゼロ画素を優先して合成する。
+    各画素がどのレイヤーから来るかのラベルマップを作り、積み重ねたレイヤーから 1 回のギャザーで取り出す。
+    """
+    frame_height, frame_width = frame_low.shape[:2]
+    pixels = frame_width * frame_height
+    stack = np.empty((len(inner_frames) + 1, frame_height, frame_width, 3), dtype=np.uint8)
+    stack[0] = frame_low  # 背景として低解像度フレーム
+    labels = np.zeros((frame_height, frame_width), dtype=np.intp)
+    for label, frame in enumerate(inner_frames, 1):
+        cv2.resize(frame, (frame_width, frame_height), dst=stack[label], interpolation=cv2.INTER_LINEAR)
+        # 内側のレイヤーはすでに円形マスクが適応されていると仮定し、非ゼロ部分で上書きする
+        labels[stack[label][..., 0] != 0] = label
+
+    gather_index = labels * pixels + np.arange(pixels, dtype=np.intp).reshape(frame_height, frame_width)
+    return np.take(stack.reshape(-1, 3), gather_index.reshape(-1), axis=0).reshape(frame_height, frame_width, 3)
+
+
+class ROICompositor:
+    """
+    low フレームの上に外側のリングから順に（既定では med → high）円形の ROI だけを貼り付ける合成器。
+
+    Args:
+        low_size (tuple): 出力 (= low レイヤー) の (width, height)。
+        layer_metadata (dict): 背景以外のレイヤーごとのサイドカー JSON の内容を外側から順に並べたもの
+            （frame_size, radius, centers と、タイルモードなら tile_size, offsets）。
+        feather (int): 円の縁を下のレイヤーと混ぜる幅（出力のピクセル）。0 なら円形ステンシルでそのまま貼り付ける。
+    """
+    def __init__(self, low_size, layer_metadata, feather=0):
+        self.width, self.height = low_size
+        self.output = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self.layers = [(name, metadata) for name, metadata in layer_metadata.items() if metadata]
+        self.scratch = {}
+        self.masks = {}
+        self.feather = feather
+        self.weights = {}
+        self.blend_buffers = {}
+
+    def scratch_buffer(self, height, width):
+        buffer = self.scratch.get((height, width))
+        if buffer is None:
+            buffer = np.empty((height, width, 3), dtype=np.uint8)
+            self.scratch[(height, width)] = buffer
+        return buffer
+
+    def circle_mask(self, radius):
+        mask = self.masks.get(radius)
+        if mask is None:
+            mask = get_circle_stencil((1, 1), radius).astype(bool)[..., np.newaxis]
+            self.masks[radius] = mask
+        return mask
+
+    def weight_patch(self, radius):
+        """
+        半径 radius の円 (2r+1 x 2r+1) の固定小数点の重み w と WEIGHT_ONE - w（0〜WEIGHT_ONE の uint16）
+        """
+        weights = self.weights.get(radius)
+        if weights is None:
+            distance_sq = np.minimum(patch_distance_sq(radius), radius * radius)
+            weight = radial_weight_lut(radius, self.feather)[distance_sq][..., np.newaxis]
+            weights = np.stack((weight, WEIGHT_ONE - weight))
+            self.weights[radius] = weights
+        return weights
+
+    def blend_roi(self, target, foreground, weights):
+        """
+        target = (foreground * w + target * (WEIGHT_ONE - w) + 128) >> 8 を uint16 の整数演算で求める。
+        """
+        buffers = self.blend_buffers.get(target.shape)
+        if buffers is None:
+            buffers = (np.empty(target.shape, dtype=np.uint16), np.empty(target.shape, dtype=np.uint16))
+            self.blend_buffers[target.shape] = buffers
+        blended, background = buffers
+        np.multiply(foreground, weights[0], out=blended)
+        np.multiply(target, weights[1], out=background)
+        blended += background
+        blended += WEIGHT_ONE // 2
+        blended >>= 8
+        np.copyto(target, blended, casting="unsafe")
+
+    def paste(self, frame, metadata, frame_number):
+        """
+        レイヤーのフレーム（タイルモードならタイル）から円形 ROI を縮小して出力に貼り付ける。
+        """
+        centers = metadata["centers"]
+        if not centers:
+            return
+        i = min(frame_number, len(centers) - 1)
+        layer_w, layer_h = metadata["frame_size"]
+        scale_x, scale_y = self.width / layer_w, self.height / layer_h
+        center_x, center_y = centers[i]
+        radius = max(1, int(round(metadata["radius"] * scale_x)))
+
+        roi = circle_roi(self.output.shape, int(round(center_x * scale_x)), int(round(center_y * scale_y)), radius)
+        if roi is None:
+            return
+        (y0, y1, x0, x1), (sy0, sy1, sx0, sx1) = roi
+
+        # ROI をタイルが覆う出力上の範囲に絞る（円がタイルより大きい場合、タイルの外は欠けている）
+        offset_x, offset_y = metadata["offsets"][i] if metadata.get("offsets") else (0, 0)
+        frame_h, frame_w = frame.shape[:2]
+        tile_x0, tile_x1 = int(np.ceil(offset_x * scale_x)), int((offset_x + frame_w) * scale_x)
+        tile_y0, tile_y1 = int(np.ceil(offset_y * scale_y)), int((offset_y + frame_h) * scale_y)
+        if tile_x0 > x0:
+            sx0 += tile_x0 - x0
+            x0 = tile_x0
+        if tile_x1 < x1:
+            sx1 -= x1 - tile_x1
+            x1 = tile_x1
+        if tile_y0 > y0:
+            sy0 += tile_y0 - y0
+            y0 = tile_y0
+        if tile_y1 < y1:
+            sy1 -= y1 - tile_y1
+            y1 = tile_y1
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        # 出力上の ROI に対応するレイヤー（タイル）上の範囲
+        src_x0 = int(max(0, min(frame_w - 1, x0 / scale_x - offset_x)))
+        src_y0 = int(max(0, min(frame_h - 1, y0 / scale_y - offset_y)))
+        src_x1 = int(max(src_x0 + 1, min(frame_w, np.ceil(x1 / scale_x - offset_x))))
+        src_y1 = int(max(src_y0 + 1, min(frame_h, np.ceil(y1 / scale_y - offset_y))))
+
+        resized = self.scratch_buffer(y1 - y0, x1 - x0)
+        cv2.resize(frame[src_y0:src_y1, src_x0:src_x1], (x1 - x0, y1 - y0), dst=resized, interpolation=cv2.INTER_LINEAR)
+        if self.feather:
+            self.blend_roi(self.output[y0:y1, x0:x1], resized, self.weight_patch(radius)[:, sy0:sy1, sx0:sx1])
+        else:
+            np.copyto(self.output[y0:y1, x0:x1], resized, where=self.circle_mask(radius)[sy0:sy1, sx0:sx1])
+
+    def composite(self, frame_low, layer_frames, frame_number):
+        """
+        Args:
+            frame_low: low フレーム。self.output に直接読み込んだ場合はコピーしない。
+            layer_frames (dict): 背景以外のレイヤーのフレーム。
+            frame_number (int): セグメント内のフレーム番号（サイドカーの添字）。
+
+        Returns:
+            np.ndarray: 合成結果（self.output。次の呼び出しで上書きされる）
+        """
+        if frame_low is not self.output:
+            np.copyto(self.output, frame_low)
+        for name, metadata in self.layers:
+            self.paste(layer_frames[name], metadata, frame_number)
+        return self.output
+
+
+def validate_compositor(layer_paths, layer_metadata, max_frames=None):
+    """
+    同じセグメントを従来の合成と ROI 合成で処理し、差分を報告する。
+
+    Args:
+        layer_paths (dict): レイヤー名 -> セグメントのパス（外側から順。先頭が背景）。
+        layer_metadata (dict): 背景以外のレイヤーのサイドカー JSON の内容。
+
+    Returns:
+        dict: フレーム数、平均絶対誤差、最大絶対誤差、PSNR [dB]
+    """
+    names = list(layer_paths)
+    captures = [cv2.VideoCapture(path) for path in layer_paths.values()]
+    width = int(captures[0].get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(captures[0].get(cv2.CAP_PROP_FRAME_HEIGHT))
+    compositor = ROICompositor((width, height), layer_metadata)
+
+    frames = 0
+    abs_error_sum = 0.0
+    squared_error_sum = 0.0
+    max_error = 0
+    while max_frames is None or frames < max_frames:
+        results = [capture.read() for capture in captures]
+        if not all(ret for ret, _ in results):
+            break
+        layer_frames = [frame for _, frame in results]
+
+        # 従来の合成はタイルを扱えないので、フルフレームのセグメントで比較する
+        expected = composite_frames_where(*layer_frames)
+        actual = compositor.composite(layer_frames[0], dict(zip(names[1:], layer_frames[1:])), frames)
+        diff = cv2.absdiff(expected, actual)
+        abs_error_sum += float(diff.mean())
+        squared_error_sum += float(np.square(diff, dtype=np.float32).mean())
+        max_error = max(max_error, int(diff.max()))
+        frames += 1
+
+    for capture in captures:
+        capture.release()
+
+    mse = squared_error_sum / max(frames, 1)
+    result = {
+        "frames": frames,
+        "mean_abs_error": abs_error_sum / max(frames, 1),
+        "max_abs_error": max_error,
+        "psnr_db": float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse),
+    }
+    print(f"Compositor validation: {result}")
+    return result
+
+
+def benchmark_compositor(frames=300, low_size=(480, 270), med_size=(640, 360), high_size=(1920, 1080),
+                         med_radius=100, high_radius=100, seed=0):
+    """
+    合成済みレイヤーを模した合成フレームで、従来の合成と ROI 合成の処理速度を比較する。
+
+    Returns:
+        dict: それぞれの frames per second
+    """
+    rng = np.random.default_rng(seed)
+    frame_low = rng.integers(0, 256, (low_size[1], low_size[0], 3), dtype=np.uint8)
+    frame_med = rng.integers(0, 256, (med_size[1], med_size[0], 3), dtype=np.uint8)
+    frame_high = rng.integers(0, 256, (high_size[1], high_size[0], 3), dtype=np.uint8)
+
+    # 視線は中央付近をランダムに動かし、円外は 0 にしておく
+    centers = [
+        (int(high_size[0] / 2 + rng.integers(-200, 200)), int(high_size[1] / 2 + rng.integers(-100, 100)))
+        for _ in range(frames)
+    ]
+    med_scale = med_size[0] / high_size[0]
+    metadata = {
+        "med": {"frame_size": list(med_size), "radius": med_radius,
+                "centers": [(int(x * med_scale), int(y * med_scale)) for x, y in centers]},
+        "high": {"frame_size": list(high_size), "radius": high_radius, "centers": centers},
+    }
+    masked_med = np.zeros_like(frame_med)
+    masked_high = np.zeros_like(frame_high)
+    cx, cy = centers[0]
+    cv2.circle(masked_high, (cx, cy), high_radius, (255, 255, 255), -1)
+    cv2.circle(masked_med, (int(cx * med_scale), int(cy * med_scale)), med_radius, (255, 255, 255), -1)
+    np.bitwise_and(masked_high, frame_high, out=masked_high)
+    np.bitwise_and(masked_med, frame_med, out=masked_med)
+
+    start = time.perf_counter()
+    for _ in range(frames):
+        composite_frames_where(frame_low, masked_med, masked_high)
+    where_seconds = time.perf_counter() - start
+
+    compositor = ROICompositor(low_size, metadata)
+    start = time.perf_counter()
+    for i in range(frames):
+        compositor.composite(frame_low, {"med": masked_med, "high": masked_high}, i)
+    roi_seconds = time.perf_counter() - start
+
+    result = {
+        "frames": frames,
+        "where_fps": frames / where_seconds,
+        "roi_fps": frames / roi_seconds,
+        "speedup": where_seconds / roi_seconds,
+    }
+    print(f"Compositor benchmark: {result}")
+    return result
@@ -1,39 +1,104 @@
 import os
+import numpy as np
+from src.server.log_writing import GAZE_LOG_HEADER, GAZE_RECORD, read_gaze_log_header
 
-def load_gaze_log(log_dir, segment_index, fps, duration):
+
+class GazeLogReader:
+    """
+    バイナリ視線ログ（src.server.log_writing.GazeLogWriter が書いたもの）を np.memmap で参照する。
+    レコードはフレーム番号の昇順に並んでいるため、フレーム範囲は二分探索で切り出す（コピーしない）。
+
+    Args:
+        path (str): ログファイルのパス。
+    """
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"視線ログファイルが見つかりません: {path}")
+        self.path = path
+        self.identity = None
+        self.records = np.empty(0, dtype=GAZE_RECORD)
+        self.refresh()
+
+    def refresh(self):
+        """
+        書き手が追記した分を読めるよう、ファイルを開き直す。末尾の不完全なレコードは含めない。
+        新しいセッションの書き手がログを作り直した場合（別のファイルになった場合）は、最初から読み直す。
+
+        Returns:
+            int: レコード数
+        """
+        st = os.stat(self.path)
+        identity = (st.st_dev, st.st_ino)
+        if identity != self.identity:
+            with open(self.path, "rb") as f:
+                read_gaze_log_header(f)
+            self.identity = identity
+            self.records = np.empty(0, dtype=GAZE_RECORD)
+        count = max(0, (st.st_size - GAZE_LOG_HEADER.size) // GAZE_RECORD.itemsize)
+        if count != len(self.records):
+            if count > 0:
+                self.records = np.memmap(self.path, dtype=GAZE_RECORD, mode="r",
+                                         offset=GAZE_LOG_HEADER.size, shape=(count,))
+            else:
+                self.records = np.empty(0, dtype=GAZE_RECORD)
+        return count
+
+    def __len__(self):
+        return len(self.records)
+
+    def frame_range(self, start_frame, stop_frame):
+        """[start_frame, stop_frame) のフレームのサンプルがあるレコードの範囲 (開始, 終了)"""
+        frames = self.records["frame"]
+        return (
+            int(np.searchsorted(frames, start_frame, side="left")),
+            int(np.searchsorted(frames, stop_frame, side="left")),
+        )
+
+    def read(self, start_frame, stop_frame):
+        """
+        [start_frame, stop_frame) のフレームのサンプルをすべて返す。
+
+        Returns:
+            tuple: (timestamp, frame, x, y) の配列（memmap のビュー）
+        """
+        lo, hi = self.frame_range(start_frame, stop_frame)
+        records = self.records[lo:hi]
+        return records["timestamp"], records["frame"], records["x"], records["y"]
+
+    def positions(self, start_frame, stop_frame):
+        """
+        [start_frame, stop_frame) の各フレームの視線位置を返す。
+        1 フレームに複数のサンプルがあれば最後のものを、サンプルのないフレームは直前のサンプルを使う。
+
+        Returns:
+            np.ndarray: (stop_frame - start_frame, 2) の int32 配列 [[x, y], ...]
+        """
+        frames = self.records["frame"]
+        wanted = np.arange(start_frame, stop_frame, dtype=np.int64)
+        indices = np.searchsorted(frames, wanted, side="right") - 1
+        if wanted.size and indices[0] < 0:
+            raise ValueError(f"フレーム {start_frame} 以前の視線サンプルがありません")
+        if wanted.size and frames[-1] < stop_frame - 1:
+            raise ValueError(f"視線ログが不完全です。最後のフレーム: {int(frames[-1])}, 必要なフレーム: {stop_frame - 1}")
+        positions = np.empty((wanted.size, 2), dtype=np.int32)
+        positions[:, 0] = self.records["x"][indices]
+        positions[:, 1] = self.records["y"][indices]
+        return positions
+
+
+def load_gaze_log(log_path, segment_index, fps, duration):
     """
-    指定されたセグメントの疑似視線ログを読み込む。
+    指定されたセグメントの視線位置を読み込む。
 
     Parameters:
-    - log_dir (str): ログファイルが保存されているディレクトリ
+    - log_path (str): バイナリ視線ログのパス（src.server.log_writing.gaze_log_path）
     - segment_index (int): セグメントのインデックス
     - fps (int): フレームレート
     - duration (int): セグメントの長さ（秒）
 
     Returns:
-    - list[tuple]: フレームごとの視線位置 (x, y) のリスト
+    - np.ndarray: フレームごとの視線位置 (fps * duration, 2)
     """
-    log_file = os.path.join(log_dir, f"segment_{segment_index:04d}.txt")
-    if not os.path.exists(log_file):
-        raise FileNotFoundError(f"視線ログファイルが見つかりません: {log_file}")
-
-    gaze_positions = []
-    with open(log_file, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith("Frame") or not line:  # ヘッダー行や空行をスキップ
-                continue
-            parts = line.split(",")
-            if len(parts) != 3:
-                continue
-            try:
-                frame, x, y = map(int, parts)
-                gaze_positions.append((x, y))
-            except ValueError:
-                continue
-
-    expected_frames = fps * duration
-    if len(gaze_positions) != expected_frames:
-        raise ValueError(f"視線ログが不完全です。期待されるフレーム数: {expected_frames}, 実際のフレーム数: {len(gaze_positions)}")
-
-    return gaze_positions
+    frames_per_segment = fps * duration
+    start = segment_index * frames_per_segment
+    return GazeLogReader(log_path).positions(start, start + frames_per_segment)
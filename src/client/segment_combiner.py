@@ -0,0 +1,178 @@
+"""
+並列セグメント合成。
+
+揃ったレイヤーセグメントの番号をプロセスプールに投入し、完了順に関係なく
+番号順に連続した分だけを公開する（MPD の SegmentTimeline は連続した番号しか追記できないため）。
+
+追いつき指標:
+- backlog: 合成可能になったが、まだ公開していないセグメント数
+- catch_up_ratio: 直近の公開速度 [セグメント/秒] × セグメント長。1 を超えていれば実時間より速く
+  消化しており、バックログは縮む。
+- catch_up_seconds: バックログが 2 以上になってから 1 以下に戻るまでにかかった時間
+"""
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from src.client.client_functions import combine_segments
+from src.client.compositor import DEFAULT_FEATHER
+from src.server.segment_watcher import LAYERS
+
+
+def layer_segment_paths(layer_dir, index, layers=LAYERS):
+    """レイヤー名 -> セグメント index のパス（外側のリングから順）"""
+    return {layer: os.path.join(layer_dir, f"{layer}_segment{index:04d}.mp4") for layer in layers}
+
+
+def combine_segment(layer_dir, output_dir, index, layers=LAYERS, feather=DEFAULT_FEATHER):
+    """
+    セグメント index を合成する（ワーカープロセスで実行されるため、モジュールレベルの関数にしている）。
+
+    Returns:
+        tuple: (index, 合成にかかった秒数)
+    """
+    start = time.perf_counter()
+    combine_segments(
+        layer_segment_paths(layer_dir, index, layers), os.path.join(output_dir, f"segment_{index:04d}.mp4"), feather
+    )
+    return index, time.perf_counter() - start
+
+
+class SegmentCombiner:
+    """
+    Args:
+        layer_dir (str): レイヤーセグメントのディレクトリ。
+        output_dir (str): 合成セグメントの出力先。
+        segment_duration (float): セグメント長（秒）。追いつき指標の計算に使う。
+        max_workers (int): ワーカープロセス数。None なら CPU 数、0 なら呼び出し元のプロセスで順に合成する。
+        next_index (int): 最初に合成するセグメント番号（既存の合成済みセグメントの次）。
+        rate_window (int): catch_up_ratio を計算する直近の公開数。
+        max_retries (int): 合成に失敗したセグメントを再投入する回数。
+        layers (tuple): 合成するレイヤー名（外側のリングから順）。
+        feather (int): リングの境界を混ぜる幅（合成セグメントのピクセル）。0 なら境界は混ぜない。
+    """
+    def __init__(self, layer_dir, output_dir, segment_duration=2, max_workers=None, next_index=0, rate_window=10,
+                 max_retries=2, layers=LAYERS, feather=DEFAULT_FEATHER):
+        self.layer_dir = layer_dir
+        self.layers = tuple(layers)
+        self.feather = feather
+        self.output_dir = output_dir
+        self.segment_duration = segment_duration
+        self.max_workers = os.cpu_count() if max_workers is None else max_workers
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers) if self.max_workers > 0 else None
+
+        self.next_submit = next_index
+        self.next_publish = next_index
+        self.available = next_index  # 合成可能になったセグメント数（= 次に揃う番号）
+        self.pending = {}  # index -> Future
+        self.finished = {}  # index -> 合成秒数（公開待ち）
+        self.max_retries = max_retries
+        self.retries = {}  # index -> 再投入した回数
+
+        self.publish_times = deque(maxlen=rate_window)
+        self.combine_seconds = 0.0
+        self.published = 0
+        self.max_backlog = 0
+        self.backlog_since = None
+        self.catch_up_seconds = []
+
+    def submit(self, segment_count):
+        """
+        segment_count 未満でまだ投入していない番号を投入する。全レイヤーが揃っていない番号で止める。
+        """
+        self.available = max(self.available, segment_count)
+        while self.next_submit < segment_count:
+            index = self.next_submit
+            if not all(os.path.exists(path) for path in layer_segment_paths(self.layer_dir, index, self.layers).values()):
+                print(f"Warning: Missing segment files for segment {index:04d} in segmented_video_layer directly. Skipping...")
+                break
+            print(f"Combining segment {index:04d}...")
+            self.dispatch(index)
+            self.next_submit += 1
+        self.update_backlog()
+
+    def dispatch(self, index):
+        if self.executor is None:
+            _, seconds = combine_segment(self.layer_dir, self.output_dir, index, self.layers, self.feather)
+            self.finished[index] = seconds
+        else:
+            self.pending[index] = self.executor.submit(
+                combine_segment, self.layer_dir, self.output_dir, index, self.layers, self.feather
+            )
+
+    def collect(self, wait=False):
+        """
+        完了した合成を回収し、番号順に連続して公開できるセグメント番号のリストを返す。
+        wait=True の場合は、投入済みのすべての合成が終わるまで待つ。
+        max_retries 回再投入しても失敗したセグメントがあれば RuntimeError を送出する
+        （番号が欠けると以降のセグメントを MPD に追記できないため）。
+        """
+        for index, future in list(self.pending.items()):
+            if not (wait or future.done()):
+                continue
+            del self.pending[index]
+            try:
+                _, seconds = future.result()
+            except Exception as e:
+                retries = self.retries.get(index, 0)
+                if retries >= self.max_retries:
+                    raise RuntimeError(f"Combining segment {index:04d} failed: {e}") from e
+                print(f"Combining segment {index:04d} failed ({e}). Retrying...")
+                self.retries[index] = retries + 1
+                self.dispatch(index)
+                continue
+            self.finished[index] = seconds
+
+        ready = []
+        while self.next_publish in self.finished:
+            self.combine_seconds += self.finished.pop(self.next_publish)
+            ready.append(self.next_publish)
+            self.next_publish += 1
+
+        now = time.perf_counter()
+        for _ in ready:
+            self.publish_times.append(now)
+        self.published += len(ready)
+        self.update_backlog()
+        return ready
+
+    def backlog(self):
+        return self.available - self.next_publish
+
+    def update_backlog(self):
+        backlog = self.backlog()
+        self.max_backlog = max(self.max_backlog, backlog)
+        now = time.perf_counter()
+        if backlog >= 2 and self.backlog_since is None:
+            self.backlog_since = now
+        elif backlog <= 1 and self.backlog_since is not None:
+            self.catch_up_seconds.append(now - self.backlog_since)
+            self.backlog_since = None
+
+    def catch_up_ratio(self):
+        """
+        直近の公開速度 ÷ 実時間のセグメント生成速度。計算できない場合は None。
+        """
+        if len(self.publish_times) < 2:
+            return None
+        elapsed = self.publish_times[-1] - self.publish_times[0]
+        if elapsed <= 0:
+            return None
+        return (len(self.publish_times) - 1) / elapsed * self.segment_duration
+
+    def stats(self):
+        ratio = self.catch_up_ratio()
+        return {
+            "workers": self.max_workers,
+            "published": self.published,
+            "in_flight": len(self.pending),
+            "backlog": self.backlog(),
+            "max_backlog": self.max_backlog,
+            "catch_up_ratio": None if ratio is None else round(ratio, 2),
+            "last_catch_up_seconds": round(self.catch_up_seconds[-1], 3) if self.catch_up_seconds else None,
+            "mean_combine_seconds": round(self.combine_seconds / self.published, 3) if self.published else None,
+        }
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
@@ -0,0 +1,44 @@
+"""
+低遅延 (チャンク CMAF) モード用の補助関数。
+
+低遅延モードの常駐エンコーダは、各セグメントを断片化 MP4 として書き出す
+（先頭に空の moov を置き、以降は chunk_duration ごとの moof + mdat を追記する）。
+チャンクはエンコードされた順にファイルへ書き足されるため、HTTP サーバはセグメントの完成を待たずに
+chunked transfer encoding で送り始められる。
+
+同じエンコーダが書くセグメントの ftyp + moov は共通なので、最初のセグメントの先頭から切り出して
+DASH の初期化セグメントにする。
+"""
+import os
+import struct
+
+
+def read_init_segment(segment_path):
+    """
+    断片化 MP4 の先頭の ftyp + moov を返す。moov がまだ書き終わっていなければ None。
+    """
+    try:
+        with open(segment_path, "rb") as f:
+            data = f.read(64 * 1024)
+    except FileNotFoundError:
+        return None
+
+    offset = 0
+    while offset + 8 <= len(data):
+        size, box_type = struct.unpack(">I4s", data[offset:offset + 8])
+        if size == 1:
+            if offset + 16 > len(data):
+                return None
+            size = struct.unpack(">Q", data[offset + 8:offset + 16])[0]
+        if size < 8 or offset + size > len(data):
+            return None
+        offset += size
+        if box_type == b"moov":
+            return data[:offset]
+        if box_type in (b"moof", b"mdat"):
+            return None
+    return None
+
+
+def init_segment_path(segment_dir, layer):
+    return os.path.join(segment_dir, f"{layer}_init.mp4")
@@ -16,27 +16,127 @@ result=src1×α+src2×β+γ
     ).astype(np.uint8)
 
 よって現在は、条件分岐を使って合成を行っている。
+リングごとの np.where の入れ子は、リングを増やすとフレーム全体の走査と一時配列がその数だけ増えるため、
+merge_frame は src.server.foveation_rings.merge_rings（ラベルマップによる 1 回のギャザー）で合成する。
+
+ただし条件分岐の合成ではリングの境界に継ぎ目が見える。merge_frame に feather を指定すると、
+境界の幅 feather ピクセルの円環だけを固定小数点の重み（uint16 の LUT）で混ぜ、それ以外はギャザーで
+コピーする。フレーム全体を浮動小数点で混ぜないため、上の αブレンドの式のコストはかからず np.where の合成よりは速いが、
+円環を混ぜる分だけ境界を混ぜないギャザーより遅くなり、その差は円環の画素数とリングの数に比例して広がる
+（src.server.foveation_rings.benchmark_ring_blend で確認できる）。
 """
 import cv2
 import numpy as np
 import os
+import json
+from src.server.foveation_rings import merge_rings
 
 segment_layer_index = 0
 
-def apply_circular_mask(frame, center_x, center_y, radius, resolution_name):
+# (frame shape, radius) をキーにした円形ステンシルのキャッシュ
+_stencil_cache = {}
+
+def get_circle_stencil(shape, radius):
+    """
+    半径 radius の円 (2r+1 x 2r+1) を 0/1 の uint8 配列として返す。
+    cv2.circle で一度だけ描画し、以降はキャッシュを再利用する。
+    チャンネル数に合わせて末尾に軸を追加しておくので、そのまま乗算に使える。
+    """
+    key = (tuple(shape), radius)
+    stencil = _stencil_cache.get(key)
+    if stencil is None:
+        size = 2 * radius + 1
+        disk = np.zeros((size, size), dtype=np.uint8)
+        cv2.circle(disk, (radius, radius), radius, 1, -1)
+        if len(shape) == 3:
+            disk = np.ascontiguousarray(np.repeat(disk[..., np.newaxis], shape[2], axis=2))
+        stencil = disk
+        _stencil_cache[key] = stencil
+    return stencil
+
+def circle_roi(shape, center_x, center_y, radius):
+    """
+    円の外接矩形をフレーム内にクリップした ROI を返す。
+    戻り値は ((y0, y1, x0, x1), (sy0, sy1, sx0, sx1)) で、後者はステンシル側の範囲。
+    円がフレーム外にある場合は None。
+    """
+    h, w = shape[:2]
+    x0, x1 = max(0, center_x - radius), min(w, center_x + radius + 1)
+    y0, y1 = max(0, center_y - radius), min(h, center_y + radius + 1)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    sx0, sy0 = x0 - (center_x - radius), y0 - (center_y - radius)
+    return (y0, y1, x0, x1), (sy0, sy0 + (y1 - y0), sx0, sx0 + (x1 - x0))
+
+def apply_circular_mask_roi(frame, center_x, center_y, radius, out, prev_roi=None):
+    """
+    out に円形マスク済みのフレームを書き込む。円の外接矩形だけを処理する。
+    out は円外が 0 であることを前提とし、前回書き込んだ領域 prev_roi は先に 0 に戻す。
+
+    Returns:
+        tuple or None: 今回書き込んだ領域 (y0, y1, x0, x1)
+    """
+    if prev_roi is not None:
+        y0, y1, x0, x1 = prev_roi
+        out[y0:y1, x0:x1] = 0
+
+    roi = circle_roi(frame.shape, center_x, center_y, radius)
+    if roi is None:
+        return None
+
+    (y0, y1, x0, x1), (sy0, sy1, sx0, sx1) = roi
+    stencil = get_circle_stencil(frame.shape, radius)
+    np.multiply(frame[y0:y1, x0:x1], stencil[sy0:sy1, sx0:sx1], out=out[y0:y1, x0:x1])
+    return (y0, y1, x0, x1)
+
+class MaskBufferPool:
+    """
+    マスク済みフレーム用の出力バッファを使い回すプール。
+    セグメントバッファに保持される枚数以上の size を指定すること。
+    """
+    def __init__(self, size):
+        self.size = size
+        self.buffers = []
+        self.rois = []
+        self.next_index = 0
+
+    def mask(self, frame, center_x, center_y, radius):
+        if self.buffers and (self.buffers[0].shape != frame.shape or self.buffers[0].dtype != frame.dtype):
+            self.buffers, self.rois, self.next_index = [], [], 0
+
+        i = self.next_index
+        if i == len(self.buffers):
+            self.buffers.append(np.zeros(frame.shape, dtype=frame.dtype))
+            self.rois.append(None)
+
+        out = self.buffers[i]
+        self.rois[i] = apply_circular_mask_roi(frame, center_x, center_y, radius, out, self.rois[i])
+        self.next_index = (i + 1) % self.size
+        return out
+
+def apply_circular_mask(frame, center_x, center_y, radius, resolution_name, out=None):
     """
     Applies a circular mask to the frame, making areas outside the circle transparent.
+    Only the bounding box of the circle is touched; pixels outside it stay (0, 0, 0, 0).
+    Pass a zero-initialised BGRA buffer as ``out`` to reuse it between frames.
     """
     h, w = frame.shape[:2]
-    mask = np.zeros((h, w), dtype=np.uint8)
-    cv2.circle(mask, (center_x, center_y), radius, 255, -1)
+    if out is None:
+        out = np.zeros((h, w, 4), dtype=frame.dtype)
 
-    # Convert the frame to BGRA to support transparency
-    frame_with_alpha = cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
-    frame_with_alpha[mask == 0, 3] = 0  # Set transparency outside the circle
+    roi = circle_roi(frame.shape, center_x, center_y, radius)
+    if roi is None:
+        return out
+
+    (y0, y1, x0, x1), (sy0, sy1, sx0, sx1) = roi
+    stencil = get_circle_stencil((h, w), radius)[sy0:sy1, sx0:sx1]
+    out_roi = out[y0:y1, x0:x1]
+    np.multiply(frame[y0:y1, x0:x1], stencil[..., np.newaxis], out=out_roi[..., :3])
+    # Set transparency outside the circle
+    np.multiply(stencil, 255, out=out_roi[..., 3])
 
     #print(f"Circular mask applied to {resolution_name} resolution frame.")
-    return frame_with_alpha
+    return out
 
 def save_frames_to_segments(frames_buffer, fps, resolution_name, output_dir, segment_layer_index):
     """
@@ -60,24 +160,48 @@ def save_frames_to_segments(frames_buffer, fps, resolution_name, output_dir, seg
     video_writer.release()
     print(f"Segment saved: {segment_path}")
 
-def merge_frame(frame_low, frame_med, frame_high, cursor_x, cursor_y):
-    # マスクの初期化
-    med_mask = np.zeros((frame_low.shape[0], frame_low.shape[1]), dtype=np.uint8)
-    high_mask = np.zeros((frame_low.shape[0], frame_low.shape[1]), dtype=np.uint8)
+def gaze_tile_offset(frame_shape, center_x, center_y, tile_size):
+    """
+    視線位置を中心とする tile_size (width, height) のタイルの左上座標を、
+    フレーム内に収まるようにクリップして返す。
+    """
+    h, w = frame_shape[:2]
+    tile_w, tile_h = tile_size
+    x = int(max(0, min(center_x - tile_w // 2, w - tile_w)))
+    y = int(max(0, min(center_y - tile_h // 2, h - tile_h)))
+    return x, y
+
+def layer_metadata_path(segment_path):
+    """
+    セグメントファイルに対応するメタデータ（サイドカー JSON）のパス。
+    """
+    return os.path.splitext(segment_path)[0] + ".json"
 
+def save_layer_metadata(resolution_name, output_dir, segment_layer_index, frame_size, radius, centers,
+                        tile_size=None, offsets=None):
+    """
+    マスク済みレイヤーセグメントのフレームごとの視線中心（レイヤー座標）とマスク半径を保存する。
+    タイルモードの場合はタイルサイズとフレームごとのタイル位置も保存する。
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    segment_path = os.path.join(output_dir, f"{resolution_name}_segment{segment_layer_index:04d}.mp4")
+    metadata = {
+        "layer": resolution_name,
+        "frame_size": list(frame_size),
+        "radius": radius,
+        "centers": [list(center) for center in centers],
+    }
+    if tile_size is not None:
+        metadata["tile_size"] = list(tile_size)
+        metadata["offsets"] = [list(offset) for offset in offsets]
+    with open(layer_metadata_path(segment_path), "w", encoding="utf-8") as f:
+        json.dump(metadata, f)
+
+def merge_frame(frame_low, frame_med, frame_high, cursor_x, cursor_y, feather=0):
     # マスクの半径設定
     med_radius = 200
     high_radius = 100
 
-    # マスクの作成（円形）
-    cv2.circle(med_mask, (cursor_x, cursor_y), med_radius, 255, -1)
-    cv2.circle(high_mask, (cursor_x, cursor_y), high_radius, 255, -1)
-
-    # 条件分岐を使って合成
-    combined_frame = np.where(
-        high_mask[..., np.newaxis] > 0,
-        frame_high,
-        np.where(med_mask[..., np.newaxis] > 0, frame_med, frame_low)
-    )
-
-    return combined_frame
+    # 同じサイズの 3 リングをラベルマップで合成する（結果のバッファは次の呼び出しで再利用される）
+    # feather > 0 なら境界の円環を混ぜる
+    return merge_rings((frame_low, frame_med, frame_high), cursor_x, cursor_y, (med_radius, high_radius), feather)
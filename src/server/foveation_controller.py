@@ -0,0 +1,224 @@
+"""
+帯域に応じたフォビエイテッド設定の制御。
+
+FoveationController はセグメントごとに、HTTP サーバが測った配信スループット
+(src.server.mpeg_server.ThroughputMeter) から目標ビットレートを決め、それに収まる
+マスクするリング（既定では med / high）の半径と CRF の組 (FOVEATION_LEVELS の 1 段) を選ぶ。
+
+段の候補はリングの設定 (src.server.foveation_rings の DEFAULT_RINGS など) から foveation_levels で作る。
+FOVEATION_STEPS の各段は、マスクするすべてのリングの半径に掛ける倍率と CRF に足す値の組で、
+リングの数や既定の半径・CRF を変えても同じ段の並びが使える。
+
+各段のビットレートは、公開したセグメントの実際のサイズから学習した簡単なモデルで見積もる。
+マスクするリングのビットレートはマスクした円の面積 (π r²) に比例し、CRF が 6 下がるごとに 2 倍になるとみなし、
+レイヤーごとの係数を指数移動平均で更新する。背景のリング (low) は設定によらないため、実測値の平均をそのまま使う。
+
+判断と実測は JSON Lines で記録し、replay_decisions で同じ入力を別のパラメータのコントローラに与えて
+オフラインで比較できる。
+"""
+import os
+import json
+import math
+import time
+from src.server.foveation_rings import DEFAULT_RINGS
+
+# 安い順に並べた段（マスクするリングの半径の倍率, CRF に足す値）。背景のリングは常に固定
+FOVEATION_STEPS = [
+    {"radius_scale": 0.5, "crf_offset": 12},
+    {"radius_scale": 0.7, "crf_offset": 8},
+    {"radius_scale": 0.85, "crf_offset": 4},
+    {"radius_scale": 1.0, "crf_offset": 0},  # 既定の設定（リングの設定そのまま）
+    {"radius_scale": 1.25, "crf_offset": 0},
+    {"radius_scale": 1.5, "crf_offset": 0},
+]
+DEFAULT_LEVEL = 3
+# x264 の CRF の範囲
+CRF_RANGE = (0, 51)
+
+
+def foveation_levels(rings=None, steps=FOVEATION_STEPS):
+    """
+    リングの設定から、安い順に並べた段の候補を作る。
+
+    Args:
+        rings (list): 外側から順に並べたリングの設定（None なら DEFAULT_RINGS）。
+        steps (list): 段ごとの radius_scale と crf_offset。
+
+    Returns:
+        list: 段ごとの {レイヤー名: {"radius", "crf"}}（半径は各レイヤーの座標系、マスクするリングだけ）
+    """
+    rings = rings or DEFAULT_RINGS
+    levels = []
+    for step in steps:
+        levels.append({
+            ring["name"]: {
+                "radius": max(1, int(round(ring["radius"] * step["radius_scale"]))),
+                "crf": min(CRF_RANGE[1], max(CRF_RANGE[0], ring["crf"] + step["crf_offset"])),
+            }
+            for ring in rings if ring["radius"] is not None
+        })
+    return levels
+
+
+FOVEATION_LEVELS = foveation_levels(DEFAULT_RINGS)
+
+
+def decision_log_path(session_dir):
+    """セッションの判断ログのパス"""
+    return os.path.join(session_dir, "logs", "foveation_decisions.jsonl")
+
+
+def layer_cost(config):
+    """レイヤー設定の相対的なコスト（マスク面積 × CRF による倍率）"""
+    return math.pi * config["radius"] ** 2 * 2 ** (-config["crf"] / 6)
+
+
+class FoveationController:
+    """
+    Args:
+        target_bitrate (float): 目標ビットレート (bps)。スループットが未測定のとき、または測定値が大きいときの上限。
+        throughput (callable): 直近の配信スループット (bps) を返す関数。未測定なら None を返す。
+        levels (list): 安い順に並べた設定の候補。None なら rings から foveation_levels で作る。
+        initial_level (int): モデルを学習するまで使う段。
+        safety (float): 測定したスループットのうち目標に使う割合。
+        up_margin (float): 1 段上げるのは、見積もりが目標の up_margin 倍以下のときだけ（振動を防ぐ）。
+        smoothing (float): モデル係数の指数移動平均の重み（新しい実測値の重み）。
+        log_path (str): 判断と実測を追記する JSON Lines ファイル。None なら記録しない。
+        rings (list): 段の候補を作るリングの設定（None なら DEFAULT_RINGS）。
+    """
+    def __init__(self, target_bitrate, throughput=None, levels=None, initial_level=DEFAULT_LEVEL,
+                 safety=0.8, up_margin=0.9, smoothing=0.3, log_path=None, rings=None):
+        self.target_bitrate = target_bitrate
+        self.throughput = throughput
+        self.levels = levels or foveation_levels(rings)
+        self.level = min(initial_level, len(self.levels) - 1)
+        self.safety = safety
+        self.up_margin = up_margin
+        self.smoothing = smoothing
+        self.log_path = log_path
+        if log_path:
+            os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+
+        self.fixed_bps = None  # 段によらないレイヤー（背景のリング）の合計
+        self.coefficients = {}  # レイヤー -> bps / layer_cost
+        self.decisions = {}  # セグメント番号 -> 選んだ段
+
+    def config(self, level=None):
+        """段の設定（コピー）"""
+        level = self.level if level is None else level
+        return {layer: dict(config) for layer, config in self.levels[level].items()}
+
+    def estimate(self, level):
+        """段のビットレートの見積もり (bps)。まだ学習していなければ None。"""
+        if self.fixed_bps is None or len(self.coefficients) < len(self.levels[level]):
+            return None
+        return self.fixed_bps + sum(
+            self.coefficients[layer] * layer_cost(config) for layer, config in self.levels[level].items()
+        )
+
+    def target(self, throughput_bps):
+        """スループットから目標ビットレートを決める"""
+        if throughput_bps is None:
+            return self.target_bitrate
+        return min(self.target_bitrate, self.safety * throughput_bps)
+
+    def choose_level(self, target_bps):
+        """
+        目標に収まる最も高い段を選ぶ。下げるときは一度に、上げるときは 1 段ずつ。
+        """
+        if self.estimate(0) is None:
+            return self.level
+        fitting = 0
+        for level in range(len(self.levels)):
+            if self.estimate(level) <= target_bps:
+                fitting = level
+        if fitting < self.level:
+            return fitting
+        if fitting > self.level and self.estimate(self.level + 1) <= target_bps * self.up_margin:
+            return self.level + 1
+        return self.level
+
+    def decide(self, index, throughput_bps=None):
+        """
+        セグメント index の設定を決める。
+
+        Args:
+            throughput_bps (float): 測定したスループット。None なら throughput 関数から取得する。
+
+        Returns:
+            dict: マスクするリングごとの {"radius", "crf"}
+        """
+        if throughput_bps is None and self.throughput is not None:
+            throughput_bps = self.throughput()
+        target_bps = self.target(throughput_bps)
+        self.level = self.choose_level(target_bps)
+        self.decisions[index] = self.level
+        estimate = self.estimate(self.level)
+        self.write_log({
+            "event": "decision", "segment": index, "time": time.time(),
+            "throughput_bps": throughput_bps, "target_bps": target_bps,
+            "level": self.level, "estimated_bps": estimate, "config": self.levels[self.level],
+        })
+        return self.config()
+
+    def observe(self, index, layer_bytes, duration):
+        """
+        公開したセグメントのレイヤーごとのサイズからモデルを更新する。
+
+        Args:
+            layer_bytes (dict): レイヤー -> バイト数。
+            duration (float): セグメントの長さ（秒）。
+        """
+        level = self.decisions.pop(index, None)
+        if level is None or duration <= 0:
+            return
+        layer_bps = {layer: size * 8 / duration for layer, size in layer_bytes.items()}
+        fixed_layers = [layer for layer in layer_bps if layer not in self.levels[level]]
+        if fixed_layers:
+            self.fixed_bps = self.update_average(self.fixed_bps, sum(layer_bps[layer] for layer in fixed_layers))
+        for layer, config in self.levels[level].items():
+            if layer in layer_bps:
+                self.coefficients[layer] = self.update_average(
+                    self.coefficients.get(layer), layer_bps[layer] / layer_cost(config)
+                )
+        self.write_log({
+            "event": "observation", "segment": index, "time": time.time(), "level": level,
+            "duration": duration, "layer_bytes": layer_bytes, "total_bps": sum(layer_bps.values()),
+        })
+
+    def update_average(self, current, value):
+        if current is None:
+            return value
+        return (1 - self.smoothing) * current + self.smoothing * value
+
+    def write_log(self, record):
+        if self.log_path:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def replay_decisions(log_path, target_bitrate, **controller_kwargs):
+    """
+    判断ログに記録したスループットと実測サイズを、新しいコントローラに同じ順で与える。
+    実測サイズは記録時の設定のものなので、段を変えた場合の影響は見積もりモデルで評価することになる。
+
+    Returns:
+        list: (セグメント番号, 記録時の段, 再生したコントローラの段, 再生時の目標ビットレート)
+    """
+    controller = FoveationController(target_bitrate, log_path=None, **controller_kwargs)
+    results = []
+    with open(log_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record["event"] == "decision":
+                controller.decide(record["segment"], record["throughput_bps"])
+                results.append((
+                    record["segment"], record["level"], controller.level, controller.target(record["throughput_bps"])
+                ))
+            elif record["event"] == "observation":
+                # 実測サイズは記録時の段のものとして学習させる
+                controller.decisions[record["segment"]] = record["level"]
+                controller.observe(record["segment"], record["layer_bytes"], record["duration"])
+    return results
@@ -0,0 +1,306 @@
+"""
+離心率ごとの N 個のリング（レイヤー）の設定と、ラベルマップによる合成。
+
+リングは外側から順に並べる。先頭のリングは背景で画面全体を覆い（radius は None）、
+以降のリングは視線を中心とする円で、内側ほど解像度が高く半径が小さい。各リングは次を持つ。
+
+- name: レイヤー名（セグメントのファイル名や MPD の Representation の id になる）
+- size: エンコードする解像度 (width, height)。最後のリングの解像度が視線座標の基準になる。
+- radius: そのリングの座標系でのマスク半径（背景は None）
+- crf: レイヤーエンコーダの CRF
+- bandwidth: MPD に記述するビットレート (bps)
+
+合成はリングごとに np.where を重ねる代わりに、フレームごとのラベルマップ（各画素がどのリングから
+来るか）を作り、すべてのリングを 1 つの配列に積んで 1 回のギャザーで取り出す。ラベルマップは
+半径の組ごとにキャッシュした円形のパッチを視線位置に貼るだけなので、リングを増やしても
+フレームごとのコストはほとんど変わらない。
+
+feather（ピクセル）を指定すると、リングの境界を半径 r - feather から r までの円環でなめらかに混ぜる。
+重みは 2 乗距離を添字とする固定小数点の LUT（0〜256 の uint16、radial_weight_lut）から作り、
+円環の画素だけを整数演算 (前景 * w + 背景 * (256 - w) + 128) >> 8 で混ぜる。円環の外は
+ギャザーでそのままコピーするため、浮動小数点のフレーム全体の αブレンドよりは安いが、境界を混ぜないギャザーに比べて
+円環の画素数に比例するコストが加わり、リングを増やすほどスループットは下がる。
+"""
+import time
+import cv2
+import numpy as np
+from src.server.segment_encoder import LAYER_CRF
+
+DEFAULT_RINGS = [
+    {"name": "low", "size": (480, 270), "radius": None, "crf": LAYER_CRF["low"], "bandwidth": 500000},
+    {"name": "med", "size": (640, 360), "radius": 100, "crf": LAYER_CRF["med"], "bandwidth": 1500000},
+    {"name": "high", "size": (1920, 1080), "radius": 100, "crf": LAYER_CRF["high"], "bandwidth": 3000000},
+]
+
+# 半径の組をキーにしたラベルパッチのキャッシュ
+_label_patch_cache = {}
+# (半径の組, feather) をキーにした円環の画素と重みのキャッシュ
+_blend_annuli_cache = {}
+
+# 固定小数点の重みの 1.0（8 ビットシフトで割る）
+WEIGHT_ONE = 256
+
+
+def ring_names(rings):
+    return tuple(ring["name"] for ring in rings)
+
+
+def ring_layer_config(rings):
+    """SegmentPipeline の layer_config（レイヤー名 -> {"radius", "crf"}）を作る"""
+    config = {}
+    for ring in rings:
+        config[ring["name"]] = {"crf": ring["crf"]}
+        if ring["radius"] is not None:
+            config[ring["name"]]["radius"] = ring["radius"]
+    return config
+
+
+def patch_distance_sq(reach):
+    """(2 * reach + 1) 四方のパッチの、中心からの 2 乗距離"""
+    offsets = np.arange(-reach, reach + 1)
+    return offsets[:, np.newaxis] ** 2 + offsets[np.newaxis, :] ** 2
+
+
+def radial_weight_lut(radius, feather):
+    """
+    2 乗距離 d² (0〜radius²) を添字とする、リングの重みの LUT（0〜WEIGHT_ONE の uint16）。
+    半径 radius - feather までは WEIGHT_ONE、そこから radius に向かって直線的に 0 まで下がる。
+    """
+    distance = np.sqrt(np.arange(radius * radius + 1, dtype=np.float64))
+    weight = np.clip((radius - distance) / max(feather, 1), 0.0, 1.0)
+    return np.rint(weight * WEIGHT_ONE).astype(np.uint16)
+
+
+def get_label_patch(radii, feather=0):
+    """
+    視線を中心とする (2R+1) x (2R+1) のラベルパッチを返す（R は最大の半径）。
+    各画素の値は、その画素を重み 1 で含む最も内側のリングの番号（どのリングにも含まれなければ 0）。
+    feather を指定した場合、リングが重み 1 で覆うのは radial_weight_lut が WEIGHT_ONE になる範囲（半径 r - feather 付近まで）。
+
+    Args:
+        radii (tuple): リング 1 以降の半径（出力の座標系）。
+        feather (int): 境界を混ぜる円環の幅（ピクセル）。
+    """
+    radii = tuple(int(r) for r in radii)
+    key = (radii, int(feather))
+    patch = _label_patch_cache.get(key)
+    if patch is None:
+        distance_sq = patch_distance_sq(max(radii))
+        patch = np.zeros(distance_sq.shape, dtype=np.uint8)
+        # 外側のリングから順に上書きし、内側のリングを優先する（リングごとの np.where を重ねた結果と同じ）
+        for label in range(len(radii)):
+            radius = radii[label]
+            if feather:
+                covered = radial_weight_lut(radius, feather)[np.minimum(distance_sq, radius * radius)] == WEIGHT_ONE
+            else:
+                covered = distance_sq <= radius * radius
+            patch[covered] = label + 1
+        _label_patch_cache[key] = patch
+    return patch
+
+
+def get_blend_annuli(radii, feather):
+    """
+    リングごとに、境界の円環で混ぜる画素（中心からの位置）と固定小数点の重みを返す。
+
+    内側のリングが重み 1 で覆う画素はそのリングの値になるため除く。残りの画素は、リングの順
+    （外側から内側）に「そのリング * w + それまでの合成結果 * (1 - w)」で混ぜれば、
+    リングを外側から順に αブレンドで重ねた結果と一致する。
+
+    Returns:
+        list: (リング番号, dy (int), dx (int), 重み (n, 1) の uint16) のリスト
+    """
+    radii = tuple(int(r) for r in radii)
+    key = (radii, int(feather))
+    annuli = _blend_annuli_cache.get(key)
+    if annuli is None:
+        reach = max(radii)
+        distance_sq = patch_distance_sq(reach)
+        labels = get_label_patch(radii, feather)
+        annuli = []
+        for i, radius in enumerate(radii):
+            lut = radial_weight_lut(radius, feather)
+            weights = lut[np.minimum(distance_sq, radius * radius)]
+            selected = (weights > 0) & (weights < WEIGHT_ONE) & (labels <= i)
+            dy, dx = np.nonzero(selected)
+            annuli.append((
+                i + 1, (dy - reach).astype(np.intp), (dx - reach).astype(np.intp),
+                weights[dy, dx][:, np.newaxis],
+            ))
+        _blend_annuli_cache[key] = annuli
+    return annuli
+
+
+class RingCompositor:
+    """
+    出力サイズに揃えた N 個のリングのフレームを、ラベルマップに従って 1 回のギャザーで合成する。
+
+    リングのフレームは layer(i) が返す積み重ねた配列のビューに直接書き込む（コピーしない）。
+    ギャザーの添字 (ラベル * 画素数 + 画素番号) は前回のパッチの範囲だけを戻して更新する。
+    feather を指定すると、ギャザーの後でリングの境界の円環だけを固定小数点で混ぜる。
+
+    Args:
+        size (tuple): 出力の (width, height)。
+        ring_count (int): リングの数（背景を含む）。
+        feather (int): 境界を混ぜる円環の幅（出力のピクセル）。0 なら境界は混ぜない。
+    """
+    def __init__(self, size, ring_count, feather=0):
+        self.width, self.height = size
+        self.ring_count = ring_count
+        pixels = self.width * self.height
+        self.pixels = pixels
+        self.stack = np.zeros((ring_count, self.height, self.width, 3), dtype=np.uint8)
+        self.pixel_index = np.arange(pixels, dtype=np.intp).reshape(self.height, self.width)
+        self.gather_index = self.pixel_index.copy()
+        self.labels = np.zeros((self.height, self.width), dtype=np.uint8)
+        self.output = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self.prev_roi = None
+        self.feather = feather
+        self.blend = []  # (リング番号, 出力上の画素番号, 重み)
+
+    def layer(self, i):
+        """リング i のフレームを書き込むバッファ (height, width, 3)"""
+        return self.stack[i]
+
+    def set_layers(self, frames):
+        """出力サイズのリングのフレームを積み重ねたバッファにコピーする"""
+        for i, frame in enumerate(frames):
+            if frame is not self.stack[i]:
+                np.copyto(self.stack[i], frame)
+
+    def set_center(self, center_x, center_y, radii):
+        """
+        視線位置と各リングの半径（出力の座標系）からラベルマップを更新する。
+        """
+        if self.prev_roi is not None:
+            y0, y1, x0, x1 = self.prev_roi
+            self.labels[y0:y1, x0:x1] = 0
+            self.gather_index[y0:y1, x0:x1] = self.pixel_index[y0:y1, x0:x1]
+            self.prev_roi = None
+
+        patch = get_label_patch(radii, self.feather)
+        reach = patch.shape[0] // 2
+        self.blend = self.blend_pixels(center_x, center_y, radii) if self.feather else []
+        x0, x1 = max(0, center_x - reach), min(self.width, center_x + reach + 1)
+        y0, y1 = max(0, center_y - reach), min(self.height, center_y + reach + 1)
+        if x0 >= x1 or y0 >= y1:
+            return
+        sx0, sy0 = x0 - (center_x - reach), y0 - (center_y - reach)
+        labels = patch[sy0:sy0 + (y1 - y0), sx0:sx0 + (x1 - x0)]
+        self.labels[y0:y1, x0:x1] = labels
+        np.add(self.pixel_index[y0:y1, x0:x1], labels * np.intp(self.pixels), out=self.gather_index[y0:y1, x0:x1])
+        self.prev_roi = (y0, y1, x0, x1)
+
+    def blend_pixels(self, center_x, center_y, radii):
+        """視線位置での各リングの円環の画素番号（出力の範囲外を除く）と重み"""
+        blend = []
+        for label, dy, dx, weights in get_blend_annuli(radii, self.feather):
+            ys, xs = dy + center_y, dx + center_x
+            inside = (ys >= 0) & (ys < self.height) & (xs >= 0) & (xs < self.width)
+            if not inside.all():
+                ys, xs, weights = ys[inside], xs[inside], weights[inside]
+            if len(ys):
+                blend.append((label, ys * self.width + xs, weights))
+        return blend
+
+    def composite(self):
+        """
+        ラベルマップに従って積み重ねたリングから画素を取り出し、feather があれば境界の円環を混ぜる。
+
+        Returns:
+            np.ndarray: 合成結果（self.output。次の呼び出しで上書きされる）
+        """
+        output = self.output.reshape(-1, 3)
+        np.take(self.stack.reshape(-1, 3), self.gather_index.reshape(-1), axis=0, out=output)
+        for label, pixels, weights in self.blend:
+            foreground = self.stack[label].reshape(-1, 3)[pixels].astype(np.uint16)
+            background = output[pixels].astype(np.uint16)
+            # (前景 * w + 背景 * (256 - w) + 128) >> 8。各項は 255 * 256 以下なので uint16 に収まる
+            foreground *= weights
+            background *= WEIGHT_ONE - weights
+            foreground += background
+            foreground += WEIGHT_ONE // 2
+            foreground >>= 8
+            output[pixels] = foreground
+        return self.output
+
+
+# 出力サイズとリング数をキーにした合成器のキャッシュ（merge_rings 用）
+_compositor_cache = {}
+
+
+def merge_rings(frames, center_x, center_y, radii, feather=0):
+    """
+    出力サイズに揃えたリングのフレーム（外側から順）を、視線を中心とする同心円で合成する。
+
+    Args:
+        frames (list): リングごとのフレーム。先頭が背景。
+        center_x, center_y (int): 視線位置（出力の座標系）。
+        radii (tuple): リング 1 以降の半径（出力の座標系）。
+        feather (int): 境界を混ぜる円環の幅（ピクセル）。0 なら境界は混ぜない。
+
+    Returns:
+        np.ndarray: 合成結果（呼び出しごとに上書きされるバッファ）
+    """
+    height, width = frames[0].shape[:2]
+    key = (width, height, len(frames), int(feather))
+    compositor = _compositor_cache.get(key)
+    if compositor is None:
+        compositor = RingCompositor((width, height), len(frames), feather=int(feather))
+        _compositor_cache[key] = compositor
+    compositor.set_layers(frames)
+    compositor.set_center(int(center_x), int(center_y), radii)
+    return compositor.composite()
+
+
+def merge_frames_where(frames, center_x, center_y, radii):
+    """従来の合成（リングごとに cv2.circle のマスクを作り np.where を重ねる）。ベンチマークの比較用。"""
+    height, width = frames[0].shape[:2]
+    combined = frames[0]
+    for frame, radius in zip(frames[1:], radii):
+        mask = np.zeros((height, width), dtype=np.uint8)
+        cv2.circle(mask, (center_x, center_y), radius, 255, -1)
+        combined = np.where(mask[..., np.newaxis] > 0, frame, combined)
+    return combined
+
+
+def benchmark_ring_blend(frames=100, size=(1920, 1080), radii=(200, 100), feather=16, seed=0):
+    """
+    出力サイズの合成フレームで、np.where の合成、ラベルマップの合成、境界を混ぜる合成の速度を比較する。
+    視線はフレームごとに中央付近をランダムに動かす。
+
+    Returns:
+        dict: それぞれの frames per second と、np.where に対する境界を混ぜる合成の時間の比
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size
+    layers = [rng.integers(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(len(radii) + 1)]
+    centers = [
+        (int(width / 2 + rng.integers(-300, 300)), int(height / 2 + rng.integers(-200, 200)))
+        for _ in range(frames)
+    ]
+
+    start = time.perf_counter()
+    for cx, cy in centers:
+        merge_frames_where(layers, cx, cy, radii)
+    where_seconds = time.perf_counter() - start
+
+    seconds = {}
+    for name, width_px in (("hard", 0), ("blend", feather)):
+        compositor = RingCompositor(size, len(layers), feather=width_px)
+        compositor.set_layers(layers)
+        start = time.perf_counter()
+        for cx, cy in centers:
+            compositor.set_center(cx, cy, radii)
+            compositor.composite()
+        seconds[name] = time.perf_counter() - start
+
+    result = {
+        "frames": frames,
+        "where_fps": frames / where_seconds,
+        "gather_fps": frames / seconds["hard"],
+        "blend_fps": frames / seconds["blend"],
+        "blend_vs_where": seconds["blend"] / where_seconds,
+    }
+    print(f"Ring blend benchmark: {result}")
+    return result
@@ -0,0 +1,244 @@
+"""
+共有デコードのフレームバス。
+
+同じコンテンツを複数の視聴者が見る場合、各レイヤーのデコードは 1 回だけ行い、
+同じフレームを視聴者ごとのフォビエイテッド処理（マスクとエンコード）に配る。
+フレームは読み取り専用として共有し、マスク結果は視聴者ごとの SegmentPipeline のバッファに書く。
+
+measure_viewer_cost は視聴者数を変えて同じ入力を処理し、視聴者を 1 人増やすごとの
+1 フレームあたりの追加コストを最小二乗の傾きとして求める。
+CPU 時間は、このプロセス（デコード結果の配布・マスク・パイプへの書き込み）と、
+子プロセス（ffmpeg のエンコーダ・デコーダ）を分けて報告する。子プロセスの分は終了して回収された
+プロセスしか getrusage(RUSAGE_CHILDREN) に含まれないため、エンコーダとソースを閉じた後で測る。
+"""
+import time
+import threading
+try:
+    import resource
+except ImportError:  # Windows には resource モジュールがない
+    resource = None
+from src.server.pipeline import StageQueue, STOP
+from src.server.server_function import SegmentPipeline
+from src.server.gaze_source import RandomWalkGaze
+
+
+class FrameBus:
+    """
+    フレームソースを 1 回だけデコードし、購読者ごとのキューに同じフレームを配る。
+
+    Args:
+        source: read() が (ret, リングごとのフレームのタプル) を返すフレームソース。
+        queue_size (int): 購読者ごとのキュー長。
+        drop_when_full (bool): 遅い購読者のキューが満杯のとき、その購読者の分だけフレームを捨てる。
+            False なら最も遅い購読者に合わせて待つ。
+        max_frames (int): 配るフレーム数の上限（None なら入力の終わりまで）。
+    """
+    def __init__(self, source, queue_size=8, drop_when_full=False, max_frames=None):
+        self.source = source
+        self.queue_size = queue_size
+        self.drop_when_full = drop_when_full
+        self.max_frames = max_frames
+        self.subscribers = {}
+        self.frames_decoded = 0
+        self.decode_seconds = 0.0
+        self.running = False
+        self.thread = None
+
+    def subscribe(self, name):
+        """
+        購読者を追加し、その購読者用のキューを返す。start() の前に呼ぶこと。
+        """
+        subscriber_queue = StageQueue(name, self.queue_size, drop_when_full=self.drop_when_full)
+        self.subscribers[name] = subscriber_queue
+        return subscriber_queue
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="frame-bus", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            if self.max_frames is not None and self.frames_decoded >= self.max_frames:
+                break
+            start = time.perf_counter()
+            ret, frames = self.source.read()
+            self.decode_seconds += time.perf_counter() - start
+            if not ret:
+                print("Frame bus reached the end of the source.")
+                break
+            item = (self.frames_decoded, frames)
+            self.frames_decoded += 1
+            for subscriber_queue in self.subscribers.values():
+                subscriber_queue.put(item)
+
+        for subscriber_queue in self.subscribers.values():
+            subscriber_queue.put(STOP)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def stats(self):
+        return {
+            "frames_decoded": self.frames_decoded,
+            "decode_seconds": round(self.decode_seconds, 3),
+            "subscribers": {name: q.stats() for name, q in self.subscribers.items()},
+        }
+
+
+class ViewerSession(threading.Thread):
+    """
+    フレームバスから受け取ったフレームに、視聴者自身の視線でマスクとエンコードを行うスレッド。
+    出力は segments/<viewer_id>/ 以下に書き出される。
+    """
+    def __init__(self, bus, viewer_id, width, height, fps=30, seed=None, max_speed=15, gaze_source=None,
+                 **pipeline_kwargs):
+        super().__init__(name=f"viewer-{viewer_id}", daemon=True)
+        self.viewer_id = viewer_id
+        self.width = width
+        self.height = height
+        # 視線入力（省略時は seed で再現できるランダムウォーク）
+        self.gaze_source = gaze_source or RandomWalkGaze(width, height, max_speed=max_speed, seed=seed)
+        self.queue = bus.subscribe(viewer_id)
+        pipeline_kwargs.setdefault("pool_size", fps * pipeline_kwargs.get("segment_duration", 2) + 2)
+        self.segment_pipeline = SegmentPipeline(session_id=viewer_id, fps=fps, **pipeline_kwargs)
+        self.frames_processed = 0
+        self.busy_seconds = 0.0
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is STOP:
+                break
+            _, frames = item
+            start = time.perf_counter()
+            gaze_x, gaze_y = self.gaze_source.next_position()
+            completed_index = self.segment_pipeline.frame_segmented_with_mask(frames, gaze_x, gaze_y)
+            if completed_index is not None:
+                # 確定を待たずに保留し、次のフレーム以降で閉じられたものから公開する
+                self.segment_pipeline.publish(completed_index)
+            elif self.segment_pipeline.pending_publish:
+                self.segment_pipeline.publish_finalized()
+            self.busy_seconds += time.perf_counter() - start
+            self.frames_processed += 1
+        final_segment = self.segment_pipeline.flush()
+        if final_segment is not None:
+            self.segment_pipeline.publish(*final_segment)
+        self.segment_pipeline.publish_finalized(timeout=self.segment_pipeline.segment_duration)
+
+
+def child_cpu_seconds():
+    """
+    終了して回収済みの子プロセスの user + sys の CPU 時間 [s]。resource がない環境では None。
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_shared_viewers(source, viewer_ids, queue_size=8, drop_when_full=False, max_frames=None, **viewer_kwargs):
+    """
+    1 つのソースを共有して複数の視聴者のセグメントを生成し、終了まで待つ。
+
+    Returns:
+        dict: 所要時間・このプロセスの CPU 時間 (cpu_seconds)・エンコーダの子プロセスの CPU 時間
+              (child_cpu_seconds、計測できなければ None)・デコード統計・視聴者ごとの処理時間
+    """
+    bus = FrameBus(source, queue_size=queue_size, drop_when_full=drop_when_full, max_frames=max_frames)
+    viewers = [
+        ViewerSession(bus, viewer_id, source.width, source.height, fps=int(round(source.fps)), seed=i, **viewer_kwargs)
+        for i, viewer_id in enumerate(viewer_ids)
+    ]
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    child_start = child_cpu_seconds()
+    for viewer in viewers:
+        viewer.start()
+    bus.start()
+    bus.thread.join()
+    # 視聴者はパイプラインを flush してエンコーダを閉じて（wait して）から終わる
+    for viewer in viewers:
+        viewer.join()
+    cpu_seconds = time.process_time() - cpu_start
+    child_end = child_cpu_seconds()
+
+    return {
+        "viewers": len(viewers),
+        "frames": bus.frames_decoded,
+        "wall_seconds": time.perf_counter() - wall_start,
+        "cpu_seconds": cpu_seconds,
+        "child_cpu_seconds": None if child_start is None else child_end - child_start,
+        "bus": bus.stats(),
+        "viewer_seconds": {viewer.viewer_id: round(viewer.busy_seconds, 3) for viewer in viewers},
+    }
+
+
+def measure_viewer_cost(make_source, viewer_counts=(1, 2, 4), max_frames=300, **viewer_kwargs):
+    """
+    視聴者数を変えて同じ入力を処理し、視聴者 1 人追加あたりのコストを求める。
+
+    Args:
+        make_source (callable): 呼ぶたびに新しいフレームソースを返す関数。
+        viewer_counts (iterable): 計測する視聴者数。
+        max_frames (int): 1 回の計測で処理するフレーム数。
+
+    Returns:
+        dict: 視聴者数ごとの 1 フレームあたりの wall / CPU 時間 [ms] と、
+              その傾き（視聴者 1 人追加あたりのコスト [ms/frame]）。
+              child_cpu は ffmpeg の子プロセス（エンコーダと、パイプ入力ならデコーダ）の CPU 時間で、
+              計測できない環境では None。
+    """
+    results = []
+    for count in viewer_counts:
+        source = make_source()
+        child_start = child_cpu_seconds()
+        try:
+            result = run_shared_viewers(
+                source, [f"bench_viewer{i:02d}" for i in range(count)], max_frames=max_frames, **viewer_kwargs
+            )
+        finally:
+            source.release()
+        # デコーダの子プロセスは release で回収されるため、その後で測る
+        child_seconds = None if child_start is None else child_cpu_seconds() - child_start
+        frames = max(result["frames"], 1)
+        results.append({
+            "viewers": count,
+            "wall_ms_per_frame": result["wall_seconds"] * 1000 / frames,
+            "cpu_ms_per_frame": result["cpu_seconds"] * 1000 / frames,
+            "child_cpu_ms_per_frame": None if child_seconds is None else child_seconds * 1000 / frames,
+            "decode_ms_per_frame": result["bus"]["decode_seconds"] * 1000 / frames,
+        })
+        child_cpu = results[-1]["child_cpu_ms_per_frame"]
+        print(
+            f"viewers={count}: wall {results[-1]['wall_ms_per_frame']:.2f} ms/frame, "
+            f"cpu {results[-1]['cpu_ms_per_frame']:.2f} ms/frame, "
+            f"child cpu {'n/a' if child_cpu is None else f'{child_cpu:.2f}'} ms/frame"
+        )
+
+    def slope(key):
+        xs = [r["viewers"] for r in results]
+        ys = [r[key] for r in results]
+        if len(xs) < 2 or None in ys:
+            return None
+        mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+        denominator = sum((x - mean_x) ** 2 for x in xs)
+        if denominator == 0:
+            return None
+        return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / denominator
+
+    summary = {
+        "runs": results,
+        "wall_ms_per_added_viewer": slope("wall_ms_per_frame"),
+        "cpu_ms_per_added_viewer": slope("cpu_ms_per_frame"),
+        "child_cpu_ms_per_added_viewer": slope("child_cpu_ms_per_frame"),
+    }
+    print(
+        f"Cost per added viewer: wall {summary['wall_ms_per_added_viewer']} ms/frame, "
+        f"cpu {summary['cpu_ms_per_added_viewer']} ms/frame, "
+        f"child cpu {summary['child_cpu_ms_per_added_viewer']} ms/frame"
+    )
+    return summary
@@ -0,0 +1,69 @@
+"""
+実時間のフレームクロック。
+
+フレームごとの出力時刻 (start + n / fps) を決め、その時刻まで待つ。処理が遅れて
+max_lag_frames を超えた場合は、遅れているフレーム数を返すので、呼び出し側はその分を
+意図的にドロップして壁時計に追いつく。
+"""
+import time
+
+
+class FrameClock:
+    """
+    Args:
+        fps (float): 出力フレームレート（ソースの実フレームレート）。
+        max_lag_frames (int): これを超えて遅れたらドロップで追いつく。
+    """
+    def __init__(self, fps, max_lag_frames=5):
+        self.fps = fps
+        self.interval = 1.0 / fps
+        self.max_lag_frames = max_lag_frames
+        self.start_time = None
+        self.frame_number = 0
+        self.dropped = 0
+        self.max_lag_seconds = 0.0
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.frame_number = 0
+
+    def slot_time(self, frame_number):
+        """フレーム frame_number の予定出力時刻（perf_counter 基準）"""
+        return self.start_time + frame_number * self.interval
+
+    def wait(self):
+        """
+        次のフレームの予定時刻まで待つ。
+
+        Returns:
+            int: 追いつくためにドロップすべきフレーム数（遅れが max_lag_frames 以下なら 0）
+        """
+        if self.start_time is None:
+            self.start()
+        target = self.slot_time(self.frame_number)
+        now = time.perf_counter()
+        if now < target:
+            time.sleep(target - now)
+            return 0
+
+        lag = now - target
+        self.max_lag_seconds = max(self.max_lag_seconds, lag)
+        behind = int(lag / self.interval)
+        return behind if behind > self.max_lag_frames else 0
+
+    def tick(self, dropped=False):
+        """1 フレーム分の出力（またはドロップ）が終わったことを記録する"""
+        self.frame_number += 1
+        if dropped:
+            self.dropped += 1
+
+    def lag_seconds(self):
+        """現在のフレームが予定時刻からどれだけ遅れているか（秒、負なら先行）"""
+        return time.perf_counter() - self.slot_time(self.frame_number)
+
+    def segment_lag(self, segment_index, segment_duration):
+        """
+        セグメント segment_index が完成した時点での、壁時計上の終了予定時刻からの遅れ（秒）。
+        ライブエッジからどれだけ遅れて公開されたかを表す。
+        """
+        return time.perf_counter() - (self.start_time + (segment_index + 1) * segment_duration)
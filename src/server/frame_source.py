@@ -0,0 +1,150 @@
+"""
+フレームソース。
+
+PipedFrameSource は入力動画を ffmpeg の rawvideo パイプで 1 回だけデコードし、
+リング（既定では low / med / high の 3 レイヤー）ごとのフレームをメモリ上で NumPy 配列として生成する。
+中間のレンディションファイル（h264_outputs/*.mp4）を待つ必要がないため、
+最初の GOP がデコードされた時点でストリーミングを開始できる。
+
+RenditionFileSource は従来通り h264_compression の出力ファイルを読む。
+"""
+import json
+import subprocess
+import cv2
+import numpy as np
+from src.server.foveation_rings import DEFAULT_RINGS
+
+# レイヤーごとの出力解像度 (width, height)
+LAYER_SIZES = {ring["name"]: ring["size"] for ring in DEFAULT_RINGS}
+
+
+def probe_video(input_video):
+    """
+    ffprobe で入力動画の幅・高さ・フレームレートを取得する。
+    """
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0",
+         "-show_entries", "stream=width,height,r_frame_rate", "-of", "json", input_video],
+        capture_output=True, text=True, check=True
+    )
+    stream = json.loads(result.stdout)["streams"][0]
+    num, den = stream["r_frame_rate"].split("/")
+    fps = float(num) / float(den) if float(den) else 30.0
+    return int(stream["width"]), int(stream["height"]), fps
+
+
+class PipedFrameSource:
+    """
+    ffmpeg の rawvideo (bgr24) パイプからフレームを読み、リングごとのフレームを生成する。
+
+    Args:
+        input_video (str): 入力動画のパス。
+        rings (list): 外側から順に並べたリングの設定（None なら DEFAULT_RINGS）。
+    """
+    def __init__(self, input_video, rings=None):
+        self.input_video = input_video
+        self.layer_sizes = [tuple(ring["size"]) for ring in (rings or DEFAULT_RINGS)]
+        self.source_width, self.source_height, self.fps = probe_video(input_video)
+
+        # デコードは最も内側のリングの解像度で 1 回だけ行い、外側のリングは縮小で作る
+        self.width, self.height = self.layer_sizes[-1]
+        self.frame_bytes = self.width * self.height * 3
+
+        self.process = None
+        self.open()
+
+    def open(self):
+        command = [
+            "ffmpeg", "-nostdin", "-loglevel", "error",
+            "-i", self.input_video,
+            "-vf", f"scale={self.width}:{self.height}",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "pipe:1"
+        ]
+        self.process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=self.frame_bytes
+        )
+
+    def isOpened(self):
+        return self.process is not None and self.process.poll() in (None, 0)
+
+    def read(self):
+        """
+        次のフレームを読み込む。
+
+        Returns:
+            tuple: (ret, リングごとのフレームのタプル（外側から順。既定では (frame_low, frame_med, frame_high)）)
+        """
+        if self.process is None:
+            return False, None
+
+        # フレームはセグメントバッファに保持されるため、毎回新しい配列に読み込む
+        frame_inner = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        if self.process.stdout.readinto(memoryview(frame_inner).cast("B")) < self.frame_bytes:
+            return False, None
+
+        frames = [cv2.resize(frame_inner, size, interpolation=cv2.INTER_AREA) for size in self.layer_sizes[:-1]]
+        frames.append(frame_inner)
+        return True, tuple(frames)
+
+    def skip(self):
+        """
+        次のフレームを縮小せずに読み捨てる。ドロップ時に使う。
+        """
+        if self.process is None:
+            return False
+        return len(self.process.stdout.read(self.frame_bytes)) == self.frame_bytes
+
+    def restart(self):
+        """
+        先頭から読み直す（ループ再生用）。
+        """
+        self.release()
+        self.open()
+
+    def release(self):
+        if self.process is None:
+            return
+        self.process.stdout.close()
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+        self.process = None
+
+
+class RenditionFileSource:
+    """
+    h264_compression が書き出したレンディションファイルを読むフレームソース。
+    """
+    def __init__(self, low_res_path, med_res_path, high_res_path):
+        self.low_cap = cv2.VideoCapture(low_res_path)
+        self.med_cap = cv2.VideoCapture(med_res_path)
+        self.high_cap = cv2.VideoCapture(high_res_path)
+        self.width = int(self.high_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.high_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = self.high_cap.get(cv2.CAP_PROP_FPS) or 30.0
+
+    def isOpened(self):
+        return self.low_cap.isOpened() and self.med_cap.isOpened() and self.high_cap.isOpened()
+
+    def read(self):
+        ret_low, frame_low = self.low_cap.read()
+        ret_med, frame_med = self.med_cap.read()
+        ret_high, frame_high = self.high_cap.read()
+        if not (ret_low and ret_med and ret_high):
+            return False, None
+        return True, (frame_low, frame_med, frame_high)
+
+    def skip(self):
+        """
+        次のフレームをデコード結果を取り出さずに読み捨てる。
+        """
+        return self.low_cap.grab() and self.med_cap.grab() and self.high_cap.grab()
+
+    def restart(self):
+        for cap in (self.low_cap, self.med_cap, self.high_cap):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+    def release(self):
+        self.low_cap.release()
+        self.med_cap.release()
+        self.high_cap.release()
@@ -0,0 +1,205 @@
+"""
+セグメント単位の視線予測と領域計画。
+
+セグメントは再生より先にエンコードされるため、フレームごとの視線位置でマスクすると、
+視聴される時点では高解像度の領域がずれている。SegmentRegionPlanner はセグメントの先頭で、
+それまでの視線の軌跡から次のセグメントの視線の経路を予測し、その経路（と予測の不確かさ）を
+覆う 1 つの円をセグメント全体の領域として決める。セグメント内の全フレームで同じ領域を使うため、
+マスクの形もフレーム間で変わらない。
+
+予測には x, y それぞれ独立な等速度（速度は毎フレーム damping 倍に減衰）モデルのカルマンフィルタを使う。
+視線の速度は長くは続かないため、減衰させないと 2 秒先の予測が画面外まで伸びてしまう。
+
+実際の視線位置が計画した領域に入っていたか（hit）、視線を中心とする中心窩の円全体が
+領域に収まっていたか（covered）をフレームごとに数え、stats で報告する。
+evaluate_planner は記録した視線の列に対して同じ計画をオフラインで行い、ヒット率を求める。
+"""
+import math
+import numpy as np
+
+
+class GazePredictor:
+    """
+    減衰する等速度モデルのカルマンフィルタ（x, y で共通の共分散を持つ）。
+
+    Args:
+        damping (float): 1 フレームごとの速度の減衰率。
+        process_noise (float): 1 フレームあたりの加速度の分散（ピクセル²）。
+        measurement_noise (float): 視線の測定誤差の分散（ピクセル²）。
+    """
+    def __init__(self, damping=0.9, process_noise=1.0, measurement_noise=16.0):
+        self.damping = damping
+        self.q = process_noise
+        self.r = measurement_noise
+        self.position = None  # np.array([x, y])
+        self.velocity = np.zeros(2)
+        # 共分散 [[p_pp, p_pv], [p_pv, p_vv]]
+        self.p_pp = self.p_pv = self.p_vv = 0.0
+
+    def step_covariance(self, p_pp, p_pv, p_vv):
+        """共分散を 1 フレーム進める（F P F' + Q、Q は白色加速度モデル）"""
+        d = self.damping
+        return (
+            p_pp + 2 * p_pv + p_vv + self.q / 4,
+            d * (p_pv + p_vv) + self.q / 2,
+            d * d * p_vv + self.q,
+        )
+
+    def update(self, x, y):
+        """視線の測定値を 1 つ取り込む"""
+        z = np.array([x, y], dtype=np.float64)
+        if self.position is None:
+            self.position = z
+            self.p_pp, self.p_pv, self.p_vv = self.r, 0.0, 100.0 * self.q
+            return
+
+        # 予測
+        self.position = self.position + self.velocity
+        self.velocity = self.velocity * self.damping
+        p_pp, p_pv, p_vv = self.step_covariance(self.p_pp, self.p_pv, self.p_vv)
+
+        # 更新
+        innovation = z - self.position
+        s = p_pp + self.r
+        k_p, k_v = p_pp / s, p_pv / s
+        self.position = self.position + k_p * innovation
+        self.velocity = self.velocity + k_v * innovation
+        self.p_pp = (1 - k_p) * p_pp
+        self.p_pv = (1 - k_p) * p_pv
+        self.p_vv = p_vv - k_v * p_pv
+
+    def predict_path(self, frames):
+        """
+        続く frames フレームの予測位置と、その標準偏差を返す。
+
+        Returns:
+            tuple: ((frames, 2) の予測位置, (frames,) の標準偏差)
+        """
+        d = self.damping
+        steps = np.arange(1, frames + 1)
+        # 速度が damping 倍ずつ減衰する場合の移動量の総和
+        if d == 1:
+            travel = steps.astype(np.float64)
+        else:
+            travel = d * (1 - d ** steps) / (1 - d) if d else np.zeros(frames)
+        path = self.position + travel[:, None] * self.velocity
+
+        sigmas = np.empty(frames)
+        p_pp, p_pv, p_vv = self.p_pp, self.p_pv, self.p_vv
+        for i in range(frames):
+            p_pp, p_pv, p_vv = self.step_covariance(p_pp, p_pv, p_vv)
+            sigmas[i] = math.sqrt(p_pp)
+        return path, sigmas
+
+
+class SegmentRegionPlanner:
+    """
+    セグメントごとに、予測した視線の経路を覆う円を 1 つ計画する。
+
+    Args:
+        frame_size (tuple): 視線座標系（high レイヤー）の (width, height)。
+        confidence (float): 領域に含める予測の標準偏差の倍数。
+        max_expansion (float): 中心窩の半径に加える広がりの上限（ピクセル）。
+        predictor (GazePredictor): 予測器。None なら既定の設定で作る。
+    """
+    def __init__(self, frame_size, confidence=2.0, max_expansion=300, predictor=None):
+        self.frame_size = frame_size
+        self.confidence = confidence
+        self.max_expansion = max_expansion
+        self.predictor = predictor or GazePredictor()
+        self.plan = None
+        self.history = []  # セグメントごとの計画と結果
+        self.frames = 0
+        self.hits = 0
+        self.covered = 0
+
+    def plan_segment(self, index, frames, fovea_radius):
+        """
+        セグメント index の領域を決める。視線をまだ観測していなければ None（フレームごとの視線を使う）。
+
+        Returns:
+            dict or None: {"segment", "center": (x, y), "expansion", "radius", "fovea_radius"}
+        """
+        self.finish_segment()
+        if self.predictor.position is None:
+            self.plan = None
+            return None
+        path, sigmas = self.predictor.predict_path(frames)
+        width, height = self.frame_size
+        path = np.clip(path, 0, [width - 1, height - 1])
+
+        # 経路の外接矩形の中心を領域の中心にし、各予測点とその不確かさの円をすべて含む半径にする
+        center = (path.min(axis=0) + path.max(axis=0)) / 2
+        reach = np.hypot(path[:, 0] - center[0], path[:, 1] - center[1]) + self.confidence * sigmas
+        expansion = float(min(reach.max(), self.max_expansion))
+        self.plan = {
+            "segment": index,
+            "center": (int(round(center[0])), int(round(center[1]))),
+            "expansion": int(math.ceil(expansion)),
+            "radius": fovea_radius + int(math.ceil(expansion)),
+            "fovea_radius": fovea_radius,
+            "frames": 0, "hits": 0, "covered": 0,
+        }
+        return self.plan
+
+    def observe(self, x, y):
+        """
+        実際の視線位置を記録し、予測器を更新する。
+
+        Returns:
+            bool or None: 現在の計画の領域に入っていたか（計画がなければ None）
+        """
+        hit = None
+        if self.plan is not None:
+            cx, cy = self.plan["center"]
+            distance = math.hypot(x - cx, y - cy)
+            hit = distance <= self.plan["radius"]
+            covered = distance + self.plan["fovea_radius"] <= self.plan["radius"]
+            self.plan["frames"] += 1
+            self.plan["hits"] += hit
+            self.plan["covered"] += covered
+            self.frames += 1
+            self.hits += hit
+            self.covered += covered
+        self.predictor.update(x, y)
+        return hit
+
+    def finish_segment(self):
+        if self.plan is not None and self.plan["frames"]:
+            self.history.append(self.plan)
+        self.plan = None
+
+    def stats(self):
+        """ヒット率（視線が領域内）とカバー率（中心窩全体が領域内）、計画した半径の平均"""
+        plans = self.history + ([self.plan] if self.plan is not None and self.plan["frames"] else [])
+        return {
+            "segments": len(plans),
+            "frames": self.frames,
+            "hit_rate": round(self.hits / self.frames, 4) if self.frames else None,
+            "covered_rate": round(self.covered / self.frames, 4) if self.frames else None,
+            "mean_radius": round(sum(plan["radius"] for plan in plans) / len(plans), 1) if plans else None,
+        }
+
+
+def evaluate_planner(positions, frames_per_segment, fovea_radius, frame_size, **planner_kwargs):
+    """
+    記録した視線の列に対してセグメントごとに領域を計画し、ヒット率を求める。
+
+    Args:
+        positions (np.ndarray): (フレーム数, 2) の視線位置（GazeSource.generate や GazeLogReader.positions の結果）。
+        frames_per_segment (int): 1 セグメントのフレーム数。
+        fovea_radius (int): 中心窩（high レイヤー）の半径。
+        frame_size (tuple): (width, height)。
+
+    Returns:
+        dict: SegmentRegionPlanner.stats() と、セグメントごとのヒット率のリスト
+    """
+    planner = SegmentRegionPlanner(frame_size, **planner_kwargs)
+    for start in range(0, len(positions), frames_per_segment):
+        planner.plan_segment(start // frames_per_segment, frames_per_segment, fovea_radius)
+        for x, y in positions[start:start + frames_per_segment]:
+            planner.observe(int(x), int(y))
+    planner.finish_segment()
+    result = planner.stats()
+    result["segment_hit_rates"] = [round(plan["hits"] / plan["frames"], 4) for plan in planner.history]
+    return result
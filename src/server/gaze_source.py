@@ -0,0 +1,213 @@
+"""
+疑似視線の生成と、記録した視線ログの再生。
+
+GazeSource はフレームごとの視線位置を返す共通インタフェース。サブクラスは next_block で
+続きの視線位置をまとめて (n, 2) の配列として作り、1 フレームずつの取り出し (next_position) や
+セグメント単位の取り出し (generate) は GazeSource が行う。
+
+- RandomWalkGaze: 1 フレームごとに一様乱数で移動するランダムウォーク（画面端で反射する）。
+- SaccadeFixationGaze: 注視（小さな揺れを伴う停留）とサッカード（次の注視点への高速な移動）を繰り返すモデル。
+- ReplayGaze: バイナリ視線ログ (src.server.log_writing) をフレーム番号どおりに再生する。
+
+生成は np.random.Generator でブロック単位に行う。ブロックの大きさは取り出し方によらないため、
+同じ seed なら 1 フレームずつ取り出してもセグメント単位で取り出しても同じ列になる。
+"""
+import numpy as np
+from src.client.gaze_log_handler import GazeLogReader
+
+
+def reflect(values, limit):
+    """
+    values を [0, limit] の範囲に、端で折り返して収める（画面端で跳ね返る動き）。
+    """
+    if limit <= 0:
+        return np.zeros_like(values)
+    period = 2 * limit
+    return limit - np.abs(np.mod(values, period) - limit)
+
+
+class GazeSource:
+    """
+    フレームごとの視線位置 (x, y) を順に返す。
+    """
+    def __init__(self):
+        self.block = np.empty((0, 2), dtype=np.int32)
+        self.block_offset = 0
+        self.frame_number = 0  # 次に返すフレームの番号
+
+    def next_block(self):
+        """
+        続きの視線位置を (n, 2) の int32 配列で返す（n はサブクラスが決める）。空なら終端。
+        """
+        raise NotImplementedError
+
+    def generate(self, count):
+        """
+        続く count フレーム分の視線位置を (count, 2) の int32 配列で返す。
+        """
+        parts = []
+        remaining = count
+        while remaining > 0:
+            if self.block_offset >= len(self.block):
+                self.block = self.next_block()
+                self.block_offset = 0
+                if len(self.block) == 0:
+                    raise ValueError(f"視線の入力が終端に達しました（フレーム {self.frame_number + count - remaining}）")
+            part = self.block[self.block_offset:self.block_offset + remaining]
+            self.block_offset += len(part)
+            remaining -= len(part)
+            parts.append(part)
+        self.frame_number += count
+        if len(parts) == 1:
+            return parts[0].copy()
+        return np.concatenate(parts) if parts else np.empty((0, 2), dtype=np.int32)
+
+    def next_position(self):
+        """次のフレームの視線位置 (x, y)"""
+        if self.block_offset >= len(self.block):
+            self.block = self.next_block()
+            self.block_offset = 0
+            if len(self.block) == 0:
+                raise ValueError(f"視線の入力が終端に達しました（フレーム {self.frame_number}）")
+        x, y = self.block[self.block_offset]
+        self.block_offset += 1
+        self.frame_number += 1
+        return int(x), int(y)
+
+
+class RandomWalkGaze(GazeSource):
+    """
+    各フレームで x, y をそれぞれ [-max_speed, max_speed] の一様乱数だけ動かす。
+
+    Args:
+        width (int), height (int): フレームの解像度。
+        max_speed (int): 1 フレームあたりの最大移動量（ピクセル）。
+        seed (int): 乱数のシード。None なら毎回異なる列になる。
+        start (tuple): 最初の位置。None なら画面中央。
+        block_frames (int): 一度に生成するフレーム数。
+    """
+    def __init__(self, width, height, max_speed=15, seed=None, start=None, block_frames=256):
+        super().__init__()
+        self.limits = np.array([width - 1, height - 1])
+        self.max_speed = max_speed
+        self.rng = np.random.default_rng(seed)
+        self.position = np.array(start if start is not None else (width // 2, height // 2), dtype=np.int64)
+        self.block_frames = block_frames
+
+    def next_block(self):
+        steps = self.rng.integers(-self.max_speed, self.max_speed, size=(self.block_frames, 2), endpoint=True)
+        path = self.position + np.cumsum(steps, axis=0)
+        positions = np.empty_like(path)
+        positions[:, 0] = reflect(path[:, 0], self.limits[0])
+        positions[:, 1] = reflect(path[:, 1], self.limits[1])
+        self.position = positions[-1]
+        return positions.astype(np.int32)
+
+
+class SaccadeFixationGaze(GazeSource):
+    """
+    注視とサッカードを繰り返す視線モデル。
+
+    注視点は画面中央寄りの正規分布から選び（center_bias は画面サイズに対する標準偏差の比）、
+    注視時間はガンマ分布（平均 fixation_mean 秒）に従う。注視中は jitter ピクセルの揺れを加え、
+    次の注視点へは saccade_duration 秒かけて滑らかに移動する。
+
+    Args:
+        width (int), height (int): フレームの解像度。
+        fps (int): フレームレート。
+        seed (int): 乱数のシード。
+        fixation_mean (float): 平均注視時間（秒）。
+        fixation_shape (float): 注視時間のガンマ分布の形状パラメータ（大きいほどばらつきが小さい）。
+        saccade_duration (float): サッカードにかける時間（秒）。
+        jitter (float): 注視中の揺れの標準偏差（ピクセル）。
+        center_bias (float): 注視点の分布の標準偏差（画面サイズに対する比）。
+        block_events (int): 一度に生成する注視の数。
+    """
+    def __init__(self, width, height, fps=30, seed=None, fixation_mean=0.3, fixation_shape=4.0,
+                 saccade_duration=0.04, jitter=2.0, center_bias=0.2, block_events=32):
+        super().__init__()
+        self.size = np.array([width, height], dtype=np.float64)
+        self.fps = fps
+        self.rng = np.random.default_rng(seed)
+        self.fixation_mean = fixation_mean
+        self.fixation_shape = fixation_shape
+        self.saccade_frames = max(1, int(round(saccade_duration * fps)))
+        self.jitter = jitter
+        self.center_bias = center_bias
+        self.block_events = block_events
+        self.target = self.size / 2
+
+    def next_block(self):
+        rng = self.rng
+        count = self.block_events
+        targets = rng.normal(self.size / 2, self.size * self.center_bias, size=(count, 2))
+        targets = np.clip(targets, 0, self.size - 1)
+        fixation_frames = np.maximum(1, np.rint(
+            rng.gamma(self.fixation_shape, self.fixation_mean / self.fixation_shape, size=count) * self.fps
+        )).astype(np.int64)
+
+        # 注視ごとに「サッカード + 注視」のフレームを並べ、各フレームの注視番号と先頭からの位置を求める
+        lengths = fixation_frames + self.saccade_frames
+        event = np.repeat(np.arange(count), lengths)
+        offset = np.arange(len(event)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+        starts = np.vstack([self.target[None, :], targets[:-1]])
+        progress = np.clip((offset + 1) / self.saccade_frames, 0.0, 1.0)
+        progress = progress * progress * (3 - 2 * progress)  # 加速してから減速する
+        positions = starts[event] + (targets[event] - starts[event]) * progress[:, None]
+
+        fixating = offset >= self.saccade_frames
+        positions[fixating] += rng.normal(0.0, self.jitter, size=(int(fixating.sum()), 2))
+        self.target = targets[-1]
+        return np.rint(np.clip(positions, 0, self.size - 1)).astype(np.int32)
+
+
+class ReplayGaze(GazeSource):
+    """
+    バイナリ視線ログをフレーム番号の順に再生する。
+
+    Args:
+        log_path (str): 視線ログのパス（src.server.log_writing.gaze_log_path）。
+        loop (bool): ログの終端に達したら先頭から繰り返す。False なら終端で ValueError。
+        block_frames (int): 一度に読み出すフレーム数。
+    """
+    def __init__(self, log_path, loop=True, block_frames=256):
+        super().__init__()
+        self.reader = GazeLogReader(log_path)
+        if len(self.reader) == 0:
+            raise ValueError(f"視線ログが空です: {log_path}")
+        self.loop = loop
+        self.block_frames = block_frames
+        self.first_frame = int(self.reader.records["frame"][0])
+        self.log_frame = self.first_frame
+
+    def next_block(self):
+        last_frame = int(self.reader.records["frame"][-1])
+        if self.log_frame > last_frame:
+            if not self.loop:
+                return np.empty((0, 2), dtype=np.int32)
+            self.log_frame = self.first_frame
+        stop = min(self.log_frame + self.block_frames, last_frame + 1)
+        positions = self.reader.positions(self.log_frame, stop)
+        self.log_frame = stop
+        return positions
+
+
+def create_gaze_source(model, width, height, fps=30, seed=None, log_path=None, **kwargs):
+    """
+    名前から視線入力を作る。
+
+    Args:
+        model (str): "random_walk", "saccade", "replay" のいずれか。
+        log_path (str): "replay" で再生する視線ログのパス。
+        kwargs: 各クラスの追加の引数。
+    """
+    if model == "random_walk":
+        return RandomWalkGaze(width, height, seed=seed, **kwargs)
+    if model == "saccade":
+        return SaccadeFixationGaze(width, height, fps=fps, seed=seed, **kwargs)
+    if model == "replay":
+        if log_path is None:
+            raise ValueError("replay には log_path が必要です")
+        return ReplayGaze(log_path, **kwargs)
+    raise ValueError(f"未知の視線モデル: {model}")
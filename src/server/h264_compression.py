@@ -1,62 +1,177 @@
 import os
+import json
+import time
+import hashlib
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def h264_compression(input_video):
+# 出力ディレクトリとレンディション定義（scale, crf）
+H264_OUTPUT_DIR = "h264_outputs"
+RENDITIONS = {
+    "low": {"scale": "480:270", "crf": "50"},
+    "med": {"scale": "640:360", "crf": "30"},
+    "high": {"scale": "1920:1080", "crf": "1"},
+}
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    入力ファイルの SHA-256 ハッシュを計算する。
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def probe_duration(input_video):
+    """
+    ffprobe で動画の長さ（秒）を取得する。取得できなければ None を返す。
+    """
+    try:
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration",
+             "-of", "default=noprint_wrappers=1:nokey=1", input_video],
+            capture_output=True, text=True
+        )
+        return float(result.stdout.strip())
+    except (OSError, ValueError):
+        return None
+
+
+def build_rendition_args(name):
+    """
+    レンディションごとの ffmpeg エンコード引数（入出力を除く）を返す。
+    """
+    config = RENDITIONS[name]
+    return [
+        "-vf", f"scale={config['scale']}", "-c:v", "libx264", "-crf", config["crf"],
+        "-preset", "ultrafast", "-tune", "zerolatency"
+    ]
+
+
+def cache_key(input_hash, args):
+    """
+    入力ファイルのハッシュと ffmpeg 引数から内容アドレス型のキャッシュキーを作る。
+    """
+    payload = json.dumps({"input": input_hash, "args": args}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def is_cached(output, key):
+    """
+    出力ファイルとサイドカーのキーが一致すればキャッシュ済みとみなす。
+    """
+    key_path = output + ".key"
+    if not (os.path.exists(output) and os.path.exists(key_path)):
+        return False
+    with open(key_path, "r", encoding="utf-8") as f:
+        return f.read().strip() == key
+
+
+def run_rendition(name, input_video, output, args, key, duration=None):
+    """
+    1 つのレンディションを ffmpeg でエンコードし、進捗と所要時間を表示する。
+    成功時はサイドカーにキャッシュキーを書き込む。
+    """
+    start = time.perf_counter()
+    if is_cached(output, key):
+        print(f"[{name}] cache hit: {output} ({key[:12]})")
+        return name, output, True, time.perf_counter() - start
+
+    # 途中で失敗した場合に古いキーが残らないよう先に削除
+    key_path = output + ".key"
+    if os.path.exists(key_path):
+        os.remove(key_path)
+
+    cmd = ["ffmpeg", "-y", "-nostats", "-loglevel", "error", "-i", input_video] + args + \
+          ["-progress", "pipe:1", output]
+    print(f"[{name}] Running FFmpeg for {output}")
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+    last_reported = -1
+    for line in process.stdout:
+        # -progress の出力は key=value 形式
+        if not line.startswith("out_time_us=") and not line.startswith("out_time_ms="):
+            continue
+        try:
+            seconds = int(line.split("=", 1)[1]) / 1_000_000
+        except ValueError:
+            continue
+        if duration:
+            percent = min(100, int(seconds / duration * 100))
+            if percent // 10 > last_reported:
+                last_reported = percent // 10
+                print(f"[{name}] {percent}% ({seconds:.1f}/{duration:.1f}s)")
+        elif int(seconds) // 10 > last_reported:
+            last_reported = int(seconds) // 10
+            print(f"[{name}] {seconds:.1f}s encoded")
+
+    stderr = process.stderr.read()
+    process.wait()
+    elapsed = time.perf_counter() - start
+
+    if process.returncode != 0:
+        print(f"[{name}] FFmpeg failed for {output} with error: {stderr}")
+        return name, output, False, elapsed
+
+    with open(key_path, "w", encoding="utf-8") as f:
+        f.write(key)
+    print(f"[{name}] Successfully created {output} in {elapsed:.2f}s")
+    return name, output, True, elapsed
+
+
+def h264_compression(input_video, output_dir=H264_OUTPUT_DIR, max_workers=3):
+    """
+    low / med / high の 3 レンディションを並列にエンコードする。
+    入力ハッシュと ffmpeg 引数が変わっていないレンディションは再エンコードしない。
+
+    Args:
+        input_video (str): 入力動画のパス。
+        output_dir (str): 出力ディレクトリ。
+        max_workers (int): 同時に実行する ffmpeg プロセス数の上限。
+
+    Returns:
+        tuple: (low_res_output, med_res_output, high_res_output)
+    """
     try:
-        low_res_output = "h264_outputs/low_res.mp4"
-        med_res_output = "h264_outputs/med_res.mp4"
-        high_res_output = "h264_outputs/high_res.mp4"
+        outputs = {name: os.path.join(output_dir, f"{name}_res.mp4") for name in RENDITIONS}
 
         # ディレクトリのチェックと作成
-        if not os.path.exists("h264_outputs"):
-            try:
-                subprocess.run(["mkdir", "-p", "h264_outputs"], shell=True, check=True)
-                print('"h264_outputs" directory is meked')
-            except subprocess.CalledProcessError as e:
-                print(f"Error creating h264_outputs directory: {e}")
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+            print(f'"{output_dir}" directory is made')
         else:
-            print('"h264_outputs" already exists')
-
-        # FFmpeg コマンドの実行
-        commands = [
-            {
-                "output": low_res_output,
-                "cmd": [
-                    "ffmpeg", "-y", "-i", input_video,
-                    "-vf", "scale=480:270", "-c:v", "libx264", "-crf", "50", "-preset", "ultrafast",
-                    "-tune", "zerolatency", low_res_output
-                ]
-            },
-            {
-                "output": med_res_output,
-                "cmd": [
-                    "ffmpeg", "-y", "-i", input_video,
-                    "-vf", "scale=640:360", "-c:v", "libx264", "-crf", "30", "-preset", "ultrafast",
-                    "-tune", "zerolatency", med_res_output
-                ]
-            },
-            {
-                "output": high_res_output,
-                "cmd": [
-                    "ffmpeg", "-y", "-i", input_video,
-                    "-vf", "scale=1920:1080", "-c:v", "libx264", "-crf", "1", "-preset", "ultrafast",
-                    "-tune", "zerolatency", high_res_output
-                ]
-            }
-        ]
-
-        for command in commands:
-            try:
-                print(f"Running FFmpeg for {command['output']}")
-                result = subprocess.run(command["cmd"], capture_output=True, text=True)
-                if result.returncode != 0:
-                    print(f"FFmpeg failed for {command['output']} with error: {result.stderr}")
-                else:
-                    print(f"Successfully created {command['output']}")
-            except Exception as e:
-                print(f"Exception while running FFmpeg for {command['output']}: {e}")
-
-        return low_res_output, med_res_output, high_res_output
+            print(f'"{output_dir}" already exists')
+
+        input_hash = file_hash(input_video)
+        duration = probe_duration(input_video)
+
+        total_start = time.perf_counter()
+        timings = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for name in RENDITIONS:
+                args = build_rendition_args(name)
+                key = cache_key(input_hash, args)
+                futures.append(executor.submit(
+                    run_rendition, name, input_video, outputs[name], args, key, duration
+                ))
+
+            for future in as_completed(futures):
+                try:
+                    name, output, ok, elapsed = future.result()
+                    timings[name] = (ok, elapsed)
+                except Exception as e:
+                    print(f"Exception while running FFmpeg: {e}")
+
+        for name in RENDITIONS:
+            ok, elapsed = timings.get(name, (False, 0.0))
+            print(f"  {name}: {'ok' if ok else 'failed'} ({elapsed:.2f}s)")
+        print(f"H.264 renditions finished in {time.perf_counter() - total_start:.2f}s")
+
+        return outputs["low"], outputs["med"], outputs["high"]
     except Exception as e:
         print(f"H.264 Compression failed: {e}")
         raise
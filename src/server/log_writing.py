@@ -1,18 +1,129 @@
+"""
+追記専用のバイナリ視線ログ。
+
+1 ファイルに 1 セッション分の視線サンプルを、固定長のレコード (GAZE_RECORD) として追記する。
+先頭に 16 バイトのヘッダ（マジック、レコード長、予約）を置き、以降はレコードが隙間なく並ぶため、
+読み手は np.memmap でそのまま配列として参照できる（src.client.gaze_log_handler.GazeLogReader）。
+
+レコードはフレーム番号の昇順（同じフレームに複数のサンプルがあってもよい）で追記する。
+書き込みはメモリ上のバッファにまとめてから 1 回の write で行い、行ごとの書式化や I/O は行わない。
+書き込み途中で終了した場合の末尾の不完全なレコードは、読み手が無視し、続きから追記する書き手 (append=True) が切り捨てる。
+
+フレーム番号はセッションごとに 0 から数え直すため、書き手は既定では新しいログを作る（既存のファイルは
+削除してから作り直すので、前のセッションのログを memmap している読み手は別のファイルとして扱える）。
+"""
 import os
+import time
+import struct
+import numpy as np
+
+GAZE_LOG_MAGIC = b"GAZELOG1"
+GAZE_LOG_HEADER = struct.Struct("<8sII")  # マジック, レコード長, 予約
+GAZE_RECORD = np.dtype([
+    ("timestamp", "<f8"),  # サンプルの時刻 (time.time())
+    ("frame", "<i8"),      # フレーム番号（セッション先頭から）
+    ("x", "<i4"),
+    ("y", "<i4"),
+])
+
+
+def gaze_log_path(session_dir):
+    """セッションの視線ログのパス"""
+    return os.path.join(session_dir, "logs", "gaze_log.bin")
+
+
+def read_gaze_log_header(f):
+    """
+    ヘッダを読み、形式が正しければレコード長を返す。
+    """
+    header = f.read(GAZE_LOG_HEADER.size)
+    if len(header) != GAZE_LOG_HEADER.size:
+        raise ValueError("視線ログのヘッダが不完全です")
+    magic, record_size, _ = GAZE_LOG_HEADER.unpack(header)
+    if magic != GAZE_LOG_MAGIC or record_size != GAZE_RECORD.itemsize:
+        raise ValueError("視線ログの形式が異なります")
+    return record_size
+
 
-def log_gaze_positions(log_dir, segment_index, gaze_positions):
+class GazeLogWriter:
     """
-    疑似視線の位置をセグメントごとにログとして記録する関数。
-    :param log_dir: ログファイルを保存するディレクトリ
-    :param segment_index: セグメント番号
-    :param gaze_positions: 各フレームごとの疑似視線位置のリスト [(x1, y1), (x2, y2), ...]
+    視線サンプルを固定長レコードとして追記する。
+
+    Args:
+        path (str): ログファイルのパス。
+        buffer_records (int): ディスクに書き出すまでメモリにためるレコード数。
+        append (bool): True なら既存のログに続きから追記する（フレーム番号は前回の続きから）。
+            False なら既存のログを捨てて新しいセッションのログを作る。
     """
-    os.makedirs(log_dir, exist_ok=True)
-    log_file_path = os.path.join(log_dir, f"segment_{segment_index:04d}.txt")
-    
-    with open(log_file_path, "w") as log_file:
-        log_file.write("Frame, Gaze_X, Gaze_Y\n")
-        for frame_index, (gaze_x, gaze_y) in enumerate(gaze_positions):
-            log_file.write(f"{frame_index}, {gaze_x}, {gaze_y}\n")
-    
-    print(f"ログを保存しました: {log_file_path}")
+    def __init__(self, path, buffer_records=4096, append=False):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.buffer = np.empty(buffer_records, dtype=GAZE_RECORD)
+        self.buffered = 0
+        self.records_written = 0
+        self.last_frame = -1
+
+        if not append and os.path.exists(path):
+            os.remove(path)
+        if append and os.path.exists(path) and os.path.getsize(path) >= GAZE_LOG_HEADER.size:
+            with open(path, "r+b") as f:
+                read_gaze_log_header(f)
+                # 前回書きかけで終わったレコードを切り捨てる
+                count = (os.path.getsize(path) - GAZE_LOG_HEADER.size) // GAZE_RECORD.itemsize
+                f.truncate(GAZE_LOG_HEADER.size + count * GAZE_RECORD.itemsize)
+                if count:
+                    f.seek(GAZE_LOG_HEADER.size + (count - 1) * GAZE_RECORD.itemsize)
+                    self.last_frame = int(np.frombuffer(f.read(GAZE_RECORD.itemsize), dtype=GAZE_RECORD)["frame"][0])
+            self.records_written = count
+            self.file = open(path, "ab")
+        else:
+            self.file = open(path, "wb")
+            self.file.write(GAZE_LOG_HEADER.pack(GAZE_LOG_MAGIC, GAZE_RECORD.itemsize, 0))
+            # 読み手がすぐに開けるよう、ヘッダだけは先に書き出す
+            self.file.flush()
+
+    def append(self, frame, x, y, timestamp=None):
+        """
+        1 サンプルを追加する。frame は直前のサンプル以上でなければならない。
+        """
+        if frame < self.last_frame:
+            raise ValueError(f"フレーム番号が昇順ではありません: {frame} < {self.last_frame}")
+        if self.buffered == len(self.buffer):
+            self.flush()
+        self.buffer[self.buffered] = (time.time() if timestamp is None else timestamp, frame, x, y)
+        self.buffered += 1
+        self.last_frame = frame
+
+    def extend(self, frames, xs, ys, timestamps=None):
+        """
+        複数のサンプルをまとめて追加する（配列を受け取り、レコードへの変換はベクトル演算で行う）。
+        """
+        frames = np.asarray(frames, dtype=np.int64)
+        if frames.size == 0:
+            return
+        if frames[0] < self.last_frame or np.any(np.diff(frames) < 0):
+            raise ValueError("フレーム番号が昇順ではありません")
+        records = np.empty(frames.size, dtype=GAZE_RECORD)
+        records["timestamp"] = time.time() if timestamps is None else timestamps
+        records["frame"] = frames
+        records["x"] = xs
+        records["y"] = ys
+
+        self.flush()
+        self.file.write(records.tobytes())
+        self.records_written += frames.size
+        self.last_frame = int(frames[-1])
+
+    def flush(self):
+        """バッファのレコードをファイルに書き出す"""
+        if self.buffered:
+            self.file.write(self.buffer[:self.buffered].tobytes())
+            self.records_written += self.buffered
+            self.buffered = 0
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
@@ -0,0 +1,174 @@
+"""
+MPD マニフェスト用のセグメントインデックス。
+
+セグメント一覧をディレクトリの走査で作り直す代わりに、完成したセグメント番号をメモリ上に
+追記していき、SegmentTemplate ($Number$) + SegmentTimeline で記述する。
+タイムラインは同じ長さのセグメントが続く限り 1 つの <S r="..."> にまとめるため、
+マニフェストの大きさと生成コストはストリームの長さに依存しない。
+"""
+import os
+import re
+import datetime
+import tempfile
+import xml.etree.ElementTree as ET
+
+
+def utc_now_iso():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None).isoformat() + "Z"
+
+
+class SegmentIndex:
+    """
+    連番のセグメントを O(1) で追記するインデックス。
+
+    Args:
+        timescale (int): タイムラインの時間単位（1 秒あたりの tick 数）。
+        segment_duration (float): 標準のセグメント長（秒）。
+    """
+    def __init__(self, timescale, segment_duration):
+        self.timescale = timescale
+        self.duration = int(round(segment_duration * timescale))
+        self.start_number = None
+        self.last_number = None
+        self.runs = []  # [t, d, r] の SegmentTimeline エントリ
+        self.availability_start = utc_now_iso()
+
+    def __len__(self):
+        if self.start_number is None:
+            return 0
+        return self.last_number - self.start_number + 1
+
+    def append(self, number, duration=None):
+        """
+        セグメント番号 number を追加する。番号は直前の番号の次でなければならない。
+        既に追加済みの番号は無視する。ただし最後の番号に別の duration を指定した場合は、
+        その長さに更新する（低遅延モードで、開始時に公開したセグメントが短く終わった場合）。
+        """
+        d = duration or self.duration
+        if self.start_number is None:
+            self.start_number = number
+            self.last_number = number
+            self.runs.append([0, d, 0])
+            return
+        if number <= self.last_number:
+            if number == self.last_number and duration and duration != self.runs[-1][1]:
+                self.update_last_duration(duration)
+            return
+        if number != self.last_number + 1:
+            raise ValueError(f"セグメント番号が連続していません: {self.last_number} -> {number}")
+
+        last = self.runs[-1]
+        if last[1] == d:
+            last[2] += 1
+        else:
+            self.runs.append([last[0] + last[1] * (last[2] + 1), d, 0])
+        self.last_number = number
+
+    def update_last_duration(self, duration):
+        last = self.runs[-1]
+        if last[2] == 0:
+            last[1] = duration
+            return
+        last[2] -= 1
+        self.runs.append([last[0] + last[1] * (last[2] + 1), duration, 0])
+
+    @classmethod
+    def from_directory(cls, segment_dir, pattern, timescale, segment_duration):
+        """
+        既存のセグメントファイルからインデックスを作る（起動時に 1 回だけ使う）。
+        pattern は番号を 1 つ含む正規表現（例: r"low_segment(\\d+)\\.mp4$"）。
+        最初の番号から連続している範囲だけを取り込む。
+        """
+        index = cls(timescale, segment_duration)
+        if not os.path.isdir(segment_dir):
+            return index
+        regex = re.compile(pattern)
+        numbers = sorted(
+            int(m.group(1)) for m in (regex.match(f) for f in os.listdir(segment_dir)) if m
+        )
+        for number in numbers:
+            if index.last_number is not None and number != index.last_number + 1:
+                break
+            index.append(number)
+        return index
+
+    def add_template(self, parent, media):
+        """
+        parent 要素の下に SegmentTemplate / SegmentTimeline を追加する。
+        """
+        template = ET.SubElement(parent, "SegmentTemplate", attrib={
+            "timescale": str(self.timescale),
+            "media": media,
+            "startNumber": str(self.start_number or 0),
+        })
+        timeline = ET.SubElement(template, "SegmentTimeline")
+        for t, d, r in self.runs:
+            attrib = {"t": str(t), "d": str(d)}
+            if r:
+                attrib["r"] = str(r)
+            ET.SubElement(timeline, "S", attrib=attrib)
+        return template
+
+
+def create_mpd_root(availability_start, min_buffer_time="PT1.5S"):
+    """
+    動的 (live) プロファイルの MPD ルート要素を作る。
+    """
+    return ET.Element("MPD", attrib={
+        "xmlns": "urn:mpeg:dash:schema:mpd:2011",
+        "profiles": "urn:mpeg:dash:profile:isoff-live:2011",
+        "type": "dynamic",
+        "minBufferTime": min_buffer_time,
+        "availabilityStartTime": availability_start,
+        "publishTime": utc_now_iso()
+    })
+
+
+def add_low_latency_elements(mpd, target_latency, minimum_update_period="PT0.5S"):
+    """
+    低遅延 (LL-DASH) 用の要素を MPD に追加する。Period を追加した後に呼ぶこと。
+    ServiceDescription で目標遅延 [秒] を、UTCTiming でサーバの時刻を伝える。
+    """
+    mpd.set("minimumUpdatePeriod", minimum_update_period)
+    service = ET.Element("ServiceDescription", attrib={"id": "0"})
+    ET.SubElement(service, "Latency", attrib={
+        "target": str(int(target_latency * 1000)),
+        "max": str(int(target_latency * 2000)),
+    })
+    mpd.insert(0, service)
+    ET.SubElement(mpd, "UTCTiming", attrib={
+        "schemeIdUri": "urn:mpeg:dash:utc:direct:2014",
+        "value": utc_now_iso(),
+    })
+
+
+def write_atomic(path, data):
+    """
+    同じディレクトリの一時ファイルに書いてから置き換えることで、
+    読み手が書きかけのファイルを見ないようにする。
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_mpd(mpd, mpd_path, store=None):
+    """
+    MPD を XML 宣言付きで原子的に書き込む。
+    store (SegmentStore) を渡した場合はストアに登録し、ディスクへの書き込みはストアに任せる。
+    """
+    ET.indent(mpd, space="  ")
+    data = ET.tostring(mpd, encoding="utf-8", xml_declaration=True)
+    key = store.key_for(mpd_path) if store is not None else None
+    if key is not None:
+        store.put(key, data, persist=True)
+    else:
+        write_atomic(mpd_path, data)
@@ -1,18 +1,253 @@
 import http.server
-import socketserver
+import functools
 import os
+import time
+import threading
+import urllib.parse
+from collections import deque
+
+# セグメントの URL はセッションごとに同じ名前で書き直されるため、キャッシュは許すが毎回 ETag で再検証させる
+# （内容が同じなら 304 で本体は送らない）
+SEGMENT_EXTENSIONS = (".mp4", ".m4s", ".json")
+SEGMENT_CACHE_CONTROL = "public, no-cache"
+# MPD やプレーヤーは更新されるため、毎回 ETag で再検証させる
+DEFAULT_CACHE_CONTROL = "no-cache"
+# 書き込み中のセグメントを確認する間隔と、書き足しが止まったとみなすまでの秒数
+IN_PROGRESS_POLL_INTERVAL = 0.01
+IN_PROGRESS_STALL_TIMEOUT = 10
+# スループットの測定に使うメディアセグメントの拡張子
+MEDIA_EXTENSIONS = (".mp4", ".m4s")
+
+
+def parse_range(header, size):
+    """
+    Range ヘッダ（単一範囲のみ）を解釈する。
+
+    Returns:
+        tuple or None or False: (開始, 終了) の閉区間。ヘッダを無視して全体を返す場合は None、
+        範囲が満たせない場合は False。
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[len("bytes="):].strip().partition("-")
+    try:
+        if start == "":
+            # 末尾 n バイト
+            length = int(end)
+            if length <= 0:
+                return False
+            return max(0, size - length), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+class ThroughputMeter:
+    """
+    配信したメディアセグメントの転送量と送信にかかった時間から、直近の配信スループットを求める。
+
+    Args:
+        window (int): 平均に使う直近の転送数。
+        min_bytes (int): これより小さい転送は測定に使わない（送信バッファに収まり、所要時間がほぼ 0 になるため）。
+    """
+    def __init__(self, window=10, min_bytes=64 * 1024):
+        self.samples = deque(maxlen=window)  # (バイト数, 秒)
+        self.min_bytes = min_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = 0
+
+    def record(self, nbytes, seconds):
+        with self.lock:
+            self.total_bytes += nbytes
+            if nbytes >= self.min_bytes and seconds > 0:
+                self.samples.append((nbytes, seconds))
+
+    def throughput(self):
+        """直近の転送の合計バイト数 / 合計時間 (bps)。測定値がなければ None。"""
+        with self.lock:
+            if not self.samples:
+                return None
+            return 8 * sum(n for n, _ in self.samples) / sum(s for _, s in self.samples)
+
+    def stats(self):
+        throughput = self.throughput()
+        return {
+            "throughput_bps": None if throughput is None else round(throughput),
+            "samples": len(self.samples),
+            "total_bytes": self.total_bytes,
+        }
+
 
 class CustomHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    HTTP/1.1 の keep-alive で、ストアまたは directory 以下のファイルを配信する。
+
+    - store (SegmentStore) にあるパスはメモリから、それ以外はファイルから sendfile で送る。
+    - 単一範囲の Range リクエストに 206 で応答する。
+    - 強い ETag を付け、If-None-Match が一致すれば 304 を返す。
+    - セグメントも MPD なども no-cache で毎回再検証させる（セグメントの URL はセッション間で再利用されるため）。
+    - 書き込み中のセグメント（低遅延モード）は、書き足された分から chunked transfer encoding で送る。
+    - meter (ThroughputMeter) を指定すると、完成したメディアセグメントの送信時間を記録する。
+    """
+    protocol_version = "HTTP/1.1"
+    # アイドル状態の keep-alive 接続を閉じるまでの秒数
+    timeout = 30
+
+    def __init__(self, *args, store=None, meter=None, **kwargs):
+        # 親クラスの __init__ の中でリクエストが処理されるため、先に設定する
+        self.store = store
+        self.meter = meter
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        self.send_resource(head_only=False)
+
+    def do_HEAD(self):
+        self.send_resource(head_only=True)
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def request_path(self):
+        return urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+
+    def send_resource(self, head_only):
+        path = self.request_path()
+        in_progress_path = self.store.in_progress(path) if self.store is not None else None
+        if in_progress_path is not None:
+            self.send_in_progress(path, in_progress_path, head_only)
+            return
+
+        entry = self.store.get_entry(path) if self.store is not None else None
+        if entry is not None:
+            data, etag = entry
+            self.send_body(path, len(data), etag, head_only, lambda start, length: self.wfile.write(
+                memoryview(data)[start:start + length]
+            ))
+            return
+
+        file_path = self.translate_path(self.path)
+        if os.path.isdir(file_path):
+            # ディレクトリの一覧やリダイレクトは既定の処理に任せる
+            return super().do_GET() if not head_only else super().do_HEAD()
+        try:
+            f = open(file_path, "rb")
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            etag = f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+            self.send_body(path, st.st_size, etag, head_only, lambda start, length: self.connection.sendfile(
+                f, start, length
+            ))
+
+    def send_in_progress(self, path, file_path, head_only):
+        """
+        書き込み中のセグメントを、ファイルに書き足されたチャンクから順に chunked で送る。
+        完成するまで長さも ETag も決まらないため、キャッシュはさせない。
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        if head_only:
+            return
+
+        f = None
+        last_progress = time.perf_counter()
+        try:
+            while True:
+                # 完成の確認は読み込みより先に行う（完成後に読んで空なら、すべて送り終えている）
+                complete = self.store.in_progress(path) is None
+                if f is None:
+                    try:
+                        f = open(file_path, "rb")
+                    except FileNotFoundError:
+                        if complete:
+                            break
+                data = f.read(256 * 1024) if f is not None else b""
+                if data:
+                    self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+                    last_progress = time.perf_counter()
+                    continue
+                if complete or time.perf_counter() - last_progress > IN_PROGRESS_STALL_TIMEOUT:
+                    break
+                time.sleep(IN_PROGRESS_POLL_INTERVAL)
+        finally:
+            if f is not None:
+                f.close()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_body(self, path, size, etag, head_only, write):
+        """
+        条件付きリクエストと Range を処理してヘッダを送り、write(開始, 長さ) で本文を送る。
+        """
+        if etag in (tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")):
+            self.send_response(304)
+            self.send_cache_headers(path, etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        byte_range = parse_range(self.headers.get("Range"), size)
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range != etag:
+            byte_range = None
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if byte_range is None:
+            start, length = 0, size
+            self.send_response(200)
+        else:
+            start, end = byte_range
+            length = end - start + 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_cache_headers(path, etag)
+        self.end_headers()
+        if not head_only and length:
+            start_time = time.perf_counter()
+            write(start, length)
+            if self.meter is not None and path.endswith(MEDIA_EXTENSIONS):
+                self.meter.record(length, time.perf_counter() - start_time)
+
+    def send_cache_headers(self, path, etag):
+        self.send_header("ETag", etag)
+        if path.endswith(SEGMENT_EXTENSIONS):
+            self.send_header("Cache-Control", SEGMENT_CACHE_CONTROL)
+        else:
+            self.send_header("Cache-Control", DEFAULT_CACHE_CONTROL)
+
     def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Cache-Control', 'no-store, no-cache, must-revalidate, max-age=0')
+        self.send_header('Access-Control-Allow-Methods', 'GET, HEAD, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Range, If-None-Match, If-Range')
+        self.send_header('Access-Control-Expose-Headers', 'Content-Length, Content-Range, ETag')
         super().end_headers()
 
-def setup_web_server(directory="segments", port=8080):
+def setup_web_server(directory="segments", port=8080, store=None, meter=None):
+    """
+    directory をルートとしてスレッド並列の HTTP サーバを起動する（プロセスの作業ディレクトリは変えない）。
+    """
     directory = os.path.abspath(directory)
-    os.chdir(directory)  # サーバのルートをsegmentsに設定
-    handler = CustomHandler
-    with socketserver.TCPServer(("", port), handler) as httpd:
-        print(f"Serving HTTP on port {port} (http://localhost:{port}/) ...")
+    handler = functools.partial(CustomHandler, store=store, meter=meter, directory=directory)
+    with http.server.ThreadingHTTPServer(("", port), handler) as httpd:
+        httpd.daemon_threads = True
+        print(f"Serving HTTP on port {port} (http://localhost:{port}/) from {directory} ...")
         httpd.serve_forever()
@@ -0,0 +1,170 @@
+"""
+段階的パイプライン。
+
+読み込み → マスク → エンコード/書き込み → マニフェスト の各段を別スレッドで動かし、
+段の間を上限付きキューでつなぐ。OpenCV の処理や ffmpeg へのパイプ書き込みは GIL を解放するため、
+セグメントの書き出し中も読み込みとマスク処理を止めずに済む。
+
+キューが満杯のときの動作は段ごとに選べる。
+- block: 上流を待たせる（バックプレッシャー）。待たされた回数を blocked として数える。
+- drop: 新しい要素を捨てる。捨てた回数を dropped として数える。
+"""
+import queue
+import threading
+import time
+
+# 段の終了を下流に伝える番兵
+STOP = object()
+
+
+class StageQueue:
+    """
+    統計付きの上限付きキュー。
+    """
+    def __init__(self, name, maxsize, drop_when_full=False):
+        self.name = name
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.drop_when_full = drop_when_full
+        self.put_count = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.blocked_seconds = 0.0
+        self.max_depth = 0
+
+    def put(self, item):
+        """
+        要素を追加する。drop モードで満杯なら捨てて False を返す。
+        番兵は常にブロックして確実に渡す。
+        """
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if self.drop_when_full and item is not STOP:
+                self.dropped += 1
+                return False
+            self.blocked += 1
+            start = time.perf_counter()
+            self.queue.put(item)
+            self.blocked_seconds += time.perf_counter() - start
+        self.put_count += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def get(self):
+        return self.queue.get()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        return {
+            "depth": self.depth(),
+            "max_depth": self.max_depth,
+            "capacity": self.queue.maxsize,
+            "put": self.put_count,
+            "dropped": self.dropped,
+            "blocked": self.blocked,
+            "blocked_seconds": round(self.blocked_seconds, 3),
+        }
+
+
+class PipelineStage(threading.Thread):
+    """
+    in_queue から要素を取り出して func を適用し、結果を out_queue に渡すスレッド。
+    func が None を返した場合は下流に何も渡さない。
+    """
+    def __init__(self, name, func, in_queue, out_queue=None):
+        super().__init__(name=name, daemon=True)
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.processed = 0
+        self.busy_seconds = 0.0
+        self.error = None
+
+    def run(self):
+        while True:
+            item = self.in_queue.get()
+            if item is STOP:
+                break
+            if self.error is not None:
+                # エラー後も上流がブロックしないよう、入力は読み捨てる
+                continue
+            start = time.perf_counter()
+            try:
+                result = self.func(item)
+            except Exception as e:
+                print(f"パイプライン段 {self.name} でエラーが発生しました: {e}")
+                self.error = e
+                continue
+            self.busy_seconds += time.perf_counter() - start
+            self.processed += 1
+            if self.out_queue is not None and result is not None:
+                self.out_queue.put(result)
+
+        if self.out_queue is not None:
+            self.out_queue.put(STOP)
+
+    def stats(self):
+        return {
+            "processed": self.processed,
+            "busy_seconds": round(self.busy_seconds, 3),
+        }
+
+
+class Pipeline:
+    """
+    段とキューをまとめて管理する。
+    stages は (name, func, out_queue_size, drop_when_full) のリストで、先頭の段の入力キューは
+    input_size / input_drop で指定する。最後の段の out_queue_size は無視される。
+    """
+    def __init__(self, stages, input_size=8, input_drop=False):
+        self.queues = []
+        self.stages = []
+        in_queue = StageQueue(stages[0][0], input_size, drop_when_full=input_drop)
+        self.queues.append(in_queue)
+        for i, (name, func, out_size, drop) in enumerate(stages):
+            out_queue = None
+            if i + 1 < len(stages):
+                next_name = stages[i + 1][0]
+                out_queue = StageQueue(next_name, out_size, drop_when_full=drop)
+                self.queues.append(out_queue)
+            self.stages.append(PipelineStage(name, func, in_queue, out_queue))
+            in_queue = out_queue
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def put(self, item):
+        """
+        先頭の段に要素を投入する。
+        """
+        return self.queues[0].put(item)
+
+    def close(self, timeout=None):
+        """
+        番兵を流してすべての段の終了を待つ。
+        """
+        self.queues[0].put(STOP)
+        for stage in self.stages:
+            stage.join(timeout)
+
+    def is_healthy(self):
+        return all(stage.error is None and stage.is_alive() for stage in self.stages)
+
+    def stats(self):
+        """
+        段ごとの入力キューの深さ・ドロップ数・バックプレッシャー回数と処理数を返す。
+        """
+        return {
+            stage.name: {**stage_queue.stats(), **stage.stats()}
+            for stage, stage_queue in zip(self.stages, self.queues)
+        }
+
+    def format_stats(self):
+        return " | ".join(
+            f"{name}: depth={s['depth']}/{s['capacity']} max={s['max_depth']} "
+            f"done={s['processed']} drop={s['dropped']} blocked={s['blocked']}"
+            for name, s in self.stats().items()
+        )
@@ -0,0 +1,171 @@
+"""
+常駐 ffmpeg エンコーダ。
+
+レイヤーごとに 1 つの ffmpeg プロセスを起動したままにし、標準入力に rawvideo (bgr24) の
+フレームを流し込む。H.264 へのエンコードと segment マクサーによる分割は ffmpeg 側で行うため、
+セグメントごとのプロセス起動や mp4v → H.264 の再エンコードが不要になる。
+セグメント境界は idr_alignment_args で IDR フレームに揃える。キーフレームの位置はフレーム番号で決め、
+タイムスタンプはフレーム番号 / fps を共通の TRACK_TIMESCALE で表すため、解像度や CRF が違っても
+low / med / high と合成ストリームのセグメントは同じフレームから始まり、同じタイムスタンプを持つ。
+各セグメントは IDR から始まる closed GOP で B フレームも持たないため、前のセグメントを参照せずにデコードできる
+（src.server.segment_verifier で確認できる）。
+
+H264FileEncoder は同じ仕組みで 1 ファイルだけを書き出す（合成セグメント用）。
+cv2.VideoWriter (mp4v) で一時ファイルに書いてから ffmpeg で H.264 に再エンコードする必要がない。
+"""
+import os
+import subprocess
+
+# レイヤーごとの既定 CRF（h264_compression のレンディション設定と合わせる）
+LAYER_CRF = {
+    "low": 50,
+    "med": 30,
+    "high": 1,
+}
+
+# 全レイヤーと合成ストリームで共通の mp4 のタイムスケール（タイムスタンプの表現を揃える）
+TRACK_TIMESCALE = 90000
+
+
+def idr_alignment_args(fps, segment_duration):
+    """
+    segment_duration 秒ごとに IDR を置き、それ以外のキーフレームを入れない libx264 の引数。
+    同じ fps と segment_duration で起動したエンコーダは、入力の内容にかかわらず同じフレームに IDR を置く。
+    """
+    gop = int(round(fps * segment_duration))
+    return [
+        "-g", str(gop), "-keyint_min", str(gop), "-sc_threshold", "0", "-bf", "0",
+        # 時刻ではなくフレーム番号で判定する（浮動小数点の丸めでレイヤーごとにずれない）
+        "-force_key_frames", f"expr:gte(n,n_forced*{gop})", "-forced-idr", "1",
+        "-x264-params", "open-gop=0",
+    ]
+
+
+class RawVideoEncoder:
+    """
+    rawvideo (bgr24) を標準入力で受け取る ffmpeg プロセスの共通部分。
+    """
+    def __init__(self, command, output_path, width, height):
+        self.output_pattern = output_path
+        self.width = width
+        self.height = height
+        self.frame_bytes = width * height * 3
+        self.frames_written = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    @staticmethod
+    def input_args(width, height, fps):
+        return [
+            "ffmpeg", "-y", "-nostdin", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(fps),
+            "-i", "pipe:0",
+        ]
+
+    def write(self, frame):
+        """
+        1 フレームをエンコーダに送る。frame は (height, width, 3) の uint8 配列。
+        """
+        if frame.shape[0] != self.height or frame.shape[1] != self.width:
+            raise ValueError(
+                f"フレームサイズが一致しません: {frame.shape[1]}x{frame.shape[0]} != {self.width}x{self.height}"
+            )
+        if not frame.flags["C_CONTIGUOUS"]:
+            frame = frame.copy()
+        self.process.stdin.write(memoryview(frame).cast("B"))
+        self.frames_written += 1
+
+    def close(self):
+        """
+        標準入力を閉じて出力を確定させ、プロセスの終了を待つ。
+
+        Returns:
+            bool: ffmpeg が正常終了したかどうか
+        """
+        if self.process is None:
+            return True
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        stderr = self.process.stderr.read()
+        self.process.wait()
+        ok = self.process.returncode == 0
+        if not ok:
+            print(f"ffmpegエラー ({self.output_pattern}): {stderr.decode(errors='replace')}")
+        self.process = None
+        return ok
+
+
+class SegmentEncoder(RawVideoEncoder):
+    """
+    rawvideo を受け取り、segment_duration 秒ごとの H.264 mp4 セグメントを書き出す ffmpeg プロセス。
+
+    Args:
+        output_pattern (str): 出力ファイル名のパターン（例: "low_segment%04d.mp4"）。
+        width (int), height (int): 入力フレームの解像度。
+        fps (int): フレームレート。
+        segment_duration (int): セグメントの長さ（秒）。
+        crf (int): libx264 の CRF。
+        start_number (int): 最初のセグメント番号。
+        segment_list (str): 完成したセグメントを追記する CSV のパス（None なら書かない）。
+        chunk_duration (float): 指定した場合、セグメントを chunk_duration 秒ごとの moof + mdat からなる
+            断片化 MP4 (CMAF) として書き出す（低遅延モード）。
+    """
+    def __init__(self, output_pattern, width, height, fps, segment_duration=2, crf=23,
+                 preset="ultrafast", start_number=0, segment_list=None, chunk_duration=None):
+        self.fps = fps
+        self.segment_duration = segment_duration
+        self.crf = crf
+
+        command = self.input_args(width, height, fps) + [
+            "-c:v", "libx264", "-preset", preset, "-tune", "zerolatency", "-crf", str(crf),
+            "-pix_fmt", "yuv420p",
+        ] + idr_alignment_args(fps, segment_duration) + [
+            # 強制した IDR の位置でちょうど分割されるよう、判定に半フレーム分の余裕を持たせる
+            "-f", "segment", "-segment_time", str(segment_duration),
+            "-segment_time_delta", f"{0.5 / fps:.6f}",
+            # 低遅延モードではチャンクの decode time をセグメントをまたいで連続させる（MSE に順に追加するため）
+            "-segment_format", "mp4", "-reset_timestamps", "0" if chunk_duration else "1",
+            "-segment_start_number", str(start_number),
+        ]
+        format_options = f"video_track_timescale={TRACK_TIMESCALE}"
+        if chunk_duration:
+            # 空の moov を先頭に書き、以降はチャンクごとに書き足す
+            format_options += (
+                f":movflags=+empty_moov+default_base_moof+cmaf:frag_duration={int(chunk_duration * 1000000)}"
+            )
+        command += ["-segment_format_options", format_options]
+        if segment_list:
+            command += ["-segment_list", segment_list, "-segment_list_type", "csv"]
+        command.append(output_pattern)
+
+        super().__init__(command, output_pattern, width, height)
+
+
+class H264FileEncoder(RawVideoEncoder):
+    """
+    rawvideo を受け取り、1 つの H.264 mp4 ファイルを書き出す ffmpeg プロセス。
+
+    既定の profile / level は合成セグメントの MPD に記述している codecs="avc1.42E01E"
+    (Constrained Baseline, Level 3.0) に合わせる。
+
+    Args:
+        output_path (str): 出力ファイルのパス。
+        width (int), height (int): 入力フレームの解像度。
+        fps (int): フレームレート。
+        crf (int): libx264 の CRF。
+    """
+    def __init__(self, output_path, width, height, fps, crf=23, preset="ultrafast", profile="baseline", level="3.0"):
+        self.fps = fps
+        command = self.input_args(width, height, fps) + [
+            "-c:v", "libx264", "-preset", preset, "-tune", "zerolatency", "-crf", str(crf),
+            "-profile:v", profile, "-level", level, "-pix_fmt", "yuv420p",
+            # 先頭を IDR にし、途中にキーフレームを追加しない（1 セグメント = 1 GOP）
+            "-g", "100000", "-sc_threshold", "0", "-bf", "0", "-x264-params", "open-gop=0",
+            # レイヤーセグメントと同じタイムスケールで、先頭フレームの時刻を 0 にする
+            "-video_track_timescale", str(TRACK_TIMESCALE),
+            "-movflags", "+faststart", "-f", "mp4", output_path,
+        ]
+        super().__init__(command, output_path, width, height)
@@ -0,0 +1,186 @@
+"""
+メモリ上のセグメントストア。
+
+エンコード済みのセグメントと MPD を、HTTP で配信するときのパス（配信ルートからの相対パス）を
+キーとして保持する。容量は合計バイト数で制限し、超えた分は最も長く参照されていないものから捨てる (LRU)。
+
+HTTP サーバはまずストアを参照し、見つからなければディスクから読む。公開したセグメントは
+何度取得されてもディスクを読まず、ライブエッジの配信がファイルシステムの遅延を待つこともない。
+MPD のようにストアが正本になるデータは、write_behind を有効にするとバックグラウンドでディスクにも書く。
+
+低遅延モードでは、書き込み中のセグメントを mark_in_progress で登録しておくと、HTTP サーバは
+完成を待たずにファイルに書き足された分から送る。完成したら put_file で登録し mark_complete を呼ぶ。
+"""
+import os
+import time
+import queue
+import posixpath
+import threading
+from collections import OrderedDict
+from src.server.manifest import write_atomic
+
+# 書き込みスレッドの終了を伝える番兵
+_STOP = object()
+
+
+def normalize_key(key):
+    """
+    URL パスやファイルの相対パスを、ストアのキー（"/" 区切りの相対パス）にする。
+    ルートの外を指すパスは None。
+    """
+    key = posixpath.normpath("/" + key.replace("\\", "/")).lstrip("/")
+    if not key or key.startswith(".."):
+        return None
+    return key
+
+
+class SegmentStore:
+    """
+    Args:
+        root (str): 配信ルート（キーはこのディレクトリからの相対パス）。
+        max_bytes (int): 保持するデータの合計サイズの上限。
+        write_behind (bool): persist=True で追加したデータを、バックグラウンドのスレッドで
+            root 以下のファイルにも書く。False ならメモリにだけ保持する。
+    """
+    def __init__(self, root="segments", max_bytes=256 * 1024 * 1024, write_behind=True):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.write_behind = write_behind
+        self.entries = OrderedDict()  # key -> (bytes, ETag)（末尾ほど最近参照された）
+        self.size = 0
+        # ETag はストアごとの識別子と登録の通し番号から作る（内容が変われば必ず変わる）
+        self.instance = time.time_ns()
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.in_progress_paths = {}  # key -> 書き込み中のファイルのパス
+
+        self.write_queue = None
+        self.writer = None
+        if write_behind:
+            self.write_queue = queue.Queue()
+            self.writer = threading.Thread(target=self.write_loop, name="segment-store-writer", daemon=True)
+            self.writer.start()
+
+    def key_for(self, path):
+        """ファイルパスに対応するキー"""
+        return normalize_key(os.path.relpath(os.path.abspath(path), self.root))
+
+    def put(self, key, data, persist=False):
+        """
+        data を key で登録する（同じキーがあれば置き換える）。
+        persist=True かつ write_behind が有効なら、ディスクへの書き込みを予約する。
+        """
+        key = normalize_key(key)
+        if key is None:
+            raise ValueError("配信ルートの外のパスは登録できません")
+        data = bytes(data)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.generation += 1
+            self.entries[key] = (data, f'"{self.instance:x}-{self.generation:x}"')
+            self.size += len(data)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+        if persist and self.write_queue is not None:
+            self.write_queue.put((key, data))
+
+    def put_file(self, path):
+        """
+        確定済みのファイルを読み込んで登録する（ffmpeg が書き出したセグメントなど）。
+        ファイルが存在しなければ False。
+        """
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        key = self.key_for(path)
+        if key is None:
+            return False
+        self.put(key, data)
+        return True
+
+    def mark_in_progress(self, path):
+        """書き込み中のファイルとして登録する"""
+        key = self.key_for(path)
+        if key is not None:
+            with self.lock:
+                self.in_progress_paths[key] = os.path.abspath(path)
+
+    def mark_complete(self, path):
+        key = self.key_for(path)
+        with self.lock:
+            self.in_progress_paths.pop(key, None)
+
+    def in_progress(self, key):
+        """key が書き込み中ならファイルのパスを、そうでなければ None を返す"""
+        key = normalize_key(key)
+        with self.lock:
+            return self.in_progress_paths.get(key)
+
+    def get_entry(self, key):
+        """
+        key の (データ, ETag) を返す。なければ None。
+        """
+        key = normalize_key(key)
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def get(self, key):
+        """
+        key のデータを返す。なければ None。
+        """
+        entry = self.get_entry(key)
+        return None if entry is None else entry[0]
+
+    def write_loop(self):
+        while True:
+            item = self.write_queue.get()
+            try:
+                if item is _STOP:
+                    break
+                key, data = item
+                try:
+                    write_atomic(os.path.join(self.root, *key.split("/")), data)
+                except OSError as e:
+                    print(f"セグメントストアの書き込みに失敗しました ({key}): {e}")
+            finally:
+                self.write_queue.task_done()
+
+    def flush(self):
+        """予約済みのディスク書き込みがすべて終わるまで待つ"""
+        if self.write_queue is not None:
+            self.write_queue.join()
+
+    def close(self):
+        if self.writer is not None:
+            self.write_queue.put(_STOP)
+            self.writer.join()
+            self.writer = None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "pending_writes": self.write_queue.qsize() if self.write_queue is not None else 0,
+            }
@@ -0,0 +1,212 @@
+"""
+ffprobe によるセグメントの検証。
+
+各セグメントについて、low / med / high（と合成ストリーム）のファイルを ffprobe でパケット単位に調べ、
+次を確認する。
+
+- H.264 で、デコード順の最初のパケットがキーフレーム (IDR) であること。
+- 最初のパケットより前の時刻に表示されるパケット（前のセグメントを参照するリーディングピクチャ）がないこと。
+- レイヤー間でフレーム数、各フレームのタイムスタンプ、セグメントの長さが一致すること。
+  合成ストリームはセグメントごとに時刻 0 から始まるため、セグメント先頭からの相対時刻で比べる。
+
+これらを満たすセグメントは、前後のセグメントなしで合成・キャッシュ・並列取得できる。
+
+使い方:
+    python -m src.server.segment_verifier segments/<session_id>
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import subprocess
+from fractions import Fraction
+from src.server.segment_watcher import LAYERS
+
+
+def probe_packets(path):
+    """
+    ffprobe で最初の映像ストリームのパケットを読む。
+
+    Returns:
+        dict or None: {"codec": コーデック名, "packets": [(pts 秒, 長さ 秒, キーフレームか), ...]}
+        （デコード順）。ffprobe が使えない、または解析できなければ None。
+    """
+    try:
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "v:0",
+             "-show_entries", "stream=codec_name,time_base:packet=pts,dts,duration,flags",
+             "-of", "json", path],
+            capture_output=True, text=True
+        )
+    except OSError:
+        return None
+    if result.returncode != 0:
+        return None
+    try:
+        info = json.loads(result.stdout)
+        stream = info["streams"][0]
+    except (ValueError, KeyError, IndexError):
+        return None
+
+    time_base = Fraction(stream.get("time_base", "1/1"))
+    packets = []
+    for packet in info.get("packets", []):
+        pts = packet.get("pts", packet.get("dts"))
+        if pts is None:
+            continue
+        packets.append((
+            Fraction(int(pts)) * time_base,
+            Fraction(int(packet.get("duration", 0))) * time_base,
+            "K" in packet.get("flags", ""),
+        ))
+    return {"codec": stream.get("codec_name"), "packets": packets}
+
+
+def check_independent(name, probe):
+    """
+    1 つのセグメントファイルが単独でデコードできるかを調べ、問題点のリストを返す。
+    """
+    problems = []
+    if probe["codec"] != "h264":
+        problems.append(f"{name}: コーデックが H.264 ではありません ({probe['codec']})")
+    packets = probe["packets"]
+    if not packets:
+        problems.append(f"{name}: パケットがありません")
+        return problems
+    if not packets[0][2]:
+        problems.append(f"{name}: 先頭のパケットがキーフレームではありません")
+    start = packets[0][0]
+    leading = sum(1 for pts, _, _ in packets if pts < start)
+    if leading:
+        problems.append(f"{name}: 先頭のキーフレームより前に表示されるフレームが {leading} 枚あります")
+    return problems
+
+
+def timeline(probe, relative=False):
+    """
+    表示順のタイムスタンプ（秒）と、セグメントの開始時刻・長さを返す。
+    """
+    packets = probe["packets"]
+    times = sorted(pts for pts, _, _ in packets)
+    start = times[0]
+    end = max(pts + duration for pts, duration, _ in packets)
+    if relative:
+        times = [t - start for t in times]
+    return times, start, end - start
+
+
+def compare_timelines(reference_name, reference, name, probe, relative, tolerance):
+    """
+    reference と probe のタイムスタンプを比べ、問題点のリストを返す。
+    relative=True なら開始時刻の違いは無視し、セグメント先頭からの相対時刻で比べる。
+    """
+    problems = []
+    ref_times, ref_start, ref_duration = timeline(reference, relative)
+    times, start, duration = timeline(probe, relative)
+    if len(times) != len(ref_times):
+        problems.append(f"{name}: フレーム数が {reference_name} と異なります ({len(times)} != {len(ref_times)})")
+        return problems
+    if not relative and abs(start - ref_start) > tolerance:
+        problems.append(f"{name}: 開始時刻が {reference_name} と異なります ({float(start):.6f} != {float(ref_start):.6f})")
+    mismatched = sum(1 for a, b in zip(times, ref_times) if abs(a - b) > tolerance)
+    if mismatched:
+        problems.append(f"{name}: {mismatched} フレームのタイムスタンプが {reference_name} と異なります")
+    if abs(duration - ref_duration) > tolerance:
+        problems.append(
+            f"{name}: 長さが {reference_name} と異なります ({float(duration):.6f} != {float(ref_duration):.6f})"
+        )
+    return problems
+
+
+def verify_segment(layer_dir, index, composite_dir=None, tolerance=Fraction(1, 1000), layers=LAYERS):
+    """
+    セグメント index の全レイヤー（と合成セグメント）を検証する。
+    layers は外側のリングから順のレイヤー名で、先頭のレイヤーを基準にタイムスタンプを比べる。
+
+    Returns:
+        list: 問題点の説明（空なら問題なし）
+    """
+    paths = {layer: os.path.join(layer_dir, f"{layer}_segment{index:04d}.mp4") for layer in layers}
+    if composite_dir is not None:
+        composite_path = os.path.join(composite_dir, f"segment_{index:04d}.mp4")
+        if os.path.exists(composite_path):
+            paths["composite"] = composite_path
+
+    problems = []
+    probes = {}
+    for name, path in paths.items():
+        if not os.path.exists(path):
+            problems.append(f"{name}: ファイルがありません ({path})")
+            continue
+        probe = probe_packets(path)
+        if probe is None:
+            problems.append(f"{name}: ffprobe で解析できません ({path})")
+            continue
+        problems.extend(check_independent(name, probe))
+        if probe["packets"]:
+            probes[name] = probe
+
+    reference_name = next((layer for layer in layers if layer in probes), None)
+    if reference_name is not None:
+        for name, probe in probes.items():
+            if name != reference_name:
+                problems.extend(compare_timelines(
+                    reference_name, probes[reference_name], name, probe,
+                    relative=(name == "composite"), tolerance=tolerance
+                ))
+    return problems
+
+
+def segment_indices(layer_dir, layer="low"):
+    """layer_dir にある layer（既定では low）のセグメント番号（昇順）"""
+    pattern = re.compile(rf"{re.escape(layer)}_segment(\d+)\.mp4$")
+    indices = []
+    for name in os.listdir(layer_dir):
+        match = pattern.match(name)
+        if match:
+            indices.append(int(match.group(1)))
+    return sorted(indices)
+
+
+def verify_session(session_dir, indices=None, tolerance=Fraction(1, 1000), layers=LAYERS):
+    """
+    セッションディレクトリ（segmented_video_layer と segmented_video を含む）のセグメントを検証する。
+
+    Returns:
+        dict: セグメント番号 -> 問題点のリスト
+    """
+    layer_dir = os.path.join(session_dir, "segmented_video_layer")
+    composite_dir = os.path.join(session_dir, "segmented_video")
+    if not os.path.isdir(composite_dir):
+        composite_dir = None
+    if indices is None:
+        indices = segment_indices(layer_dir, layers[0])
+    return {index: verify_segment(layer_dir, index, composite_dir, tolerance, layers) for index in indices}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="セグメントが IDR で揃い、単独でデコードできるかを ffprobe で検証する")
+    parser.add_argument("session_dir", help="segmented_video_layer を含むディレクトリ（例: segments/<session_id>）")
+    parser.add_argument("--index", type=int, action="append", help="検証するセグメント番号（複数指定可、省略時はすべて）")
+    parser.add_argument("--tolerance-ms", type=float, default=1.0, help="タイムスタンプの許容誤差（ミリ秒）")
+    parser.add_argument("--layers", default=",".join(LAYERS), help="外側のリングから順のレイヤー名（カンマ区切り）")
+    args = parser.parse_args(argv)
+
+    tolerance = Fraction(args.tolerance_ms) / 1000
+    results = verify_session(args.session_dir, args.index, tolerance, tuple(args.layers.split(",")))
+    failed = 0
+    for index, problems in results.items():
+        if problems:
+            failed += 1
+            print(f"セグメント {index:04d}: NG")
+            for problem in problems:
+                print(f"  {problem}")
+        else:
+            print(f"セグメント {index:04d}: OK")
+    print(f"{len(results)} セグメント中 {failed} セグメントに問題があります")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,255 @@
+"""
+イベント駆動のセグメント検出。
+
+レイヤーごとのセグメントリスト（{layer}_segments.csv）を、確定したセグメントの通知チャネルとして使う。
+常駐エンコーダでは ffmpeg の segment マクサーがセグメントを閉じたときに 1 行追記し、
+cv2.VideoWriter で書く場合は SegmentPipeline が書き込み完了後に同じ形式で追記する。
+CSV に載った時点でファイルは確定しているため、フレーム数だけで判断した場合のように
+書きかけのセグメントを公開・合成することはない。
+
+Linux では inotify でディレクトリの変更を待ち、それ以外の環境では CSV の stat を短い間隔で確認する。
+どちらの場合もディレクトリ全体の listdir / sort は行わず、CSV の追記分だけを読む。
+"""
+import os
+import re
+import sys
+import time
+import errno
+import threading
+import select
+import ctypes
+import ctypes.util
+from src.server.foveation_rings import DEFAULT_RINGS, ring_names
+
+# 既定のリングのレイヤー名（外側から順）
+LAYERS = ring_names(DEFAULT_RINGS)
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+SEGMENT_NUMBER = re.compile(rb"(\d+)\.mp4")
+
+
+def segment_list_path(layer_dir, layer):
+    return os.path.join(layer_dir, f"{layer}_segments.csv")
+
+
+def append_segment_list(list_path, segment_path, start, end):
+    """
+    ffmpeg の csv セグメントリストと同じ形式 (ファイル名,開始,終了) で 1 行追記する。
+    1 回の write で行全体を書くため、読み手が行の途中を確定とみなすことはない。
+    """
+    with open(list_path, "a", encoding="utf-8") as f:
+        f.write(f"{os.path.basename(segment_path)},{start:.6f},{end:.6f}\n")
+
+
+class SegmentListReader:
+    """
+    セグメントリスト CSV を前回の続きから読み、確定したセグメント番号を追跡する。
+
+    エンコーダを再起動すると ffmpeg は同じパスの CSV を切り詰めて書き直すため、次の poll までに
+    前回の読み取り位置より長くなっていることがある。ファイルの識別子 (st_dev, st_ino) と
+    先頭 HEAD_BYTES バイトを覚えておき、置き換え・縮小・先頭の変化のいずれかがあれば先頭から読み直す。
+    """
+    HEAD_BYTES = 64
+
+    def __init__(self, path):
+        self.path = path
+        self.identity = None
+        self.head = b""
+        self.offset = 0
+        self.partial = b""
+        self.next_index = 0  # 確定済みの最大番号 + 1
+
+    def reset(self, identity):
+        self.identity = identity
+        self.head = b""
+        self.offset = 0
+        self.partial = b""
+        self.next_index = 0
+
+    def poll(self):
+        """
+        追記された行を読み、確定済みの最大番号 + 1 を返す。
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return self.next_index
+        if st.st_size == self.offset and (st.st_dev, st.st_ino) == self.identity:
+            return self.next_index
+
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return self.next_index
+        with f:
+            st = os.fstat(f.fileno())
+            identity = (st.st_dev, st.st_ino)
+            if identity != self.identity or st.st_size < self.offset or f.read(len(self.head)) != self.head:
+                # 新しいセッションやエンコーダの再起動で作り直された
+                self.reset(identity)
+            f.seek(self.offset)
+            data = f.read(st.st_size - self.offset)
+        if len(self.head) < self.HEAD_BYTES:
+            self.head = (self.head + data)[:self.HEAD_BYTES]
+        self.offset += len(data)
+
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()  # 改行で終わっていない行は次回に回す
+        for line in lines:
+            match = SEGMENT_NUMBER.search(line.split(b",", 1)[0])
+            if match:
+                self.next_index = max(self.next_index, int(match.group(1)) + 1)
+        return self.next_index
+
+
+class InotifyWatch:
+    """
+    ctypes で libc の inotify を使い、ディレクトリ内のファイル変更を待つ。
+    """
+    def __init__(self, directory, mask=IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"inotify_add_watch failed: {directory}")
+
+    def wait(self, timeout):
+        """
+        イベントが届くか timeout 秒経つまで待ち、届いたイベントはすべて読み捨てる。
+
+        Returns:
+            bool: イベントが届いたかどうか
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        while True:
+            try:
+                if not os.read(self.fd, 65536):
+                    break
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def open_inotify(directory):
+    """
+    inotify が使えれば InotifyWatch を、使えなければ None を返す。
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        return InotifyWatch(directory)
+    except (OSError, AttributeError) as e:
+        print(f"inotify を利用できません（stat による確認に切り替えます）: {e}")
+        return None
+
+
+class SegmentWatcher:
+    """
+    すべてのレイヤー（既定では low / med / high）で確定したセグメント番号を検出する。
+
+    Args:
+        layer_dir (str): レイヤーセグメントのディレクトリ。
+        poll_interval (float): inotify が使えない場合に CSV を確認する間隔（秒）。
+        use_inotify (bool): False なら常に stat で確認する。
+        layers (tuple): 確定を待つレイヤー名。
+    """
+    def __init__(self, layer_dir, poll_interval=0.01, use_inotify=True, layers=LAYERS):
+        self.layer_dir = layer_dir
+        self.layers = tuple(layers)
+        os.makedirs(layer_dir, exist_ok=True)
+        self.poll_interval = poll_interval
+        self.readers = {layer: SegmentListReader(segment_list_path(layer_dir, layer)) for layer in self.layers}
+        self.inotify = open_inotify(layer_dir) if use_inotify else None
+        self.backend = "inotify" if self.inotify else "stat-poll"
+        self.ready_count = 0
+        self.detected_at = {}  # index -> 検出した時刻 (time.time())
+        # 公開するスレッドと、エンコーダを再起動する書き込みスレッドの両方から poll される
+        self.lock = threading.Lock()
+
+    def poll(self):
+        """
+        新しく 3 レイヤーとも確定したセグメント番号のリストを返す（待たない）。
+        """
+        with self.lock:
+            count = min(reader.poll() for reader in self.readers.values())
+            if count <= self.ready_count:
+                return []
+            now = time.time()
+            ready = list(range(self.ready_count, count))
+            for index in ready:
+                self.detected_at[index] = now
+            self.ready_count = count
+            return ready
+
+    def wait(self, timeout=None):
+        """
+        新しいセグメントが確定するか timeout 秒経つまで待つ。
+
+        Returns:
+            list: 新しく確定したセグメント番号（タイムアウトなら空）
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            ready = self.poll()
+            if ready:
+                return ready
+            remaining = None if deadline is None else deadline - time.perf_counter()
+            if remaining is not None and remaining <= 0:
+                return []
+            if self.inotify is not None:
+                self.inotify.wait(remaining)
+            else:
+                time.sleep(self.poll_interval if remaining is None else min(self.poll_interval, remaining))
+
+    def wait_for(self, index, timeout=None):
+        """
+        セグメント index が確定するまで待つ。
+
+        Returns:
+            bool: timeout までに確定したかどうか
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            self.poll()
+            if self.ready_count > index:
+                return True
+            remaining = None if deadline is None else deadline - time.perf_counter()
+            if remaining is not None and remaining <= 0:
+                return False
+            self.wait(remaining)
+
+    def closed_at(self, index):
+        """
+        セグメント index が閉じられた時刻（3 レイヤーのファイルの最終更新時刻の最大値）。
+        ファイルが見つからなければ検出時刻を返す。
+        """
+        try:
+            return max(
+                os.stat(os.path.join(self.layer_dir, f"{layer}_segment{index:04d}.mp4")).st_mtime
+                for layer in self.layers
+            )
+        except FileNotFoundError:
+            return self.detected_at.get(index, time.time())
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
@@ -1,41 +1,34 @@
 import cv2
 import os
-import subprocess
+import threading
 import traceback
-import datetime
 import numpy as np
+from collections import deque
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
-from src.server.foveated_compression import apply_circular_mask, save_frames_to_segments
+from src.server.foveated_compression import (
+    apply_circular_mask_roi, MaskBufferPool, save_frames_to_segments, gaze_tile_offset, save_layer_metadata,
+    layer_metadata_path
+)
+from src.server.segment_encoder import SegmentEncoder, H264FileEncoder
+from src.server.manifest import SegmentIndex, create_mpd_root, write_mpd, write_atomic, add_low_latency_elements
+from src.server.cmaf import read_init_segment, init_segment_path
+from src.server.segment_watcher import SegmentWatcher, append_segment_list, segment_list_path
+from src.server.foveation_rings import DEFAULT_RINGS, ring_names, ring_layer_config
 
 
-# グローバルバッファを初期化
-frame_buffer = []
-frame_buffer_low = []
-frame_buffer_med = []
-frame_buffer_high = []
-segment_index = 0
-segment_layer_index = 0
+# レイヤーごとの既定設定（マスク半径と CRF）
+DEFAULT_LAYER_CONFIG = ring_layer_config(DEFAULT_RINGS)
 
-frame_index = 0
-
-def apply_circular_mask(frame, center_x, center_y, radius):
+def apply_circular_mask(frame, center_x, center_y, radius, out=None, prev_roi=None):
     """
     フレームに円形マスクを適用する関数。円外の部分を黒くする。
+    キャッシュ済みのステンシルを使い、円の外接矩形だけを処理する。
+    out を指定した場合はそのバッファに書き込む（円外が 0 であること）。
     """
-    mask = np.zeros((frame.shape[0], frame.shape[1]), dtype=np.uint8)
-    #frame_height, frame_width = frame.shape[:2]
-
-    '''
-    # 中心座標がフレームの範囲内に収まるように調整
-    center_x = int(max(0, min(center_x, frame_width - 1)))
-    center_y = int(max(0, min(center_y, frame_height - 1)))
-    '''
-
-    # 円形マスクを適用
-    cv2.circle(mask, (center_x, center_y), radius, 255, -1)
-    result = cv2.bitwise_and(frame, frame, mask=mask)
-    return result
+    if out is None:
+        out = np.zeros_like(frame)
+    apply_circular_mask_roi(frame, center_x, center_y, radius, out, prev_roi)
+    return out
 
 
 def save_frame(masked_high, frame_index, output_directory):
@@ -52,210 +45,589 @@ def save_frame(masked_high, frame_index, output_directory):
     cv2.imwrite(frame_path, masked_high)
     #print(f"High frame saved: {frame_path}")
 
-def frame_segmented_with_mask(
-    frame_low, frame_med, frame_high, gaze_x, gaze_y, fps, segment_dir, segment_duration=2
-):
-    """
-    Applies masks to medium- and high-resolution frames, saves masked frames
-    along with low-resolution frames, and generates video segments.
+class SegmentPipeline:
     """
-    global frame_index
-
-    # 解像度情報を取得
-    #low_height, low_width = frame_low.shape[:2]
-    med_height, med_width = frame_med.shape[:2]
-    high_height, high_width = frame_high.shape[:2]
-
-    med_height_ratio = med_height / high_height
-    #low_height_ratio = low_height / high_height
-    med_width_ratio = med_width / high_width
-    #low_width_ratio = low_width / high_width
-    med_ratio_ave = (med_height_ratio + med_width_ratio) / 2
-
-    # Apply circular masks
-    high_radius = 100
-    med_radius = 100 #* int(med_ratio_ave)
-
-    masked_high = apply_circular_mask(frame_high, gaze_x, gaze_y, high_radius)
-    masked_med = apply_circular_mask(frame_med, int(gaze_x*med_width_ratio), int(gaze_y*med_height_ratio), med_radius)
-
-    '''
-    # フレームを保存
-    save_frame(frame_high, frame_index, output_directory="frames/original/high_frames")
-    save_frame(frame_med, frame_index, output_directory="frames/original/med_frames")
-    save_frame(frame_low, frame_index, output_directory="frames/original/low_frames")
-    save_frame(masked_high, frame_index, output_directory="frames/circle/high_frames")
-    save_frame(masked_med, frame_index, output_directory="frames/circle/med_frames")
-    frame_index += 1
-    '''
-
-    # Store frames in buffers
-    global frame_buffer_low, frame_buffer_med, frame_buffer_high, segment_layer_index
-    frame_buffer_low.append(frame_low)
-    frame_buffer_med.append(masked_med)
-    frame_buffer_high.append(masked_high)
-
-    frames_per_segment = fps * segment_duration
-    if len(frame_buffer_low) >= frames_per_segment:
-        save_frames_to_segments(frame_buffer_low, fps, "low", segment_dir, segment_layer_index=segment_layer_index)
-        save_frames_to_segments(frame_buffer_med, fps, "med", segment_dir, segment_layer_index=segment_layer_index)
-        save_frames_to_segments(frame_buffer_high, fps, "high", segment_dir, segment_layer_index=segment_layer_index)
+    1 本のストリームのセグメント生成状態をまとめたセッション。
 
-        # Clear buffers
-        frame_buffer_low.clear()
-        frame_buffer_med.clear()
-        frame_buffer_high.clear()
-
-        segment_layer_index += 1
-
-def frame_segmented(combined_frame, fps, segment_dir="segments/segmented_video", segment_duration=2):
-    """
-    合成フレームをセグメント化し、H.264/AAC形式でエンコードして保存します。
+    フレームバッファ、セグメント番号、マスク用バッファ、常駐エンコーダ、出力ディレクトリ、
+    レイヤー設定をインスタンスごとに持つため、1 つのサーバプロセスで複数のストリーム
+    （別の動画や別の視聴者）を同時に生成できる。
+    session_id を指定すると出力は root/<session_id>/ 以下に分かれる。
 
     Args:
-        combined_frame (np.ndarray): 合成されたフレーム。
-        fps (int): 動画のフレームレート。
-        segment_dir (str): セグメントファイルを保存するディレクトリ。
-        segment_duration (int): セグメントの長さ（秒単位）。
+        session_id (str): セッション名。None なら従来通り root 直下に書き出す。
+        root (str): セグメントのルートディレクトリ。
+        fps (int): フレームレート。
+        segment_duration (int): セグメントの長さ（秒）。
+        tile_size (tuple): 背景以外のレイヤーをタイルで書き出す場合の (width, height)。すべてのレイヤーで同じサイズの
+            タイルを切り出すため、背景以外のどのリングの解像度も超えてはならない（超えると ValueError）。
+        persistent_encoder (bool): 常駐 ffmpeg エンコーダを使うかどうか。
+        layer_config (dict): レイヤーごとの {"radius", "crf"}。None なら rings の設定。
+        pool_size (int): マスク済みフレームのバッファ数。None なら 1 セグメント分。
+        store (SegmentStore): 公開したセグメントと MPD を登録するメモリ上のストア（None なら使わない）。
+        low_latency (bool): 低遅延モード。セグメントを chunk_duration 秒ごとのチャンクからなる CMAF で書き、
+            書き始めた時点で MPD に載せる（persistent_encoder が必要）。
+        chunk_duration (float): 低遅延モードのチャンク長（秒）。
+        controller (FoveationController): セグメントごとにマスクするリングの半径と CRF を決めるコントローラ
+            （None なら layer_config のまま）。CRF の変更は常駐エンコーダを使い、低遅延モードでない場合だけ反映する。
+        planner (SegmentRegionPlanner): 指定すると、フレームごとの視線の代わりに、セグメントの先頭で予測した
+            1 つの領域（中心と広げた半径）でセグメント全体をマスクする。
+        rings (list): 外側から順に並べたリングの設定（src.server.foveation_rings.DEFAULT_RINGS と同じ形式）。
+            先頭のリングは背景としてそのまま、以降のリングは視線を中心とする円でマスクして書き出す。
     """
-    global frame_buffer, segment_index
+    def __init__(self, session_id=None, root="segments", fps=30, segment_duration=2, tile_size=None,
+                 persistent_encoder=False, layer_config=None, pool_size=None, store=None,
+                 low_latency=False, chunk_duration=0.2, controller=None, planner=None, rings=None):
+        if low_latency and not persistent_encoder:
+            raise ValueError("低遅延モードには persistent_encoder=True が必要です")
+        if tile_size is not None:
+            for ring in (rings or DEFAULT_RINGS)[1:]:
+                if tile_size[0] > ring["size"][0] or tile_size[1] > ring["size"][1]:
+                    raise ValueError(
+                        f"タイルサイズ {tile_size[0]}x{tile_size[1]} がレイヤー {ring['name']} の解像度 "
+                        f"{ring['size'][0]}x{ring['size'][1]} を超えています"
+                    )
+        self.session_id = session_id
+        self.root = os.path.abspath(root)
+        self.session_dir = os.path.join(self.root, session_id) if session_id else self.root
+        self.segment_dir = os.path.join(self.session_dir, "segmented_video_layer")
+        self.composite_dir = os.path.join(self.session_dir, "segmented_video")
+        self.mpd_layer_path = os.path.join(self.session_dir, "manifest_layer.mpd")
+        os.makedirs(self.segment_dir, exist_ok=True)
+
+        self.fps = fps
+        self.segment_duration = segment_duration
+        self.frames_per_segment = fps * segment_duration
+        self.tile_size = tile_size
+        self.persistent_encoder = persistent_encoder
+        self.rings = rings or DEFAULT_RINGS
+        self.layers = ring_names(self.rings)
+        self.masked_layers = self.layers[1:]
+        self.layer_config = {
+            layer: dict(config) for layer, config in (layer_config or ring_layer_config(self.rings)).items()
+        }
+
+        # レイヤーセグメントの状態
+        self.frame_buffers = {layer: [] for layer in self.layers}
+        # マスク済みレイヤーのフレームごとの視線中心とタイル位置（サイドカー JSON 用）
+        self.layer_metadata = {layer: {"centers": [], "offsets": []} for layer in self.masked_layers}
+        self.last_layer_info = None
+        self.segment_layer_index = 0
+        self.layer_frame_count = 0
+        self.layer_encoders = {}
+        self.layer_index = SegmentIndex(timescale=fps, segment_duration=segment_duration)
+
+        # 前のセッションのセグメントリストが残っていると未確定のセグメントを確定済みと誤認するため消す
+        for layer in self.layers:
+            list_path = segment_list_path(self.segment_dir, layer)
+            if os.path.exists(list_path):
+                os.remove(list_path)
+        # セグメントリストに載る（= ファイルが閉じられる）まで MPD への公開を保留する
+        self.segment_watcher = SegmentWatcher(self.segment_dir, layers=self.layers)
+        self.pending_publish = deque()
+        self.store = store
+
+        # 低遅延モードでは書き込み段が書き始めたセグメントを公開するため、マニフェスト段と排他する
+        self.low_latency = low_latency
+        self.chunk_duration = chunk_duration
+        self.publish_lock = threading.Lock()
+        self.init_written = set()
+
+        # マスク段が数えるフレーム数（書き込み段より先行するため、セグメントの区切りを別に数える）
+        self.controller = controller
+        self.planner = planner
+        self.region_plan = None
+        self.mask_frame_count = 0
+
+        # マスク済みフレームの出力バッファ
+        pool_size = pool_size or self.frames_per_segment
+        self.mask_pools = {layer: MaskBufferPool(pool_size) for layer in self.masked_layers}
+
+        # 合成フレームのセグメント状態
+        self.segment_index = 0
+        self.composite_encoder = None
+        self.composite_frame_count = 0
+
+    def get_layer_encoders(self, frames, crfs=None):
+        """
+        レイヤーごとの常駐エンコーダを返す。初回呼び出し時にフレームサイズから起動する。
+        crfs (レイヤー -> CRF) を指定したレイヤーは、layer_config の代わりにその CRF で起動する。
+        """
+        if not self.layer_encoders:
+            for layer, frame in frames.items():
+                height, width = frame.shape[:2]
+                crf = (crfs or {}).get(layer, self.layer_config[layer]["crf"])
+                self.layer_encoders[layer] = SegmentEncoder(
+                    os.path.join(self.segment_dir, f"{layer}_segment%04d.mp4"), width, height, self.fps,
+                    segment_duration=self.segment_duration, crf=crf,
+                    start_number=self.segment_layer_index,
+                    segment_list=segment_list_path(self.segment_dir, layer),
+                    chunk_duration=self.chunk_duration if self.low_latency else None
+                )
+        return self.layer_encoders
+
+    def restart_encoders_for_quality(self, layer_info):
+        """
+        セグメントの先頭で、コントローラが CRF を変えたレイヤーがあれば常駐エンコーダをすべて閉じる
+        （次の get_layer_encoders で新しい CRF で起動する）。全レイヤーを同じフレームから新しいプロセスに
+        切り替えるため、セグメント境界と IDR の位置は揃ったままになる。
+        新しい ffmpeg はセグメントリストを作り直すので、閉じて確定した直前のセグメントを先に読んでおく。
+        """
+        if not any(
+            layer in self.layer_encoders and self.layer_encoders[layer].crf != layer_info[layer]["crf"]
+            for layer in self.masked_layers
+        ):
+            return
+        for encoder in self.layer_encoders.values():
+            encoder.close()
+        self.layer_encoders = {}
+        self.segment_watcher.poll()
+
+    def next_mask_frame(self):
+        """
+        マスク段のフレームを 1 つ進める。セグメントの先頭なら、コントローラにそのセグメントの設定を決めさせ、
+        視線の領域を計画する。過負荷でドロップし、直前のマスク結果を繰り返すフレームでも呼ぶ。
+        """
+        if self.mask_frame_count % self.frames_per_segment == 0:
+            index = self.mask_frame_count // self.frames_per_segment
+            if self.controller is not None:
+                config = self.controller.decide(index)
+                for layer, settings in config.items():
+                    if layer in self.layer_config:
+                        self.layer_config[layer].update(settings)
+            if self.planner is not None:
+                self.region_plan = self.planner.plan_segment(
+                    index, self.frames_per_segment, self.layer_config[self.layers[-1]]["radius"]
+                )
+        self.mask_frame_count += 1
+
+    def layer_segment_path(self, layer, index):
+        return os.path.join(self.segment_dir, f"{layer}_segment{index:04d}.mp4")
+
+    def append_segment_lists(self, frame_count):
+        """
+        cv2.VideoWriter で書き終えたセグメントを、ffmpeg と同じ形式でセグメントリストに追記する。
+        """
+        start = self.segment_layer_index * self.segment_duration
+        for layer in self.layers:
+            append_segment_list(
+                segment_list_path(self.segment_dir, layer), f"{layer}_segment{self.segment_layer_index:04d}.mp4",
+                start, start + frame_count / self.fps
+            )
+
+    def close(self):
+        """
+        常駐エンコーダを終了し、書きかけのセグメントを確定させる。
+        """
+        for encoder in self.layer_encoders.values():
+            encoder.close()
+        self.layer_encoders = {}
+        if self.composite_encoder is not None:
+            self.composite_encoder.close()
+            self.composite_encoder = None
+        # 以降に確定を待つ場合は stat による確認になる
+        self.segment_watcher.close()
+
+    def mask_layers(self, frames, gaze_x, gaze_y):
+        """
+        Applies circular masks around the gaze point to every ring except the
+        outermost (background) one.
+
+        frames holds one frame per ring, outermost first, and the gaze point is
+        given in the coordinates of the innermost ring. Masked frames are
+        written into the session's reused pool buffers. Returns
+        (layer_frames, layer_info), where layer_frames maps each layer to its
+        frame to encode, and layer_info maps each masked layer to the gaze
+        center and radius in that layer's coordinates, the full layer size,
+        and the tile offset (None unless in tile mode).
+        """
+        self.next_mask_frame()
+
+        # 解像度情報を取得（視線座標は最も内側のリングの座標系）
+        inner_height, inner_width = frames[-1].shape[:2]
+        expansion = 0
+
+        if self.planner is not None:
+            # 実際の視線は予測の更新とヒット率の集計に使い、マスクはセグメントで共通の計画した領域で行う
+            self.planner.observe(gaze_x, gaze_y)
+            if self.region_plan is not None:
+                gaze_x, gaze_y = self.region_plan["center"]
+                expansion = self.region_plan["expansion"]
+
+        layer_frames = {self.layers[0]: frames[0]}
+        layer_info = {}
+        for layer, frame in zip(self.masked_layers, frames[1:]):
+            height, width = frame.shape[:2]
+            width_ratio = width / inner_width
+            height_ratio = height / inner_height
+            x, y = int(gaze_x*width_ratio), int(gaze_y*height_ratio)
+            radius = self.layer_config[layer]["radius"] + int(round(expansion * width_ratio))
+            info = {"center": (x, y), "radius": radius, "frame_size": (width, height), "offset": None,
+                    "crf": self.layer_config[layer]["crf"]}
+
+            if self.tile_size is None:
+                layer_frames[layer] = self.mask_pools[layer].mask(frame, x, y, radius)
+            else:
+                # 視線周辺のタイルだけを切り出し、タイル座標系でマスクする
+                x0, y0 = gaze_tile_offset(frame.shape, x, y, self.tile_size)
+                tile_w, tile_h = self.tile_size
+                layer_frames[layer] = self.mask_pools[layer].mask(
+                    frame[y0:y0 + tile_h, x0:x0 + tile_w], x - x0, y - y0, radius
+                )
+                info["offset"] = (x0, y0)
+            layer_info[layer] = info
+        return layer_frames, layer_info
+
+    def save_layer_metadata(self):
+        """
+        蓄積したフレームごとの視線中心・タイル位置をサイドカー JSON に書き出してクリアする。
+        """
+        if self.last_layer_info is None:
+            return
+        for layer, metadata in self.layer_metadata.items():
+            if not metadata["centers"]:
+                continue
+            info = self.last_layer_info[layer]
+            save_layer_metadata(
+                layer, self.segment_dir, self.segment_layer_index, info["frame_size"], info["radius"],
+                metadata["centers"], tile_size=self.tile_size, offsets=metadata["offsets"]
+            )
+            metadata["centers"].clear()
+            metadata["offsets"].clear()
+
+    def write_layer_frames(self, layer_frames, layer_info=None):
+        """
+        Buffers (or streams) one frame of each layer (layer_frames maps each
+        layer to its frame, as returned by mask_layers) and writes the layer
+        segments once a segment's worth of frames has been collected.
+
+        Returns the index of the segment that was completed by this frame, or None.
+        """
+        if layer_info is not None:
+            self.last_layer_info = layer_info
+            for layer, metadata in self.layer_metadata.items():
+                metadata["centers"].append(layer_info[layer]["center"])
+                metadata["offsets"].append(layer_info[layer]["offset"])
+
+        frames = layer_frames
+        if self.persistent_encoder:
+            crfs = None
+            if layer_info is not None and not self.low_latency:
+                crfs = {layer: info["crf"] for layer, info in layer_info.items()}
+                if self.layer_frame_count == 0:
+                    self.restart_encoders_for_quality(layer_info)
+            for layer, encoder in self.get_layer_encoders(frames, crfs).items():
+                encoder.write(frames[layer])
+            self.layer_frame_count += 1
+            if self.low_latency and self.layer_frame_count == 1:
+                self.announce_segment(self.segment_layer_index)
+        else:
+            for layer, frame in frames.items():
+                self.frame_buffers[layer].append(frame)
+            self.layer_frame_count = len(self.frame_buffers[self.layers[0]])
+
+        if self.layer_frame_count < self.frames_per_segment:
+            return None
+
+        if not self.persistent_encoder:
+            for layer, buffer in self.frame_buffers.items():
+                save_frames_to_segments(buffer, self.fps, layer, self.segment_dir, segment_layer_index=self.segment_layer_index)
+            self.append_segment_lists(self.layer_frame_count)
+        self.save_layer_metadata()
 
-    # セグメントディレクトリを絶対パスに変換
-    segment_dir = os.path.abspath(segment_dir)
-    os.makedirs(segment_dir, exist_ok=True)  # ディレクトリを作成
-
-    # 回転と反転の処理
-    #combined_frame = cv2.flip(combined_frame, 1)
-    combined_frame = cv2.rotate(combined_frame, cv2.ROTATE_90_CLOCKWISE)  # 90度時計回り
-    combined_frame = cv2.flip(combined_frame, 1)  # 左右反転
-
-    frames_per_segment = fps * segment_duration
-    frame_buffer.append(combined_frame)
+        # Clear buffers
+        for buffer in self.frame_buffers.values():
+            buffer.clear()
+        self.layer_frame_count = 0
+
+        completed_index = self.segment_layer_index
+        self.segment_layer_index += 1
+        return completed_index
+
+    def flush(self):
+        """
+        書きかけのレイヤーセグメントを確定させる（ストリーム終了時に使う）。
+
+        Returns:
+            tuple or None: (セグメント番号, フレーム数)。書きかけのセグメントがなければ None。
+        """
+        frame_count = self.layer_frame_count
+        if frame_count == 0:
+            self.close()
+            return None
+
+        if self.persistent_encoder:
+            # 標準入力を閉じると ffmpeg が最後のセグメントを書き出す
+            self.close()
+        else:
+            for layer, buffer in self.frame_buffers.items():
+                save_frames_to_segments(buffer, self.fps, layer, self.segment_dir, segment_layer_index=self.segment_layer_index)
+                buffer.clear()
+            self.append_segment_lists(frame_count)
+        self.save_layer_metadata()
+
+        completed_index = self.segment_layer_index
+        self.segment_layer_index += 1
+        self.layer_frame_count = 0
+        return completed_index, frame_count
+
+    def frame_segmented_with_mask(self, frames, gaze_x, gaze_y):
+        """
+        Applies masks to every ring but the background one (frames holds one
+        frame per ring, outermost first), saves the masked frames along with
+        the background frame, and generates video segments.
+
+        If persistent_encoder is True, frames are streamed to one long-lived ffmpeg
+        process per layer that writes keyframe-aligned H.264 segments itself,
+        instead of buffering a segment and writing it with cv2.VideoWriter.
+
+        If tile_size (width, height) is given, the masked layers are encoded as a
+        fixed-size tile around the gaze point instead of the full frame, and the
+        per-frame tile offsets are added to the JSON sidecar written next to
+        each masked segment (which always records the per-frame gaze centers).
+        """
+        layer_frames, layer_info = self.mask_layers(frames, gaze_x, gaze_y)
+        return self.write_layer_frames(layer_frames, layer_info)
+
+    def publish(self, completed_index, frame_count=None, timeout=0):
+        """
+        完成したレイヤーセグメントをインデックスに追加し、MPD を更新する。
+        frame_count を指定すると、そのフレーム数の長さのセグメントとして記述する（最後の短いセグメント用）。
+
+        常駐エンコーダは必要なフレーム数を受け取った後、次のフレームが届いてからセグメントを閉じるため、
+        全レイヤーのセグメントリストに載るまでは公開を保留する。timeout 秒待っても確定しなければ
+        保留したまま返り、以降の publish / publish_finalized で公開される。
+
+        Returns:
+            list: 今回公開したセグメント番号
+        """
+        self.pending_publish.append((completed_index, frame_count))
+        return self.publish_finalized(timeout)
+
+    def store_segment(self, index):
+        """
+        確定したレイヤーセグメントとサイドカー JSON をストアに読み込む。
+        ffmpeg が閉じた直後でページキャッシュにあるうちに 1 回だけ読み、以降の配信はメモリから行う。
+        """
+        for layer in self.layers:
+            segment_path = self.layer_segment_path(layer, index)
+            self.store.put_file(segment_path)
+            self.store.mark_complete(segment_path)
+            if layer in self.layer_metadata:
+                self.store.put_file(layer_metadata_path(segment_path))
+
+    def observe_segment(self, index, frame_count=None):
+        """確定したセグメントのレイヤーごとのサイズをコントローラに渡す"""
+        layer_bytes = {}
+        for layer in self.layers:
+            try:
+                layer_bytes[layer] = os.path.getsize(self.layer_segment_path(layer, index))
+            except OSError:
+                return
+        self.controller.observe(index, layer_bytes, (frame_count or self.frames_per_segment) / self.fps)
+
+    def write_init_segments(self):
+        """
+        低遅延モード：最初のセグメントの ftyp + moov を初期化セグメントとして書き出す。
+        ffmpeg がまだ moov を書いていなければ、次の呼び出しで再試行する。
+        """
+        first_index = self.layer_index.start_number if self.layer_index.start_number is not None else 0
+        for layer in self.layers:
+            if layer in self.init_written:
+                continue
+            data = read_init_segment(self.layer_segment_path(layer, first_index))
+            if data is None:
+                continue
+            init_path = init_segment_path(self.segment_dir, layer)
+            write_atomic(init_path, data)
+            if self.store is not None:
+                self.store.put(self.store.key_for(init_path), data)
+            self.init_written.add(layer)
+
+    def announce_segment(self, index):
+        """
+        低遅延モード：書き始めたセグメントを MPD に載せ、HTTP サーバには書き込み中として登録する。
+        MPD の availabilityTimeOffset により、プレーヤーは完成前からチャンクを取得し始める。
+        """
+        if self.store is not None:
+            for layer in self.layers:
+                self.store.mark_in_progress(self.layer_segment_path(layer, index))
+        with self.publish_lock:
+            self.write_init_segments()
+            self.layer_index.append(index)
+            self.write_layer_mpd()
+
+    def write_layer_mpd(self):
+        generate_mpd_layer(
+            segment_dir=self.segment_dir, mpd_path=self.mpd_layer_path, fps=self.fps,
+            tile_size=self.tile_size, segment_index=self.layer_index, segment_duration=self.segment_duration,
+            store=self.store, chunk_duration=self.chunk_duration if self.low_latency else None, rings=self.rings
+        )
 
-    # フレームが規定数に達したらセグメントを保存
-    if len(frame_buffer) >= frames_per_segment:
-        raw_segment_path = os.path.join(segment_dir, f"segment_{segment_index:04d}_raw.mp4")
-        encoded_segment_path = os.path.join(segment_dir, f"segment_{segment_index:04d}.mp4")
+    def publish_finalized(self, timeout=0):
+        """
+        保留中のセグメントのうち、確定したものを番号順に公開する。
+        低遅延モードでは書き始めた時点で MPD に載っているため、ここではストアへの登録と
+        （最後の短いセグメントの）長さの更新だけを行う。
+        """
+        published = []
+        # 確定を待つ間はロックを持たない（書き込み段が次のフレームを送らないとセグメントが閉じられない）
+        while self.pending_publish:
+            index, frame_count = self.pending_publish[0]
+            if not self.segment_watcher.wait_for(index, timeout):
+                break
+            self.pending_publish.popleft()
+            if self.store is not None:
+                self.store_segment(index)
+            if self.controller is not None:
+                self.observe_segment(index, frame_count)
+            with self.publish_lock:
+                self.layer_index.append(index, duration=frame_count)
+            published.append(index)
+
+        if published:
+            with self.publish_lock:
+                if self.low_latency:
+                    self.write_init_segments()
+                self.write_layer_mpd()
+        return published
+
+    def frame_segmented(self, combined_frame):
+        """
+        合成フレームをセグメント化し、H.264 でエンコードして保存します。
+        persistent_encoder が True の場合は常駐 ffmpeg が分割まで行い、False の場合は
+        セグメントごとに H264FileEncoder を起動する。どちらもフレームを直接エンコーダに流し込む。
+
+        Args:
+            combined_frame (np.ndarray): 合成されたフレーム。
+
+        Returns:
+            bool: このフレームでセグメントが完成した場合 True。
+        """
+        os.makedirs(self.composite_dir, exist_ok=True)  # ディレクトリを作成
+        fps = self.fps
+        frames_per_segment = self.frames_per_segment
+
+        if self.persistent_encoder:
+            if self.composite_encoder is None:
+                height, width = combined_frame.shape[:2]
+                self.composite_encoder = SegmentEncoder(
+                    os.path.join(self.composite_dir, "segment_%04d.mp4"), width, height, fps,
+                    segment_duration=self.segment_duration, start_number=self.segment_index,
+                    segment_list=os.path.join(self.composite_dir, "segments.csv")
+                )
+            self.composite_encoder.write(combined_frame)
+            self.composite_frame_count += 1
+            if self.composite_frame_count >= frames_per_segment:
+                self.composite_frame_count = 0
+                self.segment_index += 1
+                return True
+            return False
 
-        # OpenCVを使って未エンコードの動画を保存
+        # 1 セグメントごとに H.264 エンコーダを起動し、フレームを直接流し込む
+        # （mp4v の一時ファイル、再エンコード、transpose で打ち消される回転・反転は行わない）
+        encoded_segment_path = os.path.join(self.composite_dir, f"segment_{self.segment_index:04d}.mp4")
         try:
-            height, width, _ = frame_buffer[0].shape
-            out = cv2.VideoWriter(raw_segment_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
-            for frame in frame_buffer:
-                out.write(frame)
-            out.release()
-
-            print(f"未エンコードセグメントを保存しました: {raw_segment_path}")
-
-            # ファイルの存在確認
-            if not os.path.exists(raw_segment_path):
-                raise FileNotFoundError(f"未エンコードファイルが見つかりません: {raw_segment_path}")
+            if self.composite_encoder is None:
+                height, width = combined_frame.shape[:2]
+                self.composite_encoder = H264FileEncoder(encoded_segment_path, width, height, fps)
+            self.composite_encoder.write(combined_frame)
         except Exception as e:
-            print(f"セグメント保存エラー: {raw_segment_path}")
+            print(f"セグメント保存エラー: {encoded_segment_path}")
             print(traceback.format_exc())
-            frame_buffer.clear()
             return False
+        self.composite_frame_count += 1
 
-        # ffmpegを使ってH.264/AAC形式にエンコード
-        try:
-            # ffmpegでH.264/AACに変換 + 90度回転
-            command = [
-                "ffmpeg",
-                "-i", raw_segment_path,
-                "-vf", "transpose=0",
-                "-c:v", "libx264",
-                "-preset", "fast",
-                "-c:a", "aac",
-                "-strict", "experimental",
-                encoded_segment_path,
-                "-y"
-            ]
-
-            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-            # ffmpegのエラーチェック
-            if result.returncode != 0:
-                print(f"ffmpegエラー: {result.stderr}")
-                raise subprocess.CalledProcessError(result.returncode, command)
-
-            print(f"エンコード済みセグメントを保存しました: {encoded_segment_path}")
-        except Exception as e:
-            print(f"エンコード中にエラーが発生しました: {encoded_segment_path}")
-            print(traceback.format_exc())
-        finally:
-            # 一時的な未エンコードファイルを削除
-            if os.path.exists(raw_segment_path):
-                os.remove(raw_segment_path)
+        # フレームが規定数に達したらセグメントを確定
+        if self.composite_frame_count >= frames_per_segment:
+            if self.composite_encoder.close():
+                print(f"エンコード済みセグメントを保存しました: {encoded_segment_path}")
+            self.composite_encoder = None
+            self.composite_frame_count = 0
+            self.segment_index += 1
+            return True
 
-        # フレームバッファをクリアし、次のセグメントの準備
-        frame_buffer.clear()
-        segment_index += 1
-        return True
+        return False
 
-    return False
 
+def generate_mpd_layer(segment_dir="segments/segmented_video_layer", mpd_path="segments/manifest_layer.mpd", fps=30, tile_size=None,
+                       segment_index=None, segment_duration=2, store=None, chunk_duration=None, target_latency=None,
+                       rings=None):
+    """
+    レイヤーセグメントの MPD を生成する。
+    レイヤー（AdaptationSet）は rings（None なら DEFAULT_RINGS）の順に、各リングの解像度とビットレートで記述する。
+    tile_size を指定した場合、背景以外のレイヤーはタイルの解像度で記述し、
+    元のフレーム内の位置はセグメントごとのサイドカー JSON を参照するよう記述する。
+
+    segment_index (SegmentIndex) を渡した場合はディレクトリを走査せず、そのインデックスから
+    SegmentTemplate / SegmentTimeline を生成する。全レイヤーは同じ番号で書き出されるため共通。
 
-def generate_mpd_layer(segment_dir="segments/segmented_video_layer", mpd_path="segments/manifest_layer.mpd", fps=30):
+    chunk_duration を指定した場合は低遅延 (LL-DASH) の MPD にする。初期化セグメントを指定し、
+    availabilityTimeOffset でセグメントの完成より (segment_duration - chunk_duration) 秒早く
+    取得を始められることを示す。target_latency [秒] は ServiceDescription の目標遅延。
+    """
     segment_dir = os.path.abspath(segment_dir)
     mpd_path = os.path.abspath(mpd_path)
-    os.makedirs(os.path.dirname(mpd_path), exist_ok=True)
+
+    rings = rings or DEFAULT_RINGS
+    if segment_index is None:
+        segment_index = SegmentIndex.from_directory(
+            segment_dir, rf"{rings[0]['name']}_segment(\d+)\.mp4$", fps, segment_duration
+        )
 
     # MPDの基本構造
-    mpd = ET.Element("MPD", attrib={
-        "xmlns": "urn:mpeg:dash:schema:mpd:2011",
-        "profiles": "urn:mpeg:dash:profile:isoff-on-demand:2011",
-        "type": "dynamic",
-        "minBufferTime": "PT1.5S",
-        "availabilityStartTime": datetime.datetime.utcnow().isoformat() + "Z",
-        "publishTime": datetime.datetime.utcnow().isoformat() + "Z"
-    })
+    mpd = create_mpd_root(segment_index.availability_start)
 
     period = ET.SubElement(mpd, "Period", attrib={"id": "1", "start": "PT0S"})
 
-    # 解像度とビットレートを定義
+    # 解像度とビットレートはリングの設定から取る
     layer_configs = {
-        "low": {"resolution": "640x360", "bitrate": "500k"},
-        "med": {"resolution": "960x540", "bitrate": "1500k"},
-        "high": {"resolution": "1920x1080", "bitrate": "3000k"}
+        ring["name"]: {"resolution": f"{ring['size'][0]}x{ring['size'][1]}", "bitrate": f"{ring['bandwidth'] // 1000}k"}
+        for ring in rings
     }
 
     # 各レイヤーのAdaptationSetとRepresentationを作成
     for layer, config in layer_configs.items():
+        width, height = config["resolution"].split("x")
+        tiled = tile_size is not None and layer != rings[0]["name"]
+        if tiled:
+            width, height = str(tile_size[0]), str(tile_size[1])
+
         adaptation_set = ET.SubElement(period, "AdaptationSet", attrib={
             "mimeType": "video/mp4",
             "codecs": "avc1.42E01E",
-            "width": config["resolution"].split("x")[0],
-            "height": config["resolution"].split("x")[1],
+            "width": width,
+            "height": height,
             "frameRate": str(fps),
             "bandwidth": config["bitrate"]
         })
 
+        if tiled:
+            # タイルの配置はフレームごとに変わるため、サイドカー JSON のテンプレートを示す
+            ET.SubElement(adaptation_set, "SupplementalProperty", attrib={
+                "schemeIdUri": "urn:foveated-compression:gaze-tile:2024",
+                "value": f"{width},{height},{config['resolution'].replace('x', ',')}",
+                "metadata": f"segmented_video_layer/{layer}_segment$Number%04d$.json"
+            })
+
         representation = ET.SubElement(adaptation_set, "Representation", attrib={
             "id": layer,
             "bandwidth": config["bitrate"],
-            "width": config["resolution"].split("x")[0],
-            "height": config["resolution"].split("x")[1],
+            "width": width,
+            "height": height,
             "frameRate": str(fps)
         })
 
-        segment_list = ET.SubElement(representation, "SegmentList", attrib={
-            "timescale": str(fps),
-            "duration": str(2 * fps)  # 2秒ごと
-        })
-
-        # セグメントリストを作成
-        segment_files = sorted(
-            [f for f in os.listdir(segment_dir) if f.startswith(f"{layer}_segment") and f.endswith(".mp4")]
-        )
-        for segment_file in segment_files:
-            ET.SubElement(segment_list, "SegmentURL", attrib={"media": f"segmented_video_layer/{segment_file}"})
+        template = segment_index.add_template(representation, f"segmented_video_layer/{layer}_segment$Number%04d$.mp4")
+        if chunk_duration:
+            template.set("initialization", f"segmented_video_layer/{layer}_init.mp4")
+            template.set("availabilityTimeOffset", f"{segment_duration - chunk_duration:g}")
+            template.set("availabilityTimeComplete", "false")
 
-    # 整形してファイルに書き込む
-    rough_string = ET.tostring(mpd, 'utf-8')
-    reparsed = minidom.parseString(rough_string)
-    pretty_xml_as_string = reparsed.toprettyxml(indent="  ")
+    if chunk_duration:
+        add_low_latency_elements(mpd, target_latency or max(1.0, 5 * chunk_duration))
 
-    with open(mpd_path, "w", encoding="utf-8") as f:
-        f.write(pretty_xml_as_string)
+    # 一時ファイル経由で書き込む
+    write_mpd(mpd, mpd_path, store=store)
 
-    print(f"Layer Segments MPD ファイルを生成しました: {mpd_path}")
\ No newline at end of file
+    print(f"Layer Segments MPD ファイルを生成しました: {mpd_path}")
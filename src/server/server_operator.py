@@ -1,6 +1,10 @@
 """
 セグメントが独立してデコードできるため、用意する動画のフレームはIフレームのみにし、P,Bフレームは取り扱わないのが
 最も好ましい。しかし、現在は全てのフレームを参照するようになっている。
+常駐エンコーダ (persistent_encoder=True) では、各レイヤーと合成ストリームのセグメントを IDR から始まる
+closed GOP にし、境界とタイムスタンプを全レイヤーで揃える（segment_encoder.idr_alignment_args）。
+P フレームはセグメント内でしか参照しないため、セグメント単位では独立してデコードできる。
+検証は python -m src.server.segment_verifier segments/<session_id> で行う。
 """
 
 import pygame
@@ -8,125 +12,281 @@ import cv2
 import threading
 import os
 import src.client.browser_launcher as browser_launcher
-import random
 import time
 import numpy as np
 import pygetwindow as gw
 from src.server.foveated_compression import merge_frame
-from src.server.server_function import frame_segmented, generate_mpd_layer, frame_segmented_with_mask
-from src.server.mpeg_server import setup_web_server
-from src.server.log_writing import log_gaze_positions
+from src.server.server_function import SegmentPipeline
+from src.server.pipeline import Pipeline
+from src.server.frame_clock import FrameClock
+from src.server.mpeg_server import setup_web_server, ThroughputMeter
+from src.server.foveation_controller import FoveationController, decision_log_path
+from src.server.gaze_prediction import SegmentRegionPlanner
+from src.server.segment_store import SegmentStore
+from src.server.frame_source import PipedFrameSource, RenditionFileSource
+from src.server.foveation_rings import DEFAULT_RINGS
+from src.server.log_writing import GazeLogWriter, gaze_log_path
+from src.server.gaze_source import create_gaze_source
 from src.client.client_player import create_client_player
 from src.client.browser_launcher import open_chrome
 
+# 過負荷でドロップしたフレームの代わりに、直前の出力フレームを繰り返すことを示す
+REPEAT_FRAME = object()
+
 class VideoStreaming:
-    def __init__(self, input_video, low_res_path, med_res_path, high_res_path):
-        self.low_cap = cv2.VideoCapture(low_res_path)
-        self.med_cap = cv2.VideoCapture(med_res_path)
-        self.high_cap = cv2.VideoCapture(high_res_path)
-        self.cap = cv2.VideoCapture(input_video)
+    def __init__(self, input_video, low_res_path=None, med_res_path=None, high_res_path=None, session_id=None,
+                 low_latency=False, adaptive_foveation=False, target_bitrate=4000000, gaze_prediction=False,
+                 tile_size=None, gaze_model="random_walk", gaze_seed=None, gaze_replay_path=None):
+        # 外側から順に並べたフォビエーションのリング（レイヤー）。名前・解像度・半径・CRF・ビットレートを持つ
+        self.rings = DEFAULT_RINGS
+        # レンディションファイルが指定されていればそれを読み（low / med / high の 3 リングのみ）、
+        # なければ入力を直接パイプでデコードしてリングごとのフレームを作る
+        if low_res_path and med_res_path and high_res_path:
+            self.source = RenditionFileSource(low_res_path, med_res_path, high_res_path)
+        else:
+            self.source = PipedFrameSource(input_video, rings=self.rings)
 
-        if not self.cap.isOpened():
+        if not self.source.isOpened():
             raise ValueError(f"動画ファイルを開けませんでした: {input_video}")
 
-        self.window_width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        self.window_height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.window_width = self.source.width
+        self.window_height = self.source.height
 
         print(f"Video resolution: {self.window_width}x{self.window_height}")
 
-        # MPEG-DASH 用の初期設定
-        self.segment_layer_dir = os.path.abspath("segments/segmented_video_layer")  # 絶対パスを設定
-        os.makedirs(self.segment_layer_dir, exist_ok=True)
-        print(f"レイヤーセグメントディレクトリ: {self.segment_layer_dir}")
-
-        self.fps = 30
+        # セグメント計算には整数のフレームレートを使い、クロックはソースの実フレームレートで刻む
+        self.fps = int(round(self.source.fps)) or 30
         self.frame_counter = 0
-        self.gaze_positions = []  # 各フレームごとの疑似視線位置を記録するリスト
         self.segment_index = 0  # セグメント番号を管理
+        # 背景以外のリングをタイルとして書き出す場合のタイルサイズ (width, height)。None ならフレーム全体
+        self.tile_size = tile_size
+        # True の場合、レイヤーごとの常駐 ffmpeg が H.264 セグメントを直接書き出す
+        self.persistent_encoder = True
+        # パイプラインの各段の間のキュー長。満杯時に読み込みフレームを捨てるか（False なら待つ）
+        self.queue_size = 8
+        self.drop_frames_when_full = False
+        self.pipeline = None
+        # 実時間で出力するか、終端でループするか、どれだけ遅れたらドロップで追いつくか
+        self.realtime = True
+        self.loop = True
+        # True の場合、レイヤーセグメントを chunk_duration 秒ごとのチャンク (CMAF) で書き、
+        # 書き始めた時点で MPD に載せて chunked transfer で配信する（LL-DASH）
+        self.low_latency = low_latency
+        self.chunk_duration = 0.2
+        self.clock = FrameClock(self.source.fps or self.fps, max_lag_frames=5)
+        # 疑似視線のモデル（"random_walk", "saccade", "replay"）と乱数のシード。replay では gaze_replay_path のログを再生する
+        self.gaze_model = gaze_model
+        self.gaze_seed = gaze_seed
+        self.gaze_replay_path = gaze_replay_path
+        self.gaze_source = create_gaze_source(
+            self.gaze_model, self.window_width, self.window_height, fps=self.fps,
+            seed=self.gaze_seed, log_path=self.gaze_replay_path
+        )
+        self.gaze_x = self.window_width // 2
+        self.gaze_y = self.window_height // 2
+        # True の場合、配信スループットに合わせてセグメントごとに med / high の半径と CRF を選ぶ（target_bitrate は上限 bps）
+        self.adaptive_foveation = adaptive_foveation
+        self.target_bitrate = target_bitrate
+        self.throughput_meter = ThroughputMeter()
+        # True の場合、視線の軌跡から予測した 1 つの領域でセグメント全体をマスクする（ヒット率は終了時に表示）
+        self.gaze_prediction = gaze_prediction
+        self.last_masked = None
+
+        # MPEG-DASH 用の初期設定（セッションごとに segments/<session_id>/ 以下へ書き出す）
+        # 書き込み段に渡るまでに滞留しうるフレーム数以上のマスク用バッファを確保する
+        # 公開したセグメントと MPD はメモリ上のストアから配信する（MPD はディスクにも書き戻す）
+        self.segment_store = SegmentStore(root="segments", max_bytes=256 * 1024 * 1024, write_behind=True)
+        session_dir = os.path.join("segments", session_id) if session_id else "segments"
+        self.foveation_controller = None
+        if self.adaptive_foveation:
+            self.foveation_controller = FoveationController(
+                self.target_bitrate, throughput=self.throughput_meter.throughput,
+                log_path=decision_log_path(session_dir), rings=self.rings
+            )
+        self.region_planner = None
+        if self.gaze_prediction:
+            self.region_planner = SegmentRegionPlanner((self.window_width, self.window_height))
+        self.segment_pipeline = SegmentPipeline(
+            session_id=session_id, root="segments", fps=self.fps, segment_duration=2,
+            tile_size=self.tile_size, persistent_encoder=self.persistent_encoder,
+            pool_size=self.fps * 2 + 2 * self.queue_size + 4, store=self.segment_store,
+            low_latency=self.low_latency, chunk_duration=self.chunk_duration,
+            controller=self.foveation_controller, planner=self.region_planner, rings=self.rings
+        )
+        self.segment_layer_dir = self.segment_pipeline.segment_dir
+        print(f"レイヤーセグメントディレクトリ: {self.segment_layer_dir}")
+        # フレームごとの疑似視線位置をセッションのバイナリログに追記する
+        # （ログはセッションごとに作り直すため、再生中のログと同じパスには書かない）
+        log_path = gaze_log_path(self.segment_pipeline.session_dir)
+        if self.gaze_replay_path and os.path.abspath(self.gaze_replay_path) == os.path.abspath(log_path):
+            raise ValueError(f"再生する視線ログは別のセッションのものを指定してください: {self.gaze_replay_path}")
+        self.gaze_log = GazeLogWriter(log_path)
 
         # サーバとブラウザを別スレッドで起動
         self.start_web_server()
         self.start_browser()
 
     def start_web_server(self):
-        server_thread = threading.Thread(target=setup_web_server, args=("segments",), daemon=True)
+        server_thread = threading.Thread(
+            target=setup_web_server, args=("segments",),
+            kwargs={"store": self.segment_store, "meter": self.throughput_meter}, daemon=True
+        )
         server_thread.start()
 
     def start_browser(self):
-        browser_thread = threading.Thread(target=open_chrome, args=("http://localhost:8080/player.html",), daemon=True)
+        url = "http://localhost:8080/player.html"
+        if self.low_latency:
+            # 低遅延モードは dash.js の低遅延設定を有効にしたプレーヤーでレイヤー MPD を再生する
+            mpd_url = "http://localhost:8080/" + os.path.relpath(
+                self.segment_pipeline.mpd_layer_path, self.segment_store.root
+            ).replace(os.sep, "/")
+            create_client_player(output_dir="segments", mpd_url=mpd_url, low_latency=True,
+                                 target_latency=max(1.0, 5 * self.chunk_duration))
+            url = "http://localhost:8080/player_ll.html"
+        browser_thread = threading.Thread(target=open_chrome, args=(url,), daemon=True)
         browser_thread.start()
 
-    def generate_gaze_position(self, max_speed=15):
-        """疑似視線の位置をランダムに決定する関数"""
-        # 前回の視線位置を取得
-        prev_x = getattr(self, 'gaze_x', self.window_width // 2)
-        prev_y = getattr(self, 'gaze_y', self.window_height // 2)
+    def generate_gaze_position(self):
+        """疑似視線の次の位置を視線入力 (gaze_source) から取り出す"""
+        self.gaze_x, self.gaze_y = self.gaze_source.next_position()
+        return self.gaze_x, self.gaze_y
 
-        # 視線が自然に移動する範囲内で次の位置を計算
-        self.gaze_x = max(0, min(prev_x + random.randint(-max_speed, max_speed), self.window_width - 1))
-        self.gaze_y = max(0, min(prev_y + random.randint(-max_speed, max_speed), self.window_height - 1))
+    def mask_stage(self, item):
+        """パイプラインのマスク段：背景以外のリングに円形マスクを適用する"""
+        if item is REPEAT_FRAME:
+            # ドロップしたフレームは直前のマスク結果を繰り返す（セグメントの区切りを数えるためフレームは進める）
+            self.segment_pipeline.next_mask_frame()
+            return self.last_masked
+        frames, gaze_x, gaze_y = item
+        self.last_masked = self.segment_pipeline.mask_layers(frames, gaze_x, gaze_y)
+        return self.last_masked
 
-        return self.gaze_x, self.gaze_y
+    def write_stage(self, item):
+        """パイプラインの書き込み段：レイヤーセグメントをエンコード・保存する"""
+        layer_frames, layer_info = item
+        return self.segment_pipeline.write_layer_frames(layer_frames, layer_info)
+
+    def manifest_stage(self, completed_index, frame_count=None):
+        """
+        パイプラインのマニフェスト段：セグメントが確定（ファイルが閉じられる）ごとに MPD を更新する。
+        常駐エンコーダは次のフレームを受け取ってからセグメントを閉じるため、最大 1 セグメント分待つ。
+        """
+        published = self.segment_pipeline.publish(
+            completed_index, frame_count, timeout=self.segment_pipeline.segment_duration
+        )
+        for index in published:
+            live_edge_lag = self.clock.segment_lag(index, self.segment_pipeline.segment_duration)
+            print(
+                f"Segment {index:04d} published (live edge lag {live_edge_lag:+.2f}s, "
+                f"dropped {self.clock.dropped}). {self.pipeline.format_stats()}"
+            )
+        return None
+
+    def record_frame(self, gaze_x, gaze_y):
+        """フレームごとの視線ログとカウンタを更新する"""
+        # 2秒ごとに次のセグメントへ
+        if self.frame_counter >= self.fps * 2:
+            self.segment_index += 1
+            self.frame_counter = 0
+
+        # 出力フレーム番号（ドロップしたフレームも含む）で記録する
+        self.gaze_log.append(self.clock.frame_number, gaze_x, gaze_y)
+
+        self.frame_counter += 1
+
+    def drop_frames(self, count):
+        """
+        過負荷で遅れたフレームを意図的にドロップする。ソースのフレームは縮小・マスクせずに読み捨て、
+        出力には直前のフレームを繰り返してセグメントの時刻を壁時計に合わせる。
+        """
+        for _ in range(count):
+            if self.last_masked is None or not self.source.skip():
+                return
+            self.pipeline.put(REPEAT_FRAME)
+            self.record_frame(self.gaze_x, self.gaze_y)
+            self.clock.tick(dropped=True)
+
+    def build_pipeline(self):
+        """読み込み → マスク → エンコード/書き込み → マニフェスト のパイプラインを構築する"""
+        return Pipeline(
+            [
+                ("mask", self.mask_stage, self.queue_size, False),
+                ("write", self.write_stage, self.queue_size, False),
+                ("manifest", self.manifest_stage, 0, False),
+            ],
+            input_size=self.queue_size,
+            input_drop=self.drop_frames_when_full,
+        )
 
     def run(self):
-        #clock = pygame.time.Clock()
         running = True
+        self.pipeline = self.build_pipeline()
+        self.pipeline.start()
+        self.clock.start()
 
         while running:
-            ret_low, frame_low = self.low_cap.read()
-            ret_med, frame_med = self.med_cap.read()
-            ret_high, frame_high = self.high_cap.read()
-
-            if not (ret_low and ret_med and ret_high):
-                print("Video capture reached the end or encountered an error.")
-                time.sleep(1)  # 一時停止してリソースを解放する
-                continue  # エラー後もループを継続
+            if not self.pipeline.is_healthy():
+                print("Pipeline stage stopped unexpectedly.")
+                break
+
+            # ソースの実フレームレートで出力し、遅れすぎた場合はドロップして追いつく
+            if self.realtime:
+                behind = self.clock.wait()
+                if behind:
+                    self.drop_frames(behind)
+
+            ret, frames = self.source.read()
+
+            if not ret:
+                if self.loop:
+                    print("Video reached the end. Restarting from the beginning.")
+                    self.source.restart()
+                    continue
+                print("Video reached the end or encountered an error. Ending the stream.")
+                break
             
             # 正しいリサイズ処理（幅, 高さ の順序で指定）
             '''
-            frame_low = cv2.resize(frame_low, (self.window_width, self.window_height))
-            frame_med = cv2.resize(frame_med, (self.window_width, self.window_height))
-            frame_high = cv2.resize(frame_high, (self.window_width, self.window_height))
+            frames = [cv2.resize(frame, (self.window_width, self.window_height)) for frame in frames]
             '''
 
             # 疑似視線位置を更新
             gaze_x, gaze_y = self.generate_gaze_position()
 
-            # 各解像度のセグメントを保存
-            frame_segmented_with_mask(frame_low, frame_med, frame_high, gaze_x, gaze_y, fps=30, segment_dir='segmented_video_layer', segment_duration=2)
+            # マスク・書き込み・MPD 生成は後段のスレッドで行う
+            self.pipeline.put((frames, gaze_x, gaze_y))
 
             # 合成フレーム作成
             '''
             try:
-                combined_frame = merge_frame(frame_low, frame_med, frame_high, gaze_y, gaze_x) 
+                combined_frame = merge_frame(*frames, gaze_y, gaze_x) 
             except Exception as e:
                 print(f"Error during frame merging: {e}\n")
                 break
             
-            frame_segmented(combined_frame, self.fps, self.segment_dir)
+            self.segment_pipeline.frame_segmented(combined_frame)
             '''
-            # 2秒ごとにMPDとログを保存
-            #print(f'{self.frame_counter}')
-            if self.frame_counter >= self.fps * 2:
-                #generate_mpd(segment_dir=self.segment_dir, mpd_path=os.path.join("manifest.mpd"))
-                generate_mpd_layer(segment_dir=self.segment_layer_dir, mpd_path=os.path.join("manifest_layer.mpd"))
-                # 疑似視線ログを保存
-                #log_gaze_positions(log_dir="logs/gaze_logs", segment_index=self.segment_index, gaze_positions=self.gaze_positions)
-                self.gaze_positions = []  # ログをリセット
-                self.segment_index += 1  # 次のセグメントへ
-
-                self.frame_counter = 0
-
-            self.gaze_positions.append((gaze_x, gaze_y))  # ログに追加
-
-            self.frame_counter += 1
-
-            #clock.tick(60)
+            self.record_frame(gaze_x, gaze_y)
+            self.clock.tick()
 
-        self.cap.release()
-        self.low_cap.release()
-        self.med_cap.release()
-        self.high_cap.release()
+        # パイプラインを空にしてから、書きかけのセグメントを確定・公開する
+        self.pipeline.close()
+        final_segment = self.segment_pipeline.flush()
+        if final_segment is not None:
+            self.manifest_stage(*final_segment)
+        else:
+            # エンコーダを閉じたことで確定した保留中のセグメントを公開する
+            self.segment_pipeline.publish_finalized(timeout=self.segment_pipeline.segment_duration)
+        self.source.release()
+        self.gaze_log.close()
+        self.segment_store.flush()
+        print(
+            f"Stream ended: {self.clock.frame_number} frames, {self.clock.dropped} dropped, "
+            f"max lag {self.clock.max_lag_seconds:.3f}s, segment store {self.segment_store.stats()}, "
+            f"delivery {self.throughput_meter.stats()}"
+        )
+        if self.region_planner is not None:
+            print(f"Gaze region prediction: {self.region_planner.stats()}")
         #pygame.quit()
         # 終了時にブラウザを閉じる
         browser_launcher.close_chrome()
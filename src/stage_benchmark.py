@@ -0,0 +1,492 @@
+"""
+段ごとのベンチマーク。
+
+ffmpeg の testsrc で合成したテスト動画をローカルに作り、パイプラインの各段を単独で計測する。
+
+- encode: h264_compression によるレンディションのエンコード（キャッシュなし）
+- decode: PipedFrameSource による rawvideo パイプのデコードとリングごとの縮小
+- mask: SegmentPipeline.mask_layers（メモリ上のフレームを繰り返し使う）
+- write: 常駐エンコーダによるレイヤーセグメントの書き出し (SegmentPipeline.write_layer_frames)
+- combine: client_functions.combine_segments によるセグメントの合成
+- mpd: generate_mpd_layer による MPD の生成
+- http: CustomHandler + SegmentStore からのセグメントの配信（keep-alive の並列クライアント）
+
+各段は spawn した別プロセスで実行し、処理速度（段によって frames/s, calls/s, requests/s）と、
+そのプロセスと子プロセス (ffmpeg) の最大常駐メモリを記録する。計測前の準備（動画の読み込みやサーバの起動）は
+時間に含めない。combine / mpd / http は write が書き出したセグメントを使う（なければ先に書き出す）。
+
+結果は JSON（既定では benchmarks/<日時>_<コミット>.json）に保存する。--baseline に以前の結果を指定すると、
+処理速度が rate_drop の割合より下がった段、最大常駐メモリが memory_growth の割合より増えた段を回帰として報告し、
+終了コード 1 を返す。閾値は DEFAULT_THRESHOLDS と STAGE_THRESHOLDS（段ごとの上書き）、または --thresholds の JSON で決める。
+
+    python -m src.stage_benchmark
+    python -m src.stage_benchmark --baseline benchmarks/<前の結果>.json
+    python -m src.stage_benchmark --stages mask,mpd --duration 2 --repeat 3
+"""
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import functools
+import statistics
+import subprocess
+import contextlib
+import http.client
+import http.server
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+
+try:
+    import resource
+except ImportError:  # Windows では最大常駐メモリを記録しない
+    resource = None
+
+STAGES = ("encode", "decode", "mask", "write", "combine", "mpd", "http")
+
+# 回帰とみなす閾値（基準の結果に対する割合）
+DEFAULT_THRESHOLDS = {
+    "rate_drop": 0.2,       # 処理速度がこの割合より下がったら回帰
+    "memory_growth": 0.3,   # 最大常駐メモリがこの割合より増えたら回帰
+}
+# 段ごとの上書き（ばらつきの大きい段は緩める）
+STAGE_THRESHOLDS = {
+    "encode": {"rate_drop": 0.3},
+    "http": {"rate_drop": 0.35},
+}
+
+DEFAULT_CONFIG = {
+    "work_dir": "bench_work",
+    "size": (1920, 1080),
+    "fps": 30,
+    "duration": 4,            # テスト動画の長さ（秒）
+    "segment_duration": 2,
+    "preload_frames": 16,     # mask / write で繰り返し使うフレーム数
+    "mpd_calls": 200,
+    "http_rounds": 20,        # 全セグメントを取得する回数（クライアントごと）
+    "http_clients": 4,
+    "encode_workers": 3,
+}
+
+
+def test_video_path(config):
+    width, height = config["size"]
+    return os.path.join(
+        os.path.abspath(config["work_dir"]), f"testsrc_{width}x{height}_{config['fps']}fps_{config['duration']}s.mp4"
+    )
+
+
+def make_test_video(config):
+    """
+    ffmpeg の testsrc でテスト動画を作る（同じ設定の動画があれば再利用する）。
+
+    Returns:
+        str: 動画のパス
+    """
+    path = test_video_path(config)
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    width, height = config["size"]
+    subprocess.run([
+        "ffmpeg", "-y", "-nostdin", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc=size={width}x{height}:rate={config['fps']}:duration={config['duration']}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", path + ".part.mp4"
+    ], check=True)
+    os.replace(path + ".part.mp4", path)
+    print(f"テスト動画を作成しました: {path}")
+    return path
+
+
+def frame_count(config):
+    return config["fps"] * config["duration"]
+
+
+def bench_dir(config, name):
+    """段ごとの作業ディレクトリ（前回の出力は消す）"""
+    path = os.path.join(os.path.abspath(config["work_dir"]), name)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def layer_session_dir(config):
+    """write が書き出すセッションのディレクトリ"""
+    return os.path.join(os.path.abspath(config["work_dir"]), "write", "bench")
+
+
+def preload_frames(config):
+    """テスト動画の先頭から preload_frames 枚のリングごとのフレームを読む"""
+    from src.server.frame_source import PipedFrameSource
+    source = PipedFrameSource(make_test_video(config))
+    frames = []
+    try:
+        while len(frames) < config["preload_frames"]:
+            ret, ring_frames = source.read()
+            if not ret:
+                break
+            frames.append(ring_frames)
+    finally:
+        source.release()
+    return frames
+
+
+def gaze_path(config, count):
+    from src.server.gaze_source import RandomWalkGaze
+    width, height = config["size"]
+    return RandomWalkGaze(width, height, seed=0).generate(count)
+
+
+def bench_encode(config):
+    from src.server.h264_compression import h264_compression
+    video = make_test_video(config)
+    output_dir = bench_dir(config, "encode")
+    start = time.perf_counter()
+    h264_compression(video, output_dir=output_dir, max_workers=config["encode_workers"])
+    return frame_count(config), "frames/s", time.perf_counter() - start
+
+
+def bench_decode(config):
+    from src.server.frame_source import PipedFrameSource
+    source = PipedFrameSource(make_test_video(config))
+    frames = 0
+    start = time.perf_counter()
+    try:
+        while True:
+            ret, _ = source.read()
+            if not ret:
+                break
+            frames += 1
+    finally:
+        source.release()
+    return frames, "frames/s", time.perf_counter() - start
+
+
+def bench_mask(config):
+    from src.server.server_function import SegmentPipeline
+    frames = preload_frames(config)
+    count = frame_count(config)
+    gaze = gaze_path(config, count)
+    pipeline = SegmentPipeline(
+        session_id="bench", root=bench_dir(config, "mask"), fps=config["fps"],
+        segment_duration=config["segment_duration"]
+    )
+    start = time.perf_counter()
+    for i in range(count):
+        pipeline.mask_layers(frames[i % len(frames)], int(gaze[i, 0]), int(gaze[i, 1]))
+    seconds = time.perf_counter() - start
+    pipeline.close()
+    return count, "frames/s", seconds
+
+
+def write_layer_segments(config):
+    """
+    常駐エンコーダでテスト動画分のレイヤーセグメントを書き出し、(フレーム数, 秒数) を返す。
+    マスクは計測の前に preload_frames 枚分だけ行い、その結果を繰り返し書き込む。
+    """
+    from src.server.server_function import SegmentPipeline
+    frames = preload_frames(config)
+    count = frame_count(config)
+    gaze = gaze_path(config, len(frames))
+    pipeline = SegmentPipeline(
+        session_id="bench", root=bench_dir(config, "write"), fps=config["fps"],
+        segment_duration=config["segment_duration"], persistent_encoder=True,
+        pool_size=len(frames)
+    )
+    masked = [
+        pipeline.mask_layers(ring_frames, int(x), int(y)) for ring_frames, (x, y) in zip(frames, gaze)
+    ]
+    start = time.perf_counter()
+    for i in range(count):
+        layer_frames, layer_info = masked[i % len(masked)]
+        pipeline.write_layer_frames(layer_frames, layer_info)
+    pipeline.flush()
+    return count, time.perf_counter() - start
+
+
+def ensure_layer_segments(config):
+    """combine / mpd / http の入力になるレイヤーセグメントを用意する"""
+    from src.server.segment_verifier import segment_indices
+    layer_dir = os.path.join(layer_session_dir(config), "segmented_video_layer")
+    if os.path.isdir(layer_dir) and segment_indices(layer_dir):
+        return layer_dir
+    write_layer_segments(config)
+    return layer_dir
+
+
+def bench_write(config):
+    count, seconds = write_layer_segments(config)
+    return count, "frames/s", seconds
+
+
+def bench_combine(config):
+    from src.client.client_functions import combine_segments
+    from src.client.segment_combiner import layer_segment_paths
+    from src.server.segment_verifier import segment_indices
+    layer_dir = ensure_layer_segments(config)
+    output_dir = bench_dir(config, "combine")
+    start = time.perf_counter()
+    for index in segment_indices(layer_dir):
+        combine_segments(layer_segment_paths(layer_dir, index), os.path.join(output_dir, f"segment_{index:04d}.mp4"))
+    return frame_count(config), "frames/s", time.perf_counter() - start
+
+
+def bench_mpd(config):
+    from src.server.manifest import SegmentIndex
+    from src.server.server_function import generate_mpd_layer
+    layer_dir = ensure_layer_segments(config)
+    mpd_path = os.path.join(bench_dir(config, "mpd"), "manifest_layer.mpd")
+    segment_index = SegmentIndex.from_directory(
+        layer_dir, r"low_segment(\d+)\.mp4$", config["fps"], config["segment_duration"]
+    )
+    start = time.perf_counter()
+    for _ in range(config["mpd_calls"]):
+        generate_mpd_layer(
+            segment_dir=layer_dir, mpd_path=mpd_path, fps=config["fps"], segment_index=segment_index,
+            segment_duration=config["segment_duration"]
+        )
+    return config["mpd_calls"], "calls/s", time.perf_counter() - start
+
+
+def fetch_all(port, paths, rounds):
+    """keep-alive の 1 接続で paths を rounds 回取得し、受信したバイト数を返す"""
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    received = 0
+    try:
+        for _ in range(rounds):
+            for path in paths:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                received += len(response.read())
+                if response.status != 200:
+                    raise RuntimeError(f"HTTP {response.status}: {path}")
+    finally:
+        connection.close()
+    return received
+
+
+def bench_http(config):
+    from src.server.mpeg_server import CustomHandler
+    from src.server.segment_store import SegmentStore
+    layer_dir = ensure_layer_segments(config)
+    root = layer_session_dir(config)
+    store = SegmentStore(root=root, write_behind=False)
+    paths = []
+    for name in sorted(os.listdir(layer_dir)):
+        if name.endswith(".mp4"):
+            store.put_file(os.path.join(layer_dir, name))
+            paths.append(f"/segmented_video_layer/{name}")
+
+    handler = functools.partial(CustomHandler, store=store, directory=root)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    port = server.server_address[1]
+    clients = config["http_clients"]
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            received = sum(executor.map(lambda _: fetch_all(port, paths, config["http_rounds"]), range(clients)))
+        seconds = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+    print(f"HTTP: {received / seconds / 1e6:.1f} MB/s")
+    return len(paths) * config["http_rounds"] * clients, "requests/s", seconds
+
+
+STAGE_FUNCTIONS = {
+    "encode": bench_encode,
+    "decode": bench_decode,
+    "mask": bench_mask,
+    "write": bench_write,
+    "combine": bench_combine,
+    "mpd": bench_mpd,
+    "http": bench_http,
+}
+
+
+def max_rss_mb(who):
+    """最大常駐メモリ [MB]（Linux の ru_maxrss は KB、macOS はバイト）"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(who).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_stage(name, config, verbose=False):
+    """
+    段を 1 回実行する（ワーカープロセスで実行されるため、モジュールレベルの関数にしている）。
+
+    Returns:
+        dict: count, unit, seconds, rate, max_rss_mb, child_max_rss_mb
+    """
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    errors = contextlib.nullcontext() if verbose else contextlib.redirect_stderr(io.StringIO())
+    with output, errors:
+        count, unit, seconds = STAGE_FUNCTIONS[name](config)
+    return {
+        "count": count,
+        "unit": unit,
+        "seconds": round(seconds, 4),
+        "rate": round(count / seconds, 2) if seconds > 0 else None,
+        "max_rss_mb": max_rss_mb(resource.RUSAGE_SELF) if resource else None,
+        "child_max_rss_mb": max_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+    }
+
+
+def measure_stage(name, config, repeat=1, verbose=False):
+    """
+    段を repeat 回、それぞれ新しいプロセスで実行し、処理速度の中央値の回を結果とする。
+    """
+    runs = []
+    context = multiprocessing.get_context("spawn")
+    for _ in range(repeat):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            runs.append(executor.submit(run_stage, name, config, verbose).result())
+    runs.sort(key=lambda run: run["rate"] or 0)
+    result = dict(runs[len(runs) // 2])
+    result["rates"] = [run["rate"] for run in runs]
+    return result
+
+
+def git_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def stage_thresholds(name, thresholds=None):
+    """段の閾値（DEFAULT_THRESHOLDS に STAGE_THRESHOLDS と thresholds の上書きを重ねる）"""
+    merged = dict(DEFAULT_THRESHOLDS)
+    merged.update(STAGE_THRESHOLDS.get(name, {}))
+    if thresholds:
+        merged.update({key: value for key, value in thresholds.items() if key in DEFAULT_THRESHOLDS})
+        merged.update(thresholds.get("stages", {}).get(name, {}))
+    return merged
+
+
+def compare_results(baseline, current, thresholds=None):
+    """
+    基準の結果と比べ、回帰した段を返す。
+
+    Args:
+        baseline (dict), current (dict): run_benchmarks の結果。
+        thresholds (dict): {"rate_drop", "memory_growth", "stages": {段: {...}}} の上書き。
+
+    Returns:
+        list: 回帰の説明
+    """
+    regressions = []
+    for name, result in current["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if base is None:
+            continue
+        limits = stage_thresholds(name, thresholds)
+        if base.get("rate") and result.get("rate") is not None:
+            minimum = base["rate"] * (1 - limits["rate_drop"])
+            if result["rate"] < minimum:
+                regressions.append(
+                    f"{name}: {result['rate']} {result['unit']} < {minimum:.2f} "
+                    f"(基準 {base['rate']}, 許容 -{limits['rate_drop']:.0%})"
+                )
+        for key in ("max_rss_mb", "child_max_rss_mb"):
+            if base.get(key) and result.get(key) is not None:
+                maximum = base[key] * (1 + limits["memory_growth"])
+                if result[key] > maximum:
+                    regressions.append(
+                        f"{name}: {key} {result[key]} MB > {maximum:.1f} MB "
+                        f"(基準 {base[key]} MB, 許容 +{limits['memory_growth']:.0%})"
+                    )
+    return regressions
+
+
+def run_benchmarks(stages=STAGES, config=None, repeat=1, verbose=False):
+    """
+    指定した段を順に計測する。
+
+    Returns:
+        dict: 実行環境、設定、段ごとの結果
+    """
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    make_test_video(config)
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "config": config,
+        "stages": {},
+    }
+    for name in stages:
+        print(f"[{name}] 計測中...")
+        result = measure_stage(name, config, repeat, verbose)
+        results["stages"][name] = result
+        print(
+            f"[{name}] {result['rate']} {result['unit']} ({result['count']} in {result['seconds']}s), "
+            f"max RSS {result['max_rss_mb']} MB, children {result['child_max_rss_mb']} MB"
+        )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="テスト動画でパイプラインの段ごとの処理速度とメモリを計測する")
+    parser.add_argument("--stages", default=",".join(STAGES), help="計測する段（カンマ区切り）")
+    parser.add_argument("--duration", type=int, default=DEFAULT_CONFIG["duration"], help="テスト動画の長さ（秒）")
+    parser.add_argument("--size", default="x".join(map(str, DEFAULT_CONFIG["size"])), help="テスト動画の解像度（例: 1920x1080）")
+    parser.add_argument("--fps", type=int, default=DEFAULT_CONFIG["fps"])
+    parser.add_argument("--repeat", type=int, default=1, help="段ごとの実行回数（処理速度の中央値の回を記録する）")
+    parser.add_argument("--work-dir", default=DEFAULT_CONFIG["work_dir"], help="テスト動画と出力を置くディレクトリ")
+    parser.add_argument("--output", help="結果の JSON のパス（省略時は benchmarks/<日時>_<コミット>.json）")
+    parser.add_argument("--baseline", help="比較する以前の結果の JSON")
+    parser.add_argument("--thresholds", help="閾値を上書きする JSON（{\"rate_drop\", \"memory_growth\", \"stages\": {...}}）")
+    parser.add_argument("--verbose", action="store_true", help="各段の出力を表示する")
+    args = parser.parse_args(argv)
+
+    stages = [name for name in args.stages.split(",") if name]
+    unknown = [name for name in stages if name not in STAGE_FUNCTIONS]
+    if unknown:
+        parser.error(f"未知の段: {', '.join(unknown)}")
+    width, height = (int(value) for value in args.size.split("x"))
+    config = {"duration": args.duration, "size": (width, height), "fps": args.fps, "work_dir": args.work_dir}
+
+    results = run_benchmarks(stages, config, args.repeat, args.verbose)
+
+    thresholds = None
+    if args.thresholds:
+        with open(args.thresholds, "r", encoding="utf-8") as f:
+            thresholds = json.load(f)
+    results["thresholds"] = {name: stage_thresholds(name, thresholds) for name in stages}
+
+    output = args.output or os.path.join(
+        "benchmarks", f"{time.strftime('%Y%m%d_%H%M%S')}_{results['commit'] or 'nogit'}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"結果を保存しました: {output}")
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare_results(baseline, results, thresholds)
+    if regressions:
+        print(f"基準 ({baseline.get('commit')}) に対する回帰:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print(f"基準 ({baseline.get('commit')}) に対する回帰はありません")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,46 @@
+import os
+import pytest
+from src.server.log_writing import GazeLogWriter
+from src.client.gaze_log_handler import GazeLogReader
+
+
+def write_frames(path, frames, **kwargs):
+    writer = GazeLogWriter(path, **kwargs)
+    for frame in frames:
+        writer.append(frame, frame, frame * 2)
+    writer.close()
+
+
+def test_reopen_starts_new_session(tmp_path):
+    # 2 回目の起動でもフレーム番号は 0 から始まる
+    path = str(tmp_path / "logs" / "gaze_log.bin")
+    write_frames(path, range(100))
+    write_frames(path, range(10))
+
+    reader = GazeLogReader(path)
+    assert len(reader) == 10
+    assert reader.positions(0, 10)[-1].tolist() == [9, 18]
+
+
+def test_append_continues_previous_log(tmp_path):
+    path = str(tmp_path / "gaze_log.bin")
+    write_frames(path, range(100))
+    write_frames(path, range(100, 110), append=True)
+    assert len(GazeLogReader(path)) == 110
+
+    writer = GazeLogWriter(path, append=True)
+    with pytest.raises(ValueError):
+        writer.append(0, 0, 0)
+    writer.close()
+
+
+def test_reader_follows_new_session(tmp_path):
+    path = str(tmp_path / "gaze_log.bin")
+    write_frames(path, range(100))
+    reader = GazeLogReader(path)
+    assert len(reader) == 100
+
+    write_frames(path, range(5))
+    assert reader.refresh() == 5
+    assert reader.records["frame"][-1] == 4
+    assert os.path.getsize(path) > 0
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from src.server.gaze_source import ReplayGaze, create_gaze_source
+from src.server.log_writing import GazeLogWriter
+
+
+@pytest.mark.parametrize("model", ["random_walk", "saccade"])
+def test_same_seed_same_trajectory(model):
+    # セグメント単位でも 1 フレームずつでも、同じ seed なら同じ列になる（ブロックの境界をまたぐ長さ）
+    frames = 700
+    by_segment = create_gaze_source(model, 1920, 1080, fps=30, seed=7)
+    segments = np.concatenate(
+        [by_segment.generate(60) for _ in range(frames // 60)] + [by_segment.generate(frames % 60)]
+    )
+
+    by_frame = create_gaze_source(model, 1920, 1080, fps=30, seed=7)
+    positions = np.array([by_frame.next_position() for _ in range(frames)])
+
+    assert segments.shape == (frames, 2)
+    assert np.array_equal(segments, positions)
+    assert (segments >= 0).all() and (segments[:, 0] < 1920).all() and (segments[:, 1] < 1080).all()
+
+    other = create_gaze_source(model, 1920, 1080, fps=30, seed=8)
+    assert not np.array_equal(other.generate(frames), segments)
+
+
+def write_log(path, positions):
+    writer = GazeLogWriter(path)
+    for frame, (x, y) in enumerate(positions):
+        writer.append(frame, int(x), int(y))
+    writer.close()
+
+
+def test_replay_reproduces_log(tmp_path):
+    path = str(tmp_path / "logs" / "gaze_log.bin")
+    recorded = create_gaze_source("saccade", 1920, 1080, seed=3).generate(300)
+    write_log(path, recorded)
+
+    replay = ReplayGaze(path, loop=False, block_frames=64)
+    assert np.array_equal(replay.generate(150), recorded[:150])
+    assert [replay.next_position() for _ in range(150)] == [tuple(p) for p in recorded[150:].tolist()]
+    with pytest.raises(ValueError):
+        replay.next_position()
+
+
+def test_replay_loops(tmp_path):
+    path = str(tmp_path / "gaze_log.bin")
+    recorded = np.array([(i, 2 * i) for i in range(100)])
+    write_log(path, recorded)
+
+    replay = create_gaze_source("replay", 1920, 1080, log_path=path)
+    assert np.array_equal(replay.generate(250), np.concatenate([recorded, recorded, recorded[:50]]))
@@ -0,0 +1,55 @@
+import os
+from src.server.segment_watcher import SegmentListReader, append_segment_list
+
+
+def write_rows(path, numbers, mode="w"):
+    with open(path, mode, encoding="utf-8") as f:
+        for n in numbers:
+            f.write(f"med_segment{n:04d}.mp4,{n * 2:.6f},{n * 2 + 2:.6f}\n")
+
+
+def test_reads_appended_rows(tmp_path):
+    path = str(tmp_path / "med_segments.csv")
+    reader = SegmentListReader(path)
+    assert reader.poll() == 0
+
+    append_segment_list(path, "med_segment0000.mp4", 0, 2)
+    assert reader.poll() == 1
+    append_segment_list(path, "med_segment0001.mp4", 2, 4)
+    append_segment_list(path, "med_segment0002.mp4", 4, 6)
+    assert reader.poll() == 3
+
+
+def test_restart_rewrites_longer_list_in_place(tmp_path):
+    # エンコーダの再起動で同じファイルが切り詰められ、次の poll までに前より長く書き直される
+    path = str(tmp_path / "med_segments.csv")
+    write_rows(path, range(4))
+    reader = SegmentListReader(path)
+    assert reader.poll() == 4
+
+    inode = os.stat(path).st_ino
+    write_rows(path, range(10, 14))
+    assert os.stat(path).st_ino == inode
+    # 前回の読み取り位置は書き直した最後の行の途中にある
+    assert os.path.getsize(path) - 40 < reader.offset < os.path.getsize(path)
+    assert reader.poll() == 14
+
+    write_rows(path, [14], mode="a")
+    assert reader.poll() == 15
+
+
+def test_new_session_replaces_list(tmp_path):
+    path = str(tmp_path / "med_segments.csv")
+    write_rows(path, range(5))
+    reader = SegmentListReader(path)
+    assert reader.poll() == 5
+
+    # 新しいセッションが別のファイルに書いて置き換える（前より長い）
+    write_rows(path + ".tmp", range(8))
+    os.replace(path + ".tmp", path)
+    assert reader.poll() == 8
+
+    # 同じパスのファイルを作り直して短く書いた場合も番号は 0 からになる
+    os.remove(path)
+    write_rows(path, range(1))
+    assert reader.poll() == 1
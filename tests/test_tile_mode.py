@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from src.client.compositor import ROICompositor
+from src.client.client_functions import load_layer_metadata
+from src.server.foveation_rings import DEFAULT_RINGS
+from src.server.server_function import SegmentPipeline
+
+# マスク半径 100 の円 (201 x 201) が収まるタイル
+TILE_SIZE = (320, 240)
+
+
+def ring_frames():
+    # 各リングの画素値を位置から決める（タイルの位置がずれると値が変わる）
+    frames = []
+    for ring in DEFAULT_RINGS:
+        width, height = ring["size"]
+        frame = np.full((height, width, 3), 128, dtype=np.uint8)
+        frame[..., 0] = (np.arange(width) * 255 // (width - 1))[np.newaxis, :]
+        frame[..., 1] = (np.arange(height) * 255 // (height - 1))[:, np.newaxis]
+        frames.append(frame)
+    return frames
+
+
+def masked_layer_metadata(pipeline, gaze_x, gaze_y):
+    """mask_layers の結果からサイドカー JSON を書き出して読み戻す"""
+    layer_frames, layer_info = pipeline.mask_layers(ring_frames(), gaze_x, gaze_y)
+    pipeline.write_layer_frames(layer_frames, layer_info)
+    pipeline.save_layer_metadata()
+    metadata = {}
+    for layer in pipeline.masked_layers:
+        metadata[layer] = load_layer_metadata(pipeline.layer_segment_path(layer, 0))
+    return layer_frames, layer_info, metadata
+
+
+def test_tile_offset_is_clipped_near_edge(tmp_path):
+    pipeline = SegmentPipeline(root=str(tmp_path), tile_size=TILE_SIZE)
+    layer_frames, layer_info, metadata = masked_layer_metadata(pipeline, 1900, 1070)
+
+    assert layer_info["high"]["offset"] == (1920 - 320, 1080 - 240)
+    assert layer_info["med"]["offset"] == (640 - 320, 360 - 240)
+    for layer in pipeline.masked_layers:
+        assert layer_frames[layer].shape == (240, 320, 3)
+        assert metadata[layer]["tile_size"] == list(TILE_SIZE)
+        assert metadata[layer]["offsets"] == [list(layer_info[layer]["offset"])]
+
+
+@pytest.mark.parametrize("gaze", [(960, 540), (1900, 1070), (10, 20)])
+def test_tile_placement_matches_full_frame(tmp_path, gaze):
+    # タイルから貼り付けた結果は、フレーム全体のレイヤーから貼り付けた結果と同じになる
+    tiled = SegmentPipeline(root=str(tmp_path / "tiled"), tile_size=TILE_SIZE)
+    full = SegmentPipeline(root=str(tmp_path / "full"))
+    tile_frames, _, tile_metadata = masked_layer_metadata(tiled, *gaze)
+    full_frames, _, full_metadata = masked_layer_metadata(full, *gaze)
+
+    low = ring_frames()[0]
+    low_size = DEFAULT_RINGS[0]["size"]
+    expected = ROICompositor(low_size, full_metadata).composite(low, full_frames, 0).copy()
+    actual = ROICompositor(low_size, tile_metadata).composite(low, tile_frames, 0)
+    assert (expected != low).any()
+    assert int(np.abs(actual.astype(np.int16) - expected).max()) <= 2
+
+
+def test_circle_larger_than_tile_is_not_stretched(tmp_path):
+    # タイルからはみ出した円の部分は欠けるだけで、タイルを ROI 全体に引き伸ばさない
+    tiled = SegmentPipeline(root=str(tmp_path / "tiled"), tile_size=(320, 120))
+    full = SegmentPipeline(root=str(tmp_path / "full"))
+    tile_frames, tile_info, tile_metadata = masked_layer_metadata(tiled, 960, 540)
+    full_frames, _, full_metadata = masked_layer_metadata(full, 960, 540)
+
+    low = ring_frames()[0]
+    low_size = DEFAULT_RINGS[0]["size"]
+    expected = ROICompositor(low_size, {"med": full_metadata["med"]}).composite(low, full_frames, 0).copy()
+    actual = ROICompositor(low_size, {"med": tile_metadata["med"]}).composite(low, tile_frames, 0)
+
+    # med のタイルが覆う出力上の行 (low は med の 3/4)
+    _, offset_y = tile_info["med"]["offset"]
+    top, bottom = int(np.ceil(offset_y * 0.75)), int((offset_y + 120) * 0.75)
+    # 円の縁は縮小時の補間で黒と混ざるため、縁から離れた内側だけを比べる
+    ys, xs = np.mgrid[top:bottom, 0:low_size[0]]
+    inside = (xs - 240) ** 2 + (ys - 135) ** 2 < 70 ** 2
+    diff = np.abs(actual[top:bottom].astype(np.int16) - expected[top:bottom])
+    assert int(diff[inside].max()) <= 2
+    assert (actual[:top] == low[:top]).all()
+    assert (actual[bottom:] == low[bottom:]).all()
+
+
+def test_tile_larger_than_ring_is_rejected(tmp_path):
+    # med (640x360) に収まらないタイルは、サイドカーや MPD と食い違うため受け付けない
+    with pytest.raises(ValueError):
+        SegmentPipeline(root=str(tmp_path), tile_size=(800, 600))
+    SegmentPipeline(root=str(tmp_path), tile_size=(640, 360))